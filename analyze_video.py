@@ -0,0 +1,523 @@
+"""
+离线批量分析：对 input/ 下的录播视频（或指定的文件/文件夹）做无界面、尽可能快的行为分析。
+
+与 serverapp_v3.py 的实时链路不同：
+- 不按原速播放，解码多快就处理多快；不需要分析的帧只 grab() 不 retrieve()，省掉像素格式转换与拷贝；
+- 解码在单独线程里进行，攒够 BATCH 帧一起推理，结果按帧序交给跟踪器；
+- 默认不绘制、不编码，--draw 时才额外输出带框视频。
+
+输出（OUTPUT_DIR 下，以视频文件名为前缀）：
+  <name>.frames.csv   每帧每个目标一行：frame,time_ms,track_id,class_id,behavior,conf,x1,y1,x2,y2
+  <name>.tracks.json  每条轨迹的汇总（出现区间、各行为帧数、主要行为）以及整段视频的处理统计
+  <name>.annotated.mp4（仅 --draw）
+
+用法：
+  python analyze_video.py                          # 分析 input/ 下所有视频
+  python analyze_video.py input/xxx.mp4 --every 5 --draw
+  python analyze_video.py input/ --workers 4       # 多进程并行，每个进程只加载一次模型
+
+断点续跑：每完成一个视频就在 OUTPUT_DIR/progress.jsonl 追加一条记录（含文件大小/修改时间/分析参数），
+再次运行时跳过记录完全一致的视频；输出文件先写临时文件、完成后再改名，中途崩溃不会留下半截结果。
+
+结果缓存：分析结果按 视频内容哈希 + 权重文件哈希 + 参数（CONF_THRES / IOU_THRES / 跟踪器 YAML 内容 / every）
+存入 CACHE_DIR；同样的输入再跑一遍时直接从缓存拷出结果，不加载模型、不推理。缓存总大小超过
+CACHE_MAX_BYTES 时按最近使用时间淘汰。
+"""
+import os
+import csv
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import multiprocessing as mp
+from queue import Queue
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+from ultralytics.utils.checks import check_yaml
+
+from common import BEHAVIOR_ORDER as _BEHAVIOR_ORDER
+from common import behavior_lut, lookup_behavior, new_tracker
+from model_backend import BACKENDS, resolve_weights
+
+# =========================
+# 用户配置
+# =========================
+MODEL_PATH = r"xanylabeling_models\best_1200_pre.pt"
+TRACKER_CFG = "botsort.yaml"
+CONF_THRES = 0.25
+IOU_THRES = 0.30
+DEVICE = None     # "cuda:0" / "cpu" / None(自动)
+VERBOSE = False
+BACKEND = "pt"    # "pt" / "onnx" / "openvino"，见 model_backend.py
+BACKEND_INT8 = False
+BACKEND_DATA = None
+
+INPUT_DIR = "input"
+OUTPUT_DIR = "output"
+VIDEO_EXTS = (".mp4", ".avi", ".mkv", ".mov", ".flv", ".ts")
+BATCH = 8         # 每次推理的帧数
+EVERY = 1         # 每隔多少帧分析一帧（1 = 每帧都分析）
+READ_AHEAD = 2    # 解码线程最多提前准备几个批次
+WORKERS = 1       # 并行分析的进程数；0 = CPU 核数
+PROGRESS_FILE = "progress.jsonl"
+CACHE_DIR = os.path.join(OUTPUT_DIR, "cache")   # None 关闭结果缓存
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# =========================
+
+def _split_tracks(tracks):
+    """跟踪器输出 (N, 8)：[x1, y1, x2, y2, track_id, conf, cls, idx] → (xyxy, ids, conf, cls)。"""
+    tracks = np.asarray(tracks, dtype=np.float64).reshape(-1, 8)
+    return (tracks[:, :4].astype(np.int32), tracks[:, 4].astype(np.int64),
+            tracks[:, 5].astype(np.float32), tracks[:, 6].astype(np.int32))
+
+
+def load_model(model_path=MODEL_PATH):
+    os.environ["ULTRALYTICS_HIDE_VERSION_WARNING"] = "1"
+    model = YOLO(resolve_weights(model_path, BACKEND, BACKEND_INT8, data=BACKEND_DATA))
+    if DEVICE and BACKEND == "pt":
+        model.to(DEVICE)
+    return model, behavior_lut(getattr(model, "names", {}))
+
+
+def list_videos(paths):
+    """展开文件/文件夹参数为视频文件列表（文件夹只取一层，按文件名排序）。"""
+    videos = []
+    for p in paths:
+        if os.path.isdir(p):
+            videos.extend(
+                os.path.join(p, name) for name in sorted(os.listdir(p))
+                if name.lower().endswith(VIDEO_EXTS)
+            )
+        elif os.path.isfile(p):
+            videos.append(p)
+        else:
+            print(f"[WARN] 找不到: {p}")
+    return videos
+
+
+def _read_batches(cap, every, batch, q, stop):
+    """解码线程：只 retrieve 需要分析的帧，按批次放入队列，结束时放入 None。"""
+    frames, idxs = [], []
+    idx = 0
+    try:
+        while not stop.is_set():
+            if idx % every:
+                if not cap.grab():
+                    break
+            else:
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                frames.append(frame)
+                idxs.append(idx)
+                if len(frames) == batch:
+                    q.put((idxs, frames))
+                    frames, idxs = [], []
+            idx += 1
+        if frames:
+            q.put((idxs, frames))
+    finally:
+        q.put(None)
+
+
+def _draw(frame, xyxy, beh, ids):
+    color = (0, 255, 0)
+    for (x1, y1, x2, y2), b, tid in zip(xyxy.tolist(), beh.tolist(), ids.tolist()):
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        label = f"ID {tid} {_BEHAVIOR_ORDER[b] if b >= 0 else ''}"
+        cv2.putText(frame, label, (x1, max(0, y1 - 8)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, lineType=cv2.LINE_AA)
+
+
+class TrackSummary:
+    """按轨迹累计：首末帧、出现帧数、各行为帧数、平均置信度。"""
+
+    def __init__(self):
+        self._tracks = {}
+
+    def add(self, frame_idx, ids, beh, conf):
+        for tid, b, c in zip(ids.tolist(), beh.tolist(), conf.tolist()):
+            if tid < 0:
+                continue
+            t = self._tracks.get(tid)
+            if t is None:
+                t = self._tracks[tid] = [frame_idx, frame_idx, 0, [0] * len(_BEHAVIOR_ORDER), 0.0]
+            t[1] = frame_idx
+            t[2] += 1
+            if b >= 0:
+                t[3][b] += 1
+            t[4] += c
+
+    def to_list(self, fps):
+        out = []
+        for tid, (first, last, n, beh, conf_sum) in sorted(self._tracks.items()):
+            out.append({
+                "track_id": tid,
+                "first_frame": first,
+                "last_frame": last,
+                "first_ms": int(first * 1000 / fps),
+                "last_ms": int(last * 1000 / fps),
+                "frames": n,
+                "behavior_frames": dict(zip(_BEHAVIOR_ORDER, beh)),
+                "main_behavior": _BEHAVIOR_ORDER[int(np.argmax(beh))] if any(beh) else None,
+                "mean_conf": round(conf_sum / n, 4),
+            })
+        return out
+
+
+def _output_stem(path, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0])
+
+
+def analyze_video(model, lut, path, out_dir=OUTPUT_DIR, every=EVERY, batch=BATCH, draw=False):
+    """分析单个视频，写出 frames.csv / tracks.json（及可选的带框视频），返回处理统计。"""
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise RuntimeError(f"无法打开视频: {path}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    stem = _output_stem(path, out_dir)
+    tracker = new_tracker(TRACKER_CFG, DEVICE, fps / every)
+    summary = TrackSummary()
+    # 先写临时文件，整段分析完成后再改名，保证 output/ 中的结果要么完整要么不存在
+    writer = cv2.VideoWriter(stem + ".annotated.tmp.mp4", cv2.VideoWriter_fourcc(*"mp4v"), fps / every, (w, h)) if draw else None
+
+    q = Queue(maxsize=READ_AHEAD)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_batches, args=(cap, every, batch, q, stop), name="decode", daemon=True)
+    t0 = time.time()
+    reader.start()
+    analyzed = 0
+    last_idx = -1
+    infer_sec = 0.0
+    try:
+        with open(stem + ".frames.csv.tmp", "w", newline="", encoding="utf-8") as f:
+            out = csv.writer(f)
+            out.writerow(["frame", "time_ms", "track_id", "class_id", "behavior", "conf", "x1", "y1", "x2", "y2"])
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                idxs, frames = item
+                ti = time.time()
+                results = model.predict(source=frames, stream=False, show=False, verbose=VERBOSE,
+                                        conf=CONF_THRES, iou=IOU_THRES, save=False)
+                infer_sec += time.time() - ti
+                for frame_idx, frame, result in zip(idxs, frames, results):
+                    tracks = tracker.update(result.boxes.cpu().numpy(), result.orig_img)
+                    xyxy, ids, conf, cls = _split_tracks(tracks)
+                    beh = lookup_behavior(lut, cls)
+                    time_ms = int(frame_idx * 1000 / fps)
+                    out.writerows(
+                        [frame_idx, time_ms, tid, c, _BEHAVIOR_ORDER[b] if b >= 0 else "", round(cf, 4), x1, y1, x2, y2]
+                        for (x1, y1, x2, y2), tid, c, b, cf in zip(
+                            xyxy.tolist(), ids.tolist(), cls.tolist(), beh.tolist(), conf.tolist())
+                    )
+                    summary.add(frame_idx, ids, beh, conf)
+                    if writer is not None:
+                        _draw(frame, xyxy, beh, ids)
+                        writer.write(frame)
+                    analyzed += 1
+                    last_idx = frame_idx
+    finally:
+        stop.set()
+        while reader.is_alive():
+            # 推理出错时解码线程可能阻塞在满队列上，取空队列让它退出
+            while not q.empty():
+                q.get_nowait()
+            reader.join(timeout=0.1)
+        cap.release()
+        if writer is not None:
+            writer.release()
+
+    elapsed = time.time() - t0
+    decoded = max(total, last_idx + 1)
+    stats = {
+        "video": os.path.basename(path),
+        "fps": fps,
+        "frame_size": {"width": w, "height": h},
+        "frames": decoded,
+        "analyzed_frames": analyzed,
+        "every": every,
+        "elapsed_sec": round(elapsed, 3),
+        "infer_sec": round(infer_sec, 3),
+        "frames_per_sec": round(decoded / elapsed, 2) if elapsed > 0 else 0.0,
+        "analyzed_per_sec": round(analyzed / elapsed, 2) if elapsed > 0 else 0.0,
+        "params": {"model": os.path.basename(MODEL_PATH), "backend": BACKEND, "int8": BACKEND_INT8,
+                   "conf": CONF_THRES, "iou": IOU_THRES, "tracker": TRACKER_CFG},
+    }
+    with open(stem + ".tracks.json.tmp", "w", encoding="utf-8") as f:
+        json.dump({"summary": stats, "tracks": summary.to_list(fps)}, f, ensure_ascii=False, indent=2)
+    os.replace(stem + ".frames.csv.tmp", stem + ".frames.csv")
+    if draw:
+        os.replace(stem + ".annotated.tmp.mp4", stem + ".annotated.mp4")
+    os.replace(stem + ".tracks.json.tmp", stem + ".tracks.json")
+    return stats
+
+
+# ---------------- 断点续跑 ----------------
+def _job_key(path, every):
+    """决定一个视频是否需要重跑：文件本身（大小/修改时间）与影响结果的分析参数。"""
+    st = os.stat(path)
+    return {
+        "size": st.st_size,
+        "mtime": int(st.st_mtime),
+        "model": MODEL_PATH,
+        "backend": [BACKEND, BACKEND_INT8],
+        "conf": CONF_THRES,
+        "iou": IOU_THRES,
+        "tracker": TRACKER_CFG,
+        "every": every,
+    }
+
+
+def _load_progress(out_dir):
+    done = {}
+    try:
+        with open(os.path.join(out_dir, PROGRESS_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时可能留下半行
+                done[rec["path"]] = rec["key"]
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def _append_progress(out_dir, path, key, stats):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, PROGRESS_FILE), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"path": path, "key": key, "stats": stats}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# ---------------- 结果缓存（内容寻址） ----------------
+_hash_memo = {}
+
+
+def _file_sha256(path):
+    """整文件 SHA-256；同一进程内按 (路径, 大小, 修改时间) 记忆，权重文件只算一次。"""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    digest = _hash_memo.get(memo_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = _hash_memo[memo_key] = h.hexdigest()
+    return digest
+
+
+def _cache_key(path, every):
+    """返回 (条目名, 键内容)。任何一项变化都会得到不同的条目名，旧条目自然失效并最终被淘汰。"""
+    with open(check_yaml(TRACKER_CFG), "rb") as f:
+        tracker_sha = hashlib.sha256(f.read()).hexdigest()
+    key = {
+        "video": _file_sha256(path),
+        "weights": _file_sha256(MODEL_PATH) if os.path.isfile(MODEL_PATH) else MODEL_PATH,
+        "backend": [BACKEND, BACKEND_INT8],  # 导出/量化后的结果与 .pt 有细微差异，分开缓存
+        "conf": CONF_THRES,
+        "iou": IOU_THRES,
+        "tracker": tracker_sha,
+        "every": every,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest(), key
+
+
+def _cache_get(cache_dir, name):
+    entry = os.path.join(cache_dir, name)
+    if not (os.path.isfile(os.path.join(entry, "tracks.json")) and os.path.isfile(os.path.join(entry, "frames.csv"))):
+        return None
+    os.utime(entry)  # 条目目录的修改时间即最近使用时间（LRU）
+    return entry
+
+
+def _cache_put(cache_dir, name, key, stem, max_bytes):
+    entry = os.path.join(cache_dir, name)
+    tmp = f"{entry}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    shutil.copyfile(stem + ".frames.csv", os.path.join(tmp, "frames.csv"))
+    shutil.copyfile(stem + ".tracks.json", os.path.join(tmp, "tracks.json"))
+    with open(os.path.join(tmp, "key.json"), "w", encoding="utf-8") as f:
+        json.dump(key, f, indent=2)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # 其他进程已写入同一条目
+    _cache_evict(cache_dir, max_bytes)
+
+
+def _cache_evict(cache_dir, max_bytes):
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if ".tmp" in name or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(e.stat().st_size for e in os.scandir(entry))
+            entries.append((os.stat(entry).st_mtime, size, entry))
+        except OSError:
+            continue  # 并发淘汰时可能已被删除
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def _cache_replay(entry, path, out_dir):
+    """把缓存的结果拷到 output/，只改写汇总中与本次运行相关的字段。"""
+    t0 = time.time()
+    stem = _output_stem(path, out_dir)
+    shutil.copyfile(os.path.join(entry, "frames.csv"), stem + ".frames.csv.tmp")
+    with open(os.path.join(entry, "tracks.json"), "r", encoding="utf-8") as f:
+        data = json.load(f)
+    stats = data["summary"]
+    elapsed = time.time() - t0
+    stats.update({
+        "video": os.path.basename(path),
+        "cached": True,
+        "elapsed_sec": round(elapsed, 3),
+        "infer_sec": 0.0,
+        "frames_per_sec": round(stats["frames"] / elapsed, 2) if elapsed > 0 else 0.0,
+        "analyzed_per_sec": round(stats["analyzed_frames"] / elapsed, 2) if elapsed > 0 else 0.0,
+    })
+    with open(stem + ".tracks.json.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(stem + ".frames.csv.tmp", stem + ".frames.csv")
+    os.replace(stem + ".tracks.json.tmp", stem + ".tracks.json")
+    return stats
+
+
+# ---------------- 多进程 ----------------
+_worker = {}
+
+
+def _set_threads(n):
+    """限制本进程的 torch / OpenCV 线程数，多个进程并行时不互相抢核。"""
+    import torch
+    torch.set_num_threads(n)
+    cv2.setNumThreads(n)
+
+
+def _worker_init(model_path, backend, out_dir, every, batch, draw, threads, cache_dir):
+    global MODEL_PATH, BACKEND, BACKEND_INT8
+    MODEL_PATH = model_path
+    BACKEND, BACKEND_INT8 = backend
+    _set_threads(threads)
+    _worker.update(out_dir=out_dir, every=every, batch=batch, draw=draw, cache_dir=cache_dir)
+
+
+def _analyze(path):
+    w = _worker
+    name = key = None
+    if w["cache_dir"]:
+        name, key = _cache_key(path, w["every"])
+        # 带框视频不在缓存里，--draw 时仍需完整跑一遍（结果照样写入缓存）
+        entry = None if w["draw"] else _cache_get(w["cache_dir"], name)
+        if entry is not None:
+            return _cache_replay(entry, path, w["out_dir"])
+    if "model" not in w:
+        # 每个进程只加载一次，之后处理的所有视频共用；全部命中缓存时不加载
+        w["model"], w["lut"] = load_model(MODEL_PATH)
+    stats = analyze_video(w["model"], w["lut"], path, w["out_dir"], w["every"], w["batch"], w["draw"])
+    if name is not None:
+        _cache_put(w["cache_dir"], name, key, _output_stem(path, w["out_dir"]), CACHE_MAX_BYTES)
+    return stats
+
+
+def _worker_run(path):
+    try:
+        stats = _analyze(path)
+        stats["worker"] = os.getpid()
+        return path, stats, None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def main():
+    global MODEL_PATH, BACKEND, BACKEND_INT8
+    parser = argparse.ArgumentParser(description="离线批量分析录播视频，结果写入 output/")
+    parser.add_argument("paths", nargs="*", default=[INPUT_DIR], help="视频文件或文件夹（默认 input/）")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--backend", choices=BACKENDS, default=BACKEND, help="推理后端（首次使用时导出并缓存）")
+    parser.add_argument("--int8", action="store_true", default=BACKEND_INT8, help="使用 INT8 量化的导出模型")
+    parser.add_argument("--out", default=OUTPUT_DIR)
+    parser.add_argument("--every", type=int, default=EVERY, help="每隔多少帧分析一帧")
+    parser.add_argument("--batch", type=int, default=BATCH)
+    parser.add_argument("--draw", action="store_true", help="同时输出带框视频（较慢）")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="并行进程数，0 = CPU 核数")
+    parser.add_argument("--force", action="store_true", help="忽略 progress.jsonl，全部重新分析")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="结果缓存目录")
+    parser.add_argument("--no-cache", action="store_true", help="不读写结果缓存")
+    args = parser.parse_args()
+
+    MODEL_PATH = args.model
+    BACKEND, BACKEND_INT8 = args.backend, args.int8
+    if BACKEND != "pt":
+        resolve_weights(MODEL_PATH, BACKEND, BACKEND_INT8, data=BACKEND_DATA)  # 在主进程导出一次，各工作进程直接加载
+    every, batch = max(1, args.every), max(1, args.batch)
+    videos = [os.path.abspath(p) for p in list_videos(args.paths)]
+    done = {} if args.force else _load_progress(args.out)
+    todo = [p for p in videos if done.get(p) != _job_key(p, every)]
+    if len(todo) < len(videos):
+        print(f"[INFO] 跳过已完成的 {len(videos) - len(todo)} 个视频（--force 可全部重跑）")
+    if not todo:
+        print("[WARN] 没有需要分析的视频")
+        return
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    workers = min(args.workers or os.cpu_count() or 1, len(todo))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    t0 = time.time()
+    frames, failed = 0, 0
+    timings = []
+
+    def record(path, stats, err):
+        nonlocal frames, failed
+        if err:
+            failed += 1
+            print(f"[ERR] {os.path.basename(path)}: {err}")
+            return
+        _append_progress(args.out, path, _job_key(path, every), stats)
+        frames += stats["frames"]
+        timings.append((stats["video"], stats["elapsed_sec"], stats["frames_per_sec"]))
+        print(f"[OK] {stats['video']}: {stats['frames']} 帧（{'缓存' if stats.get('cached') else '分析'} {stats['analyzed_frames']}），"
+              f"耗时 {stats['elapsed_sec']:.1f}s，{stats['frames_per_sec']:.1f} 帧/秒"
+              + (f"（进程 {stats['worker']}）" if "worker" in stats else ""))
+
+    if workers <= 1:
+        _worker_init(args.model, (BACKEND, BACKEND_INT8), args.out, every, batch, args.draw, threads, cache_dir)
+        for path in todo:
+            record(*_worker_run(path))
+    else:
+        print(f"[INFO] {workers} 个进程并行，每个进程 {threads} 个线程")
+        # spawn：子进程不继承父进程的 torch 线程池等状态；imap_unordered 每次只派发一个文件，空闲进程自动领取下一个
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(workers, initializer=_worker_init,
+                      initargs=(args.model, (BACKEND, BACKEND_INT8), args.out, every, batch, args.draw, threads, cache_dir)) as pool:
+            for result in pool.imap_unordered(_worker_run, todo, chunksize=1):
+                record(*result)
+
+    elapsed = time.time() - t0
+    print(f"[DONE] {len(timings)} 个视频（失败 {failed}），共 {frames} 帧，{elapsed:.1f}s，"
+          f"总吞吐 {frames / elapsed:.1f} 帧/秒")
+    for name, sec, fps in sorted(timings, key=lambda x: -x[1]):
+        print(f"    {sec:8.1f}s  {fps:8.1f} 帧/秒  {name}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,554 @@
+"""
+流水线基准测试：合成教室视频 + 确定性桩检测器，驱动 serverapp_v3.py 的真实流水线
+（采集 → 调度/门控 → 跟踪/外推 → 绘制/JPEG 编码 → 序列化 → WS/MJPEG 扇出），不需要摄像头和私有权重，
+只有 CPU 的普通 Linux 机器即可运行，用来判断流水线改动的收益或退化。
+
+  python bench.py run                                         # 默认 1280x720、40 人、2 路、20 秒，重复 3 次取中位数
+  python bench.py run --students 60 --streams 4 --out output/bench/result.json
+  python bench.py run --baseline bench_baseline.json          # 与基线比较，有指标退化超过 --tolerance 时退出码为 1
+  python bench.py run --save-baseline bench_baseline.json     # 把本次结果保存为基线
+  python bench.py video --width 1920 --height 1080 --students 60   # 只生成合成视频
+  python bench.py serve --port 8000                           # 合成视频循环播放 + 桩检测器，启动完整 Web 服务（loadtest.py 用）
+
+检测框由桩检测器给出（读取画面左上角条码得到帧号，返回合成场景该帧的真值框，含少量漏检与抖动），
+跟踪器、行为映射、序列化等仍是线上代码；推理耗时用 --infer-ms 模拟。
+"""
+import os
+import sys
+import re
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+import cv2
+import numpy as np
+
+# 与模型类名一致，行为映射走 serverapp_v3 的 BehaviorTable
+CLASS_NAMES = {0: "LookingUp", 1: "LookingDown", 2: "LyingOnDesk", 3: "LookingBack", 4: "UsingPhone", 5: "Standing"}
+CLASS_WEIGHTS = (0.45, 0.28, 0.05, 0.10, 0.07, 0.05)
+STANDING = 5
+
+BENCH_DIR = os.path.join("output", "bench")
+BARCODE_BITS = 20
+BARCODE_BLOCK = 12      # 每位一个 12x12 的黑/白方块，mp4v 压缩后仍能可靠读出
+BEHAVIOR_SEGMENT_SEC = 4.0
+_CAPTURE_MS = re.compile(r'"capture_ms": (\d+)')
+
+
+class SyntheticClassroom:
+    """确定性的合成教室：按排摆放的课桌与学生（后排透视缩小），学生缓慢晃动，行为每隔几秒切换一次。
+
+    同样的参数与 seed 生成完全相同的画面和真值框；帧号以条码写在左上角，桩检测器据此还原真值。
+    """
+
+    def __init__(self, width=1280, height=720, students=40, fps=25.0, seed=0):
+        self.width, self.height, self.students, self.fps, self.seed = width, height, students, fps, seed
+        rng = np.random.default_rng(seed)
+        rows = max(1, int(round(np.sqrt(students * height / width * 1.2))))
+        cols = -(-students // rows)
+        cx, cy, bw, bh = [], [], [], []
+        for k in range(students):
+            r, c = divmod(k, cols)
+            t = r / max(1, rows - 1)                      # 0 为最后一排，1 为第一排
+            scale = 0.55 + 0.45 * t
+            row_w = width * (0.70 + 0.28 * t)
+            x0 = (width - row_w) / 2
+            w = row_w / cols * 0.55
+            cx.append(x0 + row_w * (c + 0.5) / cols)
+            cy.append(height * (0.36 + 0.52 * t))
+            bw.append(w)
+            bh.append(min(w * 1.5, height * 0.3 * scale))
+        self.cx, self.cy = np.array(cx), np.array(cy)
+        self.bw, self.bh = np.array(bw), np.array(bh)
+        self.phase = rng.uniform(0, 2 * np.pi, students)
+        self.sway_hz = rng.uniform(0.1, 0.4, students)
+        self.offset = rng.integers(0, int(fps * BEHAVIOR_SEGMENT_SEC), students)
+        self.behaviors = rng.choice(len(CLASS_WEIGHTS), size=(students, 64), p=CLASS_WEIGHTS)
+        self.colors = rng.integers(40, 220, (students, 3))
+        self._background = self._draw_background()
+
+    def _draw_background(self):
+        w, h = self.width, self.height
+        img = np.empty((h, w, 3), np.uint8)
+        img[:] = (200, 215, 225)                                      # 墙
+        img[int(h * 0.3):] = (120, 140, 160)                          # 地面
+        cv2.rectangle(img, (int(w * 0.2), int(h * 0.04)), (int(w * 0.8), int(h * 0.22)), (60, 80, 50), -1)  # 黑板
+        for x, y, bw, bh in zip(self.cx, self.cy, self.bw, self.bh):  # 课桌
+            cv2.rectangle(img, (int(x - bw * 0.8), int(y + bh * 0.25)), (int(x + bw * 0.8), int(y + bh * 0.55)),
+                          (70, 110, 150), -1)
+        return img
+
+    def boxes(self, index):
+        """第 index 帧所有学生的真值框 (N, 5)：x1, y1, x2, y2, cls。"""
+        t = index / self.fps
+        seg = (index + self.offset) // int(self.fps * BEHAVIOR_SEGMENT_SEC)
+        cls = self.behaviors[np.arange(self.students), seg % self.behaviors.shape[1]]
+        dx = self.bw * 0.12 * np.sin(2 * np.pi * self.sway_hz * t + self.phase)
+        top = self.cy - self.bh / 2 - np.where(cls == STANDING, self.bh * 0.5, 0)
+        x1, x2 = self.cx + dx - self.bw / 2, self.cx + dx + self.bw / 2
+        y2 = self.cy + self.bh / 2
+        out = np.stack([x1, top, x2, y2, cls], axis=1)
+        out[:, [0, 2]] = out[:, [0, 2]].clip(0, self.width - 1)
+        out[:, [1, 3]] = out[:, [1, 3]].clip(0, self.height - 1)
+        return out
+
+    def render(self, index):
+        img = self._background.copy()
+        for (x1, y1, x2, y2, cls), color in zip(self.boxes(index), self.colors.tolist()):
+            w = x2 - x1
+            head_r = int(w * 0.28)
+            head_y = int(y1 + head_r + (w * 0.25 if cls in (1, 2) else 0))   # 低头/趴桌时头部下沉
+            cv2.rectangle(img, (int(x1 + w * 0.1), head_y + head_r), (int(x2 - w * 0.1), int(y2)), color, -1)
+            cv2.circle(img, (int((x1 + x2) / 2), head_y), head_r, (150, 180, 210), -1)
+        _write_barcode(img, index)
+        return img
+
+
+def _write_barcode(img, index):
+    b = BARCODE_BLOCK
+    for bit in range(BARCODE_BITS):
+        img[0:b, bit * b:(bit + 1) * b] = 255 if (index >> bit) & 1 else 0
+
+
+def read_barcode(img):
+    """返回画面左上角条码中的帧号；画面太小（如分块推理的裁剪区域）读不出时返回 None。"""
+    b = BARCODE_BLOCK
+    if img.shape[0] < b or img.shape[1] < BARCODE_BITS * b:
+        return None
+    centers = img[b // 2, b // 2:BARCODE_BITS * b:b]
+    bits = centers.mean(axis=-1) > 127 if centers.ndim == 2 else centers > 127
+    return int(np.dot(bits.astype(np.int64), 1 << np.arange(BARCODE_BITS)))
+
+
+def _hash01(index, ids, salt):
+    """按 (帧号, 学生, 用途) 确定性地给出 [0, 1) 的伪随机数。"""
+    v = (np.uint64(index) * np.uint64(2654435761) + ids.astype(np.uint64) * np.uint64(40503)
+         + np.uint64(salt) * np.uint64(97)) % np.uint64(1000003)
+    return v.astype(np.float64) / 1000003
+
+
+class StubDetector:
+    """桩检测器，接口与 ultralytics YOLO 的 predict 一致：每张图返回一个 Results。
+
+    约 3% 的漏检与 ±2 像素的抖动让跟踪器的工作量接近真实场景；infer_ms 为每张图的模拟推理耗时，
+    默认 sleep（类似 GPU/加速卡，不占 CPU），spin=True 时忙等，模拟纯 CPU 推理对其他阶段的挤占。
+    """
+
+    names = CLASS_NAMES
+
+    def __init__(self, scene, infer_ms=30.0, spin=False):
+        self.scene = scene
+        self.infer_ms = infer_ms
+        self.spin = spin
+        self.calls = 0
+        self.images = 0
+        self.boxes = 0
+        self._last_index = 0
+        self._ids = np.arange(scene.students)
+
+    def to(self, device):
+        return self
+
+    def detections(self, index):
+        gt = self.scene.boxes(index)
+        keep = _hash01(index, self._ids, 1) >= 0.03
+        jitter = (np.stack([_hash01(index, self._ids, 2 + k) for k in range(4)], axis=1) - 0.5) * 4
+        conf = 0.72 + 0.27 * _hash01(index, self._ids, 7)
+        rows = np.column_stack([gt[:, :4] + jitter, conf, gt[:, 4]])[keep]
+        return rows.astype(np.float32)
+
+    def predict(self, source=None, **kwargs):
+        import torch
+        from ultralytics.engine.results import Results
+
+        frames = source if isinstance(source, list) else [source]
+        t_end = time.perf_counter() + self.infer_ms / 1000 * len(frames)
+        out = []
+        for frame in frames:
+            index = read_barcode(frame)
+            if index is None:
+                index = self._last_index
+            self._last_index = index
+            rows = self.detections(index)
+            self.boxes += len(rows)
+            out.append(Results(orig_img=frame, path="", names=self.names, boxes=torch.from_numpy(rows)))
+        self.calls += 1
+        self.images += len(frames)
+        if self.spin:
+            while time.perf_counter() < t_end:
+                pass
+        else:
+            delay = t_end - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return out
+
+
+def ensure_video(width, height, students, fps, seconds, seed=0, out_dir=BENCH_DIR):
+    """生成（或复用已生成的）合成视频，返回 (路径, 场景)。"""
+    scene = SyntheticClassroom(width, height, students, fps, seed)
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"synthetic_{width}x{height}_{students}p_{fps:g}fps_{seconds:g}s_seed{seed}.mp4")
+    if os.path.exists(path):
+        return path, scene
+    tmp = path + ".tmp.mp4"
+    writer = cv2.VideoWriter(tmp, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"无法写入视频: {tmp}")
+    try:
+        for index in range(int(round(fps * seconds))):
+            writer.write(scene.render(index))
+    finally:
+        writer.release()
+    os.replace(tmp, path)
+    return path, scene
+
+
+# ---------------- 运行 ----------------
+class _Samples:
+    """替换 serverapp_v3._latency 中的直方图：记录每个样本，给出精确分位数（直方图分桶约 20% 宽，不适合比较基线）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = []
+
+    def observe(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            ms = np.array(self._values) * 1000
+        if not len(ms):
+            return {"count": 0, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        return {"count": len(ms), "p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2)}
+
+
+class _WSConsumer(threading.Thread):
+    """进程内的 WS 客户端：直接挂在 WSHub 上消费消息（不走网络），统计条数、字节数与端到端延迟。"""
+
+    def __init__(self, srv, st, kind, e2e):
+        super().__init__(name=f"bench-ws-{kind}", daemon=True)
+        self.kind = kind
+        self.client = srv.ThreadWSClient(fields="counts" if kind == "counts" else "full", binary=kind == "bin")
+        self.client.streams = {st.sid}
+        self.messages = 0
+        self.bytes = 0
+        self.e2e = e2e
+        self._stopping = False
+        self._hub = st.ws_hub
+        self._hub.add(self.client)
+
+    def run(self):
+        while True:
+            msg = self.client.next()
+            if self._stopping:
+                return
+            self.messages += 1
+            self.bytes += len(msg.encode("utf-8")) if isinstance(msg, str) else len(msg)
+            if self.kind == "full":
+                capture_ms = int(_CAPTURE_MS.search(msg).group(1))
+                self.e2e.observe(max(0, time.time() * 1000 - capture_ms) / 1000)
+
+    def stop(self):
+        self._hub.remove(self.client)
+        self._stopping = True
+        self.client.reply({"type": "bye"})
+
+
+class _MjpegViewer(threading.Thread):
+    """进程内的 MJPEG 观看者：按 fps 取共享的最新 JPEG，行为与 /video.mjpg 的生成器一致。"""
+
+    def __init__(self, srv, st, fps):
+        super().__init__(name="bench-mjpeg", daemon=True)
+        self.st = st
+        self.fps = fps
+        self.frames = 0
+        self.bytes = 0
+        self._halt = threading.Event()
+        self._token, self._key = st.mjpeg.subscribe(srv._snap_variant(0, srv.JPEG_QUALITY), fps)
+
+    def run(self):
+        seq, next_due = 0, 0.0
+        while not self._halt.is_set():
+            delay = next_due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            seq, data = self.st.mjpeg.wait_next(self._key, seq)
+            if data is None:
+                continue
+            next_due = time.time() + 1.0 / self.fps
+            self.frames += 1
+            self.bytes += len(data)
+        self.st.mjpeg.unsubscribe(self._token, self._key)
+
+    def stop(self):
+        self._halt.set()
+
+
+def _mean(total, n):
+    return round(total / n, 1) if n else None
+
+
+def run(args):
+    os.environ["CLASSVISION_NO_AUTOSTART"] = "1"
+    import serverapp_v3 as srv
+
+    video, scene = ensure_video(args.width, args.height, args.students, args.fps, args.seconds, args.seed)
+    srv.FILE_REALTIME = not args.unpaced
+    srv.MOTION_GATE = not args.no_gate
+    model = StubDetector(scene, args.infer_ms, args.spin)
+
+    for stage in srv._latency:
+        srv._latency[stage] = _Samples()
+    cpu0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.time()
+    worker = srv.start_processing(model, {f"s{i}": video for i in range(args.streams)})
+    consumers, viewers = [], []
+    e2e = _Samples()  # 采集 → 完整帧客户端收到
+    for st in srv._streams.values():
+        for kind, n in (("full", args.ws_full), ("counts", args.ws_counts), ("bin", args.ws_bin)):
+            consumers.extend(_WSConsumer(srv, st, kind, e2e) for _ in range(n))
+        viewers.extend(_MjpegViewer(srv, st, args.mjpeg_fps) for _ in range(args.mjpeg))
+    for t in consumers + viewers:
+        t.start()
+    worker.join()
+    elapsed = time.time() - t0
+    time.sleep(0.5)  # 等流水线队列里剩下的帧处理完
+    for t in consumers + viewers:
+        t.stop()
+    for t in viewers:
+        t.join(2.0)  # 等观看者注销，统计不再变化
+    cpu1 = resource.getrusage(resource.RUSAGE_SELF)
+
+    streams = list(srv._streams.values())
+    frames = sum(st.frame_index for st in streams)
+    inferences = sum(st.infer_count for st in streams)
+    dropped = sum(st.slot.dropped for st in streams)
+    by_kind = {}
+    for c in consumers:
+        k = by_kind.setdefault(c.kind, [0, 0, 0])
+        k[0] += c.messages
+        k[1] += c.bytes
+        k[2] += c.client.dropped
+    mjpeg_frames = sum(v.frames for v in viewers)
+    cpu = (cpu1.ru_utime + cpu1.ru_stime) - (cpu0.ru_utime + cpu0.ru_stime)
+    return {
+        "config": {
+            "width": args.width, "height": args.height, "students": args.students, "fps": args.fps,
+            "seconds": args.seconds, "seed": args.seed, "streams": args.streams, "infer_ms": args.infer_ms,
+            "spin": args.spin, "unpaced": args.unpaced, "motion_gate": not args.no_gate,
+            "ws_full": args.ws_full, "ws_counts": args.ws_counts, "ws_bin": args.ws_bin,
+            "mjpeg": args.mjpeg, "mjpeg_fps": args.mjpeg_fps, "repeat": 1,
+        },
+        "env": {
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "numpy": np.__version__, "opencv": cv2.__version__,
+        },
+        "metrics": {
+            "fps": round(frames / elapsed, 2),
+            "infer_per_sec": round(inferences / elapsed, 2),
+            "dropped_ratio": round(dropped / (frames + dropped), 4) if frames + dropped else 0.0,
+            "boxes_per_inference": round(model.boxes / model.images, 1) if model.images else 0.0,
+            "stage_ms": {stage: h.summary() for stage, h in srv._latency.items()},
+            "e2e_ms": e2e.summary(),
+            "bytes_per_msg": {kind: _mean(v[1], v[0]) for kind, v in sorted(by_kind.items())},
+            "ws_messages": {kind: v[0] for kind, v in sorted(by_kind.items())},
+            "ws_dropped": {kind: v[2] for kind, v in sorted(by_kind.items())},
+            "mjpeg_bytes_per_frame": _mean(sum(v.bytes for v in viewers), mjpeg_frames),
+            "mjpeg_fps": round(mjpeg_frames / elapsed / len(viewers), 2) if viewers else None,
+            "slow_frames": srv._slow_frames.stats()["slow_frames"],
+            "cpu_percent": round(cpu / elapsed * 100, 1),
+            "peak_rss_mb": round(cpu1.ru_maxrss / 1024, 1),   # Linux 上 ru_maxrss 单位为 KB
+            "elapsed_sec": round(elapsed, 2),
+        },
+    }
+
+
+def serve(args):
+    """用合成视频（循环播放）和桩检测器启动完整的 Web 服务，供 loadtest.py 压测。"""
+    os.environ["CLASSVISION_NO_AUTOSTART"] = "1"
+    import serverapp_v3 as srv
+
+    video, scene = ensure_video(args.width, args.height, args.students, args.fps, args.seconds, args.seed)
+    srv.FILE_LOOP = True
+    srv.start_processing(StubDetector(scene, args.infer_ms, args.spin), {f"s{i}": video for i in range(args.streams)})
+    if args.server == "flask":
+        srv.app.run(host=args.host, port=args.port, threaded=True)
+        return
+    import asyncio
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"{args.host}:{args.port}"]
+    asyncio.run(hypercorn_serve(srv.asgi_app, config))
+
+
+# 子进程重复运行时原样传递的选项（流水线状态是模块级的，每次运行都要一个新进程）
+_RUN_OPTIONS = ("width", "height", "students", "fps", "seconds", "seed", "streams", "infer_ms", "spin", "unpaced",
+                "no_gate", "ws_full", "ws_counts", "ws_bin", "mjpeg", "mjpeg_fps")
+
+
+def run_repeated(args):
+    """重复运行 args.repeat 次（各自一个子进程），每项指标取中位数；单次结果保留在 runs 里，便于判断波动。"""
+    ensure_video(args.width, args.height, args.students, args.fps, args.seconds, args.seed)  # 先生成，子进程直接复用
+    cmd = [sys.executable, os.path.abspath(__file__), "run", "--repeat", "1"]
+    for name in _RUN_OPTIONS:
+        value = getattr(args, name)
+        flag = "--" + name.replace("_", "-")
+        if isinstance(value, bool):
+            cmd += [flag] if value else []
+        else:
+            cmd += [flag, str(value)]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(args.repeat):
+            out = os.path.join(tmp, f"run{i}.json")
+            subprocess.run(cmd + ["--out", out], check=True, stdout=subprocess.DEVNULL)
+            with open(out, "r", encoding="utf-8") as f:
+                results.append(json.load(f))
+            print(f"[INFO] 第 {i + 1}/{args.repeat} 次完成: fps={results[-1]['metrics']['fps']}", file=sys.stderr)
+    return {
+        "config": {**results[0]["config"], "repeat": args.repeat},
+        "env": results[0]["env"],
+        "metrics": _median([r["metrics"] for r in results]),
+        "runs": [r["metrics"] for r in results],
+    }
+
+
+def _median(values):
+    first = values[0]
+    if isinstance(first, dict):
+        return {k: _median([v.get(k) for v in values]) for k in first}
+    if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return first
+    m = float(np.median(values))
+    return int(m) if all(isinstance(v, int) for v in values) and m.is_integer() else round(m, 4)
+
+
+# ---------------- 与基线比较 ----------------
+# 越大越好的指标；其余数值指标越小越好。条数/计数类只展示不比较
+_HIGHER_IS_BETTER = ("fps", "infer_per_sec", "mjpeg_fps")
+# p99 在几十秒的测试里只有几个样本，波动太大，只展示不比较
+_NOT_COMPARED = ("ws_messages", "ws_dropped", "slow_frames", "elapsed_sec", "count", "boxes_per_inference", "p99_ms")
+# 小于该绝对差异视为噪声（1 毫秒以内的耗时、五个百分点以内的丢帧率）
+_MIN_DELTA = {"_ms": 1.0, "dropped_ratio": 0.05}
+
+
+def _flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(_flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+
+def compare(result, baseline, tolerance):
+    """逐项比较 metrics，返回 (表格行, 退化项)。
+
+    退化：往坏的方向变化超过 tolerance（相对值），且绝对差异既超过 _MIN_DELTA，也超过基线自身各次运行之间的极差。
+    """
+    cur, base = _flatten(result["metrics"]), _flatten(baseline["metrics"])
+    runs = [_flatten(r) for r in baseline.get("runs", [])]
+    rows, regressions = [], []
+    for key, b in base.items():
+        if key not in cur or any(part in _NOT_COMPARED for part in key.split(".")):
+            continue
+        c = cur[key]
+        change = (c - b) / b if b else 0.0
+        worse = -change if key.split(".")[0] in _HIGHER_IS_BETTER else change
+        spread = [r[key] for r in runs if key in r]
+        noise = max([0.0, max(spread) - min(spread) if spread else 0.0]
+                    + [delta for suffix, delta in _MIN_DELTA.items() if key.endswith(suffix)])
+        if abs(c - b) <= noise:
+            worse = min(worse, 0.0)
+        bad = worse > tolerance
+        rows.append((key, b, c, change, bad))
+        if bad:
+            regressions.append(key)
+    return rows, regressions
+
+
+def _print_comparison(rows, result, baseline):
+    if result["config"] != baseline.get("config"):
+        print("[WARN] 基线的测试配置与本次不同，比较结果仅供参考", file=sys.stderr)
+    if result["env"].get("cpus") != baseline.get("env", {}).get("cpus"):
+        print("[WARN] 基线在不同 CPU 数的机器上生成", file=sys.stderr)
+    width = max((len(r[0]) for r in rows), default=10)
+    for key, b, c, change, bad in rows:
+        print(f"{key:<{width}}  {b:>10g} -> {c:>10g}  {change:+7.1%}{'  <-- 退化' if bad else ''}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合成视频 + 桩检测器的流水线基准测试")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name in ("run", "serve", "video"):
+        p = sub.add_parser(name)
+        p.add_argument("--width", type=int, default=1280)
+        p.add_argument("--height", type=int, default=720)
+        p.add_argument("--students", type=int, default=40, help="每路画面中的学生数")
+        p.add_argument("--fps", type=float, default=25.0)
+        p.add_argument("--seconds", type=float, default=20.0, help="合成视频时长，即每次测试的时长")
+        p.add_argument("--seed", type=int, default=0)
+        if name in ("run", "serve"):
+            p.add_argument("--streams", type=int, default=2)
+            p.add_argument("--infer-ms", type=float, default=30.0, help="每张图的模拟推理耗时")
+            p.add_argument("--spin", action="store_true", help="推理耗时用忙等模拟（占 CPU），默认 sleep")
+        if name == "serve":
+            p.add_argument("--host", default="127.0.0.1")
+            p.add_argument("--port", type=int, default=8000)
+            p.add_argument("--server", choices=("hypercorn", "flask"), default="hypercorn",
+                           help="hypercorn（ASGI，默认）或 Flask 内置服务器（每个 WS 客户端一个线程）")
+        if name == "run":
+            p.add_argument("--unpaced", action="store_true", help="不按帧率读文件，测吞吐上限")
+            p.add_argument("--no-gate", action="store_true", help="关闭运动门控")
+            p.add_argument("--ws-full", type=int, default=1, help="每路完整帧 JSON 客户端数")
+            p.add_argument("--ws-counts", type=int, default=1, help="每路只要计数的客户端数")
+            p.add_argument("--ws-bin", type=int, default=1, help="每路二进制协议客户端数")
+            p.add_argument("--mjpeg", type=int, default=1, help="每路 MJPEG 观看者数")
+            p.add_argument("--mjpeg-fps", type=float, default=15.0)
+            p.add_argument("--repeat", type=int, default=3, help="重复次数，各项指标取中位数")
+            p.add_argument("--out", default=os.path.join(BENCH_DIR, "result.json"))
+            p.add_argument("--baseline", default=None, help="与该基线文件比较")
+            p.add_argument("--tolerance", type=float, default=0.25, help="允许的相对退化幅度")
+            p.add_argument("--save-baseline", default=None, help="把本次结果另存为基线")
+    args = parser.parse_args()
+
+    if args.cmd == "video":
+        print(ensure_video(args.width, args.height, args.students, args.fps, args.seconds, args.seed)[0])
+        return 0
+    if args.cmd == "serve":
+        serve(args)
+        return 0
+
+    result = run(args) if args.repeat <= 1 else run_repeated(args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    for path in filter(None, (args.out, args.save_baseline)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    json.dump(result["metrics"], sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows, regressions = compare(result, baseline, args.tolerance)
+        _print_comparison(rows, result, baseline)
+        if regressions:
+            print(f"[FAIL] {len(regressions)} 项指标退化超过 {args.tolerance:.0%}: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+        print("[OK] 未发现超过容忍度的退化", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
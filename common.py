@@ -0,0 +1,89 @@
+"""
+serverapp_v3.py（实时）与 analyze_video.py（离线批量）共用的部分：行为类别映射与跟踪器工厂。
+
+两边只从这里导入，保证实时看板与批量分析对同一个模型给出相同的行为归类与跟踪行为。
+"""
+import numpy as np
+import yaml
+from ultralytics.trackers.track import TRACKER_MAP
+from ultralytics.utils import IterableSimpleNamespace
+from ultralytics.utils.checks import check_yaml
+
+# ---------------- 行为类别映射（重要） ----------------
+# 需求映射：抬头:u  低头:d  趴桌:c  回头:b  使用手机:p  站立:s
+# 训练集类名（英文）与中文描述都做了兼容
+BEHAVIOR_ENG_KEYS = {
+    "lookingup":   ("u", "抬头",   "LookingUp"),
+    "lookingdown": ("d", "低头",   "LookingDown"),
+    "lyingondesk": ("c", "趴桌",   "LyingOnDesk"),
+    "lookingback": ("b", "回头",   "LookingBack"),
+    "usingphone":  ("p", "使用手机", "UsingPhone"),
+    "standing":    ("s", "站立",   "Standing"),
+}
+BEHAVIOR_ORDER = ["u", "d", "c", "b", "p", "s"]  # 固定顺序，便于前端绘图
+BEHAVIOR_BY_CODE = {v[0]: v for v in BEHAVIOR_ENG_KEYS.values()}
+BEHAVIOR_LEGEND = {code: BEHAVIOR_BY_CODE[code][1] for code in BEHAVIOR_ORDER}  # code -> 中文
+
+# 常见别名
+_BEHAVIOR_ALIAS = {
+    "lookinguplook": "lookingup",
+    "up": "lookingup",
+    "raisehead": "lookingup",
+    "down": "lookingdown",
+    "desk": "lyingondesk",
+    "back": "lookingback",
+    "phone": "usingphone",
+    "stand": "standing",
+}
+# 中文关键字兜底（按顺序匹配）
+_BEHAVIOR_ZH_KEYS = [("抬头", "lookingup"), ("低头", "lookingdown"), ("趴", "lyingondesk"), ("伏", "lyingondesk"),
+                     ("回头", "lookingback"), ("后", "lookingback"), ("手机", "usingphone"), ("站", "standing")]
+
+
+def map_behavior(name):
+    """将模型类名/中文名映射到 (code, zh, en)。无法识别返回 None。"""
+    if not name:
+        return None
+    raw = str(name).strip()
+    key = raw.lower().replace(" ", "").replace("_", "")
+    # 别名归一后英文优先
+    key = _BEHAVIOR_ALIAS.get(key, key)
+    if key in BEHAVIOR_ENG_KEYS:
+        return BEHAVIOR_ENG_KEYS[key]
+    for word, eng in _BEHAVIOR_ZH_KEYS:
+        if word in raw:
+            return BEHAVIOR_ENG_KEYS[eng]
+    return None
+
+
+def behavior_lut(class_names):
+    """类别 id → BEHAVIOR_ORDER 下标的查找表（np.int16），-1 表示未映射。"""
+    names = {int(k): v for k, v in (class_names or {}).items()}
+    lut = np.full(max(names) + 1 if names else 0, -1, np.int16)
+    for class_id, name in names.items():
+        beh = map_behavior(name)
+        if beh:
+            lut[class_id] = BEHAVIOR_ORDER.index(beh[0])
+    return lut
+
+
+def lookup_behavior(lut, cls):
+    """类别 id 数组 → 行为下标数组（越界/未映射为 -1）。"""
+    if len(lut) == 0:
+        return np.full(len(cls), -1, np.int16)
+    valid = (cls >= 0) & (cls < len(lut))
+    return np.where(valid, lut[np.clip(cls, 0, len(lut) - 1)], -1)
+# -----------------------------------------------------
+
+
+def new_tracker(tracker_cfg, device=None, frame_rate=30):
+    """按跟踪器 YAML 创建一个独立跟踪器（与 model.track 内部使用的是同一实现）。"""
+    with open(check_yaml(tracker_cfg), "r", encoding="utf-8") as f:
+        cfg = IterableSimpleNamespace(**yaml.safe_load(f))
+    cfg.device = device or "cpu"
+    tracker_cls = TRACKER_MAP[cfg.tracker_type]
+    try:
+        return tracker_cls(args=cfg, frame_rate=int(round(frame_rate)))
+    except TypeError:
+        # 新版 ultralytics 的跟踪器不再接收 frame_rate
+        return tracker_cls(args=cfg)
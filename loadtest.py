@@ -0,0 +1,448 @@
+"""
+WS / MJPEG 扇出压测：对本机服务同时打开 N 个 /ws 与 /video.mjpg 客户端，逐级加大 N，找出饱和点。
+
+默认自动启动 bench.py serve（合成视频循环播放 + 桩检测器），不需要摄像头和模型权重：
+  python loadtest.py                                           # 按 1,2,5,10,20,50,100,200 个客户端扫描
+  python loadtest.py --steps 10,50,100,300 --kind bin --mjpeg-share 0
+  python loadtest.py --server flask                            # 压 Flask 内置服务器（每个 WS 客户端一个线程）
+  python loadtest.py --url http://127.0.0.1:8000 --server-pid 1234   # 压已经在跑的服务
+
+每一级先预热，再在测量窗口内统计：每客户端消息速率、到达间隔抖动、端到端陈旧度（收到时刻 − 帧采集时刻，
+同一台机器时钟一致）、客户端侧漏收的帧、服务端丢弃/断开的消息与客户端、服务端处理帧率与 CPU。
+某一级出现送达率不足、漏帧过多、陈旧度明显上升、处理帧率下降或连接失败，即视为饱和，停止扫描；
+每级结束后服务端必须注销全部断开的客户端（/health 的 ws_clients、mjpeg_viewers 回到 0），否则压测失败。
+压测程序与服务在同一台机器上抢 CPU，结果里同时给出压测程序自身的 CPU 占用，供判断瓶颈在哪一边。
+"""
+import os
+import re
+import sys
+import json
+import time
+import struct
+import asyncio
+import argparse
+import resource
+import subprocess
+import urllib.request
+from urllib.parse import urlsplit
+
+import numpy as np
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (AcceptConnection, BytesMessage, CloseConnection, Ping, RejectConnection, Request,
+                            TextMessage)
+
+OUTPUT_DIR = os.path.join("output", "loadtest")
+DEFAULT_STEPS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_FRAME_INDEX = re.compile(r'"frame_index": (\d+)')
+_CAPTURE_MS = re.compile(r'"capture_ms": (\d+)')
+
+
+class _LoadClient:
+    """一个压测客户端的计数；reset() 开始一个新的测量窗口。"""
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.connected = False
+        self.errors = 0
+        self._last_t = None
+        self._last_index = None
+        self.reset()
+
+    def reset(self):
+        self.messages = 0
+        self.bytes = 0
+        self.gaps = 0
+        self.intervals = []
+        self.staleness = []
+
+    def _arrive(self, nbytes, frame_index=None, capture_ms=None):
+        now = time.time()
+        self.messages += 1
+        self.bytes += nbytes
+        if self._last_t is not None:
+            self.intervals.append(now - self._last_t)
+        self._last_t = now
+        if capture_ms is not None:
+            self.staleness.append(now * 1000 - capture_ms)
+        if frame_index is not None:
+            if self._last_index is not None and frame_index > self._last_index + 1:
+                self.gaps += frame_index - self._last_index - 1
+            self._last_index = frame_index
+
+
+class WSLoadClient(_LoadClient):
+    """asyncio + wsproto 的 WS 客户端：只解析帧头里的 frame_index / capture_ms，不解析整条 JSON。"""
+
+    def __init__(self, host, port, sid, kind):
+        super().__init__(sid)
+        self.host, self.port, self.kind = host, port, kind
+        query = {"full": "", "counts": "?fields=counts", "bin": "?format=bin"}[kind]
+        self.path = f"/streams/{sid}/ws{query}"
+
+    async def run(self):
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            conn = WSConnection(ConnectionType.CLIENT)
+            writer.write(conn.send(Request(host=f"{self.host}:{self.port}", target=self.path)))
+            parts = []
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                conn.receive_data(data)
+                for event in conn.events():
+                    if isinstance(event, AcceptConnection):
+                        self.connected = True
+                    elif isinstance(event, RejectConnection):
+                        raise ConnectionError("handshake rejected")
+                    elif isinstance(event, (TextMessage, BytesMessage)):
+                        parts.append(event.data)
+                        if event.message_finished:
+                            self._handle("".join(parts) if isinstance(event, TextMessage) else b"".join(parts))
+                            parts = []
+                    elif isinstance(event, Ping):
+                        writer.write(conn.send(event.response()))
+                    elif isinstance(event, CloseConnection):
+                        writer.write(conn.send(event.response()))
+                        return
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            self.errors += 1
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _handle(self, msg):
+        if isinstance(msg, bytes):
+            # 二进制帧头：frame_index @6，latency_ms @26，time_ms @34（见 serverapp_v3 的 _BIN_HEADER）
+            frame_index, = struct.unpack_from("<I", msg, 6)
+            latency_ms, = struct.unpack_from("<I", msg, 26)
+            time_ms, = struct.unpack_from("<d", msg, 34)
+            self._arrive(len(msg), frame_index, time_ms - latency_ms)
+            return
+        m = _FRAME_INDEX.search(msg, 0, 400)
+        if m is None:
+            return  # hello / ack 等控制消息
+        c = _CAPTURE_MS.search(msg)
+        self._arrive(len(msg.encode("utf-8")), int(m.group(1)), int(c.group(1)) if c else None)
+
+
+class MjpegLoadClient(_LoadClient):
+    """MJPEG 观看者：HTTP/1.0 请求，按每部分的 Content-Length 切出 JPEG；服务端仍用分块传输时（werkzeug）先解块。"""
+
+    def __init__(self, host, port, sid, fps, width):
+        super().__init__(sid)
+        self.host, self.port = host, port
+        self.path = f"/streams/{sid}/video.mjpg?fps={fps:g}" + (f"&w={width}" if width else "")
+
+    async def run(self):
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            writer.write(f"GET {self.path} HTTP/1.0\r\nHost: {self.host}:{self.port}\r\n\r\n".encode("ascii"))
+            head = await reader.readuntil(b"\r\n\r\n")
+            if b" 200 " not in head.split(b"\r\n", 1)[0]:
+                raise ConnectionError(head.split(b"\r\n", 1)[0].decode("latin-1"))
+            self.connected = True
+            chunked = b"transfer-encoding: chunked" in head.lower()
+            buf = b""
+            async for data in _http_body(reader, chunked):
+                buf += data
+                while True:
+                    end = buf.find(b"\r\n\r\n")
+                    if end < 0:
+                        break
+                    length = int(re.search(rb"Content-Length: (\d+)", buf[:end]).group(1))
+                    if len(buf) < end + 4 + length:
+                        break
+                    buf = buf[end + 4 + length:]
+                    self._arrive(length)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, AttributeError,
+                ValueError):
+            self.errors += 1
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+async def _http_body(reader, chunked):
+    """逐块产出响应体：普通连接照原样读，分块传输时去掉块头。"""
+    while True:
+        if not chunked:
+            data = await reader.read(65536)
+            if not data:
+                return
+            yield data
+            continue
+        size = int((await reader.readuntil(b"\r\n")).split(b";", 1)[0], 16)
+        if size == 0:
+            return
+        yield (await reader.readexactly(size + 2))[:-2]
+
+
+# ---------------- 服务端状态 ----------------
+def _get_json(base, path):
+    with urllib.request.urlopen(base + path, timeout=10) as r:
+        return json.load(r)
+
+
+def _proc_cpu_seconds(pid):
+    """/proc/<pid>/stat 中的 utime + stime（秒）；拿不到时返回 None。"""
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _self_cpu_seconds():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+def _server_counters(health):
+    streams = health["streams"]
+    return {
+        "frames": {sid: s["frame_index"] for sid, s in streams.items()},
+        "inferences": sum(s["infer_count"] for s in streams.values()),
+        "capture_dropped": sum(s["dropped_frames"] for s in streams.values()),
+        "ws_dropped": sum(s["ws"]["dropped"] for s in streams.values()),
+        "ws_slow_disconnects": sum(s["ws"]["slow_disconnects"] for s in streams.values()),
+        "pipeline_dropped": sum(p["dropped"] for p in health.get("pipeline", {}).values()),
+    }
+
+
+def _open_clients(health):
+    """服务端仍登记着的客户端数；每级结束、客户端全部断开后应回到 0。"""
+    streams = health["streams"].values()
+    return {"ws_clients": sum(s["ws_clients"] for s in streams), "mjpeg_viewers": sum(s["mjpeg_viewers"] for s in streams)}
+
+
+async def _wait_released(base, timeout):
+    """等服务端注销上一级的客户端，返回超时后仍登记着的客户端数（全为 0 表示已释放）。"""
+    loop = asyncio.get_running_loop()
+    deadline = time.time() + timeout
+    while True:
+        left = _open_clients(await loop.run_in_executor(None, _get_json, base, "/health"))
+        if not any(left.values()) or time.time() >= deadline:
+            return left
+        await asyncio.sleep(0.2)
+
+
+def _start_server(args, port):
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    log = open(os.path.join(OUTPUT_DIR, "server.log"), "w", encoding="utf-8")
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, "bench.py"), "serve", "--port", str(port), "--server", args.server,
+           "--streams", str(args.streams), "--students", str(args.students), "--width", str(args.width),
+           "--height", str(args.height), "--fps", str(args.fps), "--infer-ms", str(args.infer_ms)]
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=here)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"桩服务启动失败，见 {log.name}")
+        try:
+            health = _get_json(base, "/health")
+            if health["streams"] and all(s["frame_index"] > 0 for s in health["streams"].values()):
+                return proc, base
+        except (OSError, ValueError, KeyError):
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError(f"桩服务 {args.startup_timeout:g} 秒内没有开始出帧，见 {log.name}")
+
+
+# ---------------- 一级压测 ----------------
+def _quantiles(values, qs=(50, 95, 99)):
+    if not values:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": round(float(v), 1) for q, v in zip(qs, np.percentile(values, qs))}
+
+
+async def run_step(args, base, server_pid, n, stream_ids):
+    loop = asyncio.get_running_loop()
+    url = urlsplit(base)
+    host, port = url.hostname, url.port or 80
+    n_mjpeg = int(round(n * args.mjpeg_share))
+    clients = []
+    for i in range(n):
+        sid = stream_ids[i % len(stream_ids)]
+        if i < n_mjpeg:
+            clients.append(MjpegLoadClient(host, port, sid, args.mjpeg_fps, args.mjpeg_width))
+        else:
+            clients.append(WSLoadClient(host, port, sid, args.kind))
+    tasks = [asyncio.create_task(c.run()) for c in clients]
+    await asyncio.sleep(args.warmup)
+
+    h0 = _server_counters(await loop.run_in_executor(None, _get_json, base, "/health"))
+    cpu0, self0, t0 = _proc_cpu_seconds(server_pid), _self_cpu_seconds(), time.time()
+    for c in clients:
+        c.reset()
+    await asyncio.sleep(args.duration)
+    window = time.time() - t0
+    h1 = _server_counters(await loop.run_in_executor(None, _get_json, base, "/health"))
+    cpu1, self1 = _proc_cpu_seconds(server_pid), _self_cpu_seconds()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    frames = {sid: h1["frames"][sid] - h0["frames"][sid] for sid in stream_ids}
+    ws = [c for c in clients if isinstance(c, WSLoadClient)]
+    mjpeg = [c for c in clients if isinstance(c, MjpegLoadClient)]
+    stream_fps = {sid: frames[sid] / window for sid in stream_ids}
+    delivered = [c.messages / frames[c.sid] for c in ws if frames[c.sid]]
+    intervals = [x * 1000 for c in ws for x in c.intervals]
+    staleness = [x for c in ws for x in c.staleness]
+    received = sum(c.messages for c in ws)
+    missed = sum(c.gaps for c in ws)
+    # 观看者按自己的间隔取最新帧，能拿到的是源帧率的整数分之一（25 fps 的源按 15 fps 取实际为 12.5 fps）
+    mjpeg_expected = [f / np.ceil(f / args.mjpeg_fps - 1e-6) if f else 0.0 for f in (stream_fps[c.sid] for c in mjpeg)]
+    step = {
+        "clients": n,
+        "ws_clients": len(ws),
+        "mjpeg_clients": len(mjpeg),
+        "connect_errors": sum(1 for c in clients if not c.connected) + sum(c.errors for c in clients if c.connected),
+        "server_fps": round(sum(stream_fps.values()), 2),
+        "server_infer_per_sec": round((h1["inferences"] - h0["inferences"]) / window, 2),
+        "ws_msg_rate": round(received / window / len(ws), 2) if ws else None,
+        "ws_msg_rate_min": round(min(c.messages for c in ws) / window, 2) if ws else None,
+        "ws_delivery_ratio": round(float(np.mean(delivered)), 4) if delivered else None,
+        "ws_interval_ms": {"mean": round(float(np.mean(intervals)), 1) if intervals else None, **_quantiles(intervals)},
+        "ws_jitter_ms": round(float(np.std(intervals)), 1) if intervals else None,
+        "ws_staleness_ms": _quantiles(staleness),
+        "ws_missed_ratio": round(missed / (received + missed), 4) if received + missed else 0.0,
+        "ws_bytes_per_sec": round(sum(c.bytes for c in ws) / window),
+        "server_ws_dropped": h1["ws_dropped"] - h0["ws_dropped"],
+        "server_slow_disconnects": h1["ws_slow_disconnects"] - h0["ws_slow_disconnects"],
+        "server_capture_dropped": h1["capture_dropped"] - h0["capture_dropped"],
+        "server_pipeline_dropped": h1["pipeline_dropped"] - h0["pipeline_dropped"],
+        "mjpeg_fps": round(sum(c.messages for c in mjpeg) / window / len(mjpeg), 2) if mjpeg else None,
+        "mjpeg_delivery_ratio": round(float(np.mean([c.messages / window / e for c, e in zip(mjpeg, mjpeg_expected) if e])), 4)
+                                if mjpeg else None,
+        "mjpeg_jitter_ms": round(float(np.std([x * 1000 for c in mjpeg for x in c.intervals])), 1)
+                           if any(c.intervals for c in mjpeg) else None,
+        "mjpeg_bytes_per_sec": round(sum(c.bytes for c in mjpeg) / window),
+        "server_cpu_percent": round((cpu1 - cpu0) / window * 100, 1) if cpu0 is not None and cpu1 is not None else None,
+        "loadgen_cpu_percent": round((self1 - self0) / window * 100, 1),
+        "window_sec": round(window, 2),
+    }
+    return step
+
+
+def _saturation(step, first, args):
+    """返回该级判定为饱和的原因列表（空列表表示尚未饱和）。"""
+    reasons = []
+    if step["connect_errors"]:
+        reasons.append(f"{step['connect_errors']} 个客户端连接失败/中断")
+    if step["ws_delivery_ratio"] is not None and step["ws_delivery_ratio"] < args.min_delivery:
+        reasons.append(f"WS 送达率 {step['ws_delivery_ratio']:.0%}")
+    if step["ws_missed_ratio"] > args.max_missed:
+        reasons.append(f"WS 漏帧 {step['ws_missed_ratio']:.1%}")
+    if step["mjpeg_delivery_ratio"] is not None and step["mjpeg_delivery_ratio"] < args.min_delivery:
+        reasons.append(f"MJPEG 送达率 {step['mjpeg_delivery_ratio']:.0%}")
+    if first is not None and first["server_fps"] and step["server_fps"] < first["server_fps"] * args.min_delivery:
+        reasons.append(f"处理帧率从 {first['server_fps']} 降到 {step['server_fps']}")
+    p95, base = step["ws_staleness_ms"]["p95"], (first or {}).get("ws_staleness_ms", {}).get("p95")
+    if p95 is not None and base is not None and p95 > base + args.max_staleness_rise_ms:
+        reasons.append(f"陈旧度 p95 从 {base} ms 升到 {p95} ms")
+    return reasons
+
+
+def _print_step(step, reasons):
+    stale = step["ws_staleness_ms"]
+    print(f"[{step['clients']:>4} 客户端] 处理 {step['server_fps']:>6} fps | WS {step['ws_msg_rate'] or 0:>6} 条/秒/客户端 "
+          f"送达 {step['ws_delivery_ratio'] or 0:.0%} 抖动 {step['ws_jitter_ms'] or 0} ms 陈旧 p50/p95 {stale['p50']}/{stale['p95']} ms "
+          f"漏 {step['ws_missed_ratio']:.1%} | MJPEG {step['mjpeg_fps'] or '-'} fps | "
+          f"CPU 服务 {step['server_cpu_percent']}% 压测 {step['loadgen_cpu_percent']}%"
+          + (f"  <-- 饱和: {'; '.join(reasons)}" if reasons else ""), file=sys.stderr)
+
+
+async def sweep(args, base, server_pid):
+    stream_ids = [s["id"] for s in await asyncio.get_running_loop().run_in_executor(None, _get_json, base, "/streams")]
+    steps, first, healthy, saturated, leaked = [], None, None, None, None
+    for n in args.steps:
+        step = await run_step(args, base, server_pid, n, stream_ids)
+        reasons = _saturation(step, first, args)
+        step["saturated"] = reasons
+        steps.append(step)
+        _print_step(step, reasons)
+        first = first or step
+        # 客户端断开后服务端必须注销它们，否则残留的连接会计入下一级的负载，结果不可信
+        left = await _wait_released(base, args.release_timeout)
+        if any(left.values()):
+            leaked = {"clients": n, **left}
+            print(f"[FAIL] {n} 个客户端断开 {args.release_timeout:g} 秒后服务端仍登记着 {left}", file=sys.stderr)
+            break
+        if reasons:
+            saturated = n
+            if not args.keep_going:
+                break
+        elif saturated is None:
+            healthy = n
+        await asyncio.sleep(args.settle)
+    return {"saturation": {"max_healthy_clients": healthy, "first_saturated_clients": saturated},
+            "leaked": leaked, "steps": steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WS / MJPEG 扇出压测，逐级加大客户端数找出饱和点")
+    parser.add_argument("--url", default=None, help="压测已经在跑的服务（如 http://127.0.0.1:8000），不启动桩服务")
+    parser.add_argument("--server-pid", type=int, default=None, help="配合 --url：统计该进程的 CPU")
+    parser.add_argument("--port", type=int, default=8790, help="桩服务端口")
+    parser.add_argument("--server", choices=("hypercorn", "flask"), default="hypercorn")
+    parser.add_argument("--streams", type=int, default=1, help="桩服务的路数，客户端轮流分配到各路")
+    parser.add_argument("--students", type=int, default=40)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=25.0)
+    parser.add_argument("--infer-ms", type=float, default=30.0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--steps", default=",".join(map(str, DEFAULT_STEPS)), help="各级客户端总数，逗号分隔")
+    parser.add_argument("--kind", choices=("full", "counts", "bin"), default="full", help="WS 客户端的订阅档位")
+    parser.add_argument("--mjpeg-share", type=float, default=0.2, help="客户端中 MJPEG 观看者的比例")
+    parser.add_argument("--mjpeg-fps", type=float, default=15.0)
+    parser.add_argument("--mjpeg-width", type=int, default=640)
+    parser.add_argument("--warmup", type=float, default=3.0, help="每级连接后预热秒数")
+    parser.add_argument("--duration", type=float, default=10.0, help="每级测量窗口秒数")
+    parser.add_argument("--settle", type=float, default=2.0, help="两级之间的间隔秒数")
+    parser.add_argument("--release-timeout", type=float, default=5.0,
+                        help="每级结束后等服务端注销客户端的秒数，超时仍有残留则整次压测失败")
+    parser.add_argument("--min-delivery", type=float, default=0.9, help="送达率（及处理帧率相对第一级）低于该值视为饱和")
+    parser.add_argument("--max-missed", type=float, default=0.05, help="WS 漏帧比例超过该值视为饱和")
+    parser.add_argument("--max-staleness-rise-ms", type=float, default=250.0, help="陈旧度 p95 比第一级高出该值视为饱和")
+    parser.add_argument("--keep-going", action="store_true", help="饱和后继续跑完所有级别")
+    parser.add_argument("--out", default=os.path.join(OUTPUT_DIR, "result.json"))
+    args = parser.parse_args()
+    args.steps = [int(x) for x in args.steps.split(",") if x.strip()]
+
+    proc = None
+    if args.url:
+        base, server_pid = args.url.rstrip("/"), args.server_pid
+    else:
+        print("[INFO] 启动桩服务（bench.py serve）...", file=sys.stderr)
+        proc, base = _start_server(args, args.port)
+        server_pid = proc.pid
+    try:
+        report = asyncio.run(sweep(args, base, server_pid))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    report["config"] = {k: v for k, v in vars(args).items() if k not in ("out",)}
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    sat = report["saturation"]
+    print(f"[INFO] 未饱和的最大客户端数: {sat['max_healthy_clients']}，首次饱和: {sat['first_saturated_clients']}；"
+          f"结果见 {args.out}", file=sys.stderr)
+    return 1 if report["leaked"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
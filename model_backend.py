@@ -0,0 +1,230 @@
+"""
+CPU 推理后端：把 MODEL_PATH（.pt）导出为 ONNX Runtime / OpenVINO 格式，导出产物缓存在权重文件旁边，之后启动直接加载。
+
+serverapp_v3.py / analyze_video.py 通过 resolve_weights() 拿到实际要加载的权重路径，
+再交给 ultralytics.YOLO —— 推理、跟踪代码不需要任何改动。
+
+  backend   "pt"（PyTorch，默认）/ "onnx"（ONNX Runtime）/ "openvino"
+  int8      onnx：onnxruntime 动态量化（无需校准数据）
+            openvino：ultralytics 导出时用 NNCF 做训练后量化（需要校准数据集 yaml，见 data 参数）
+
+对比命令（在样例视频上比较 .pt 与导出后端的延迟和结果差异）：
+  python model_backend.py compare input/xxx.mp4 --model best.pt --backend onnx --int8 --frames 200
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import cv2
+import numpy as np
+
+BACKENDS = ("pt", "onnx", "openvino")
+EXPORT_IMGSZ = 640
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _artifact_path(model_path, backend, int8):
+    stem = os.path.splitext(model_path)[0]
+    if backend == "onnx":
+        return stem + (".int8.onnx" if int8 else ".onnx")
+    return stem + ("_int8" if int8 else "") + "_openvino_model"
+
+
+def _meta_path(artifact):
+    return artifact.rstrip("/\\") + ".export.json"
+
+
+def resolve_weights(model_path, backend="pt", int8=False, imgsz=EXPORT_IMGSZ, data=None):
+    """返回该后端实际要加载的权重路径；缓存的导出产物缺失或与当前权重/选项不符时重新导出。"""
+    if backend == "pt":
+        return model_path
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    artifact = _artifact_path(model_path, backend, int8)
+    meta = {"weights": _sha256(model_path), "backend": backend, "int8": int8, "imgsz": imgsz}
+    try:
+        with open(_meta_path(artifact), "r", encoding="utf-8") as f:
+            if json.load(f) == meta and os.path.exists(artifact):
+                return artifact
+    except (FileNotFoundError, ValueError):
+        pass
+
+    print(f"[INFO] 导出推理后端: {backend}{' int8' if int8 else ''} -> {artifact}")
+    t0 = time.time()
+    _export(model_path, backend, int8, imgsz, data, artifact)
+    with open(_meta_path(artifact), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    print(f"[INFO] 导出完成，用时 {time.time() - t0:.1f}s")
+    return artifact
+
+
+def _export(model_path, backend, int8, imgsz, data, artifact):
+    from ultralytics import YOLO
+
+    model = YOLO(model_path)
+    # dynamic=True：支持多路拼批（batch 维可变）以及分块推理的不同输入尺寸
+    if backend == "onnx":
+        exported = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+        if int8:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(exported, artifact, weight_type=QuantType.QInt8)
+        elif os.path.abspath(exported) != os.path.abspath(artifact):
+            os.replace(exported, artifact)
+    else:
+        kwargs = {"int8": True, "data": data} if int8 else {}
+        if int8 and not data:
+            raise ValueError("openvino int8 需要校准数据集 yaml（data），例如训练时用的数据集配置")
+        exported = model.export(format="openvino", imgsz=imgsz, dynamic=True, **kwargs)
+        if os.path.abspath(exported.rstrip("/\\")) != os.path.abspath(artifact):
+            os.replace(exported, artifact)
+
+
+# ---------------- 对比：延迟与结果差异 ----------------
+def _sample_frames(video, n, every):
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        raise RuntimeError(f"无法打开视频: {video}")
+    frames, idx = [], 0
+    while len(frames) < n:
+        if idx % every:
+            ok = cap.grab()
+        else:
+            ok, frame = cap.read()
+            if ok:
+                frames.append(frame)
+        if not ok:
+            break
+        idx += 1
+    cap.release()
+    return frames
+
+
+def _run(model, frames, conf, iou, imgsz):
+    """逐帧推理（batch=1，测的是单帧延迟），返回 (每帧耗时秒, 每帧 [x1,y1,x2,y2,conf,cls])。"""
+    model.predict(source=frames[0], conf=conf, iou=iou, imgsz=imgsz, verbose=False)  # 预热
+    times, dets = [], []
+    for frame in frames:
+        t0 = time.perf_counter()
+        result = model.predict(source=frame, conf=conf, iou=iou, imgsz=imgsz, verbose=False)[0]
+        times.append(time.perf_counter() - t0)
+        boxes = result.boxes
+        dets.append(boxes.data.cpu().numpy()[:, [0, 1, 2, 3, -2, -1]] if boxes is not None and len(boxes) else np.zeros((0, 6)))
+    return np.array(times), dets
+
+
+def _iou_matrix(a, b):
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def compare_dets(ref, test, iou_thres=0.5):
+    """以 .pt 结果为参照，统计导出后端的一致程度：同类别 IoU ≥ iou_thres 贪心配对。"""
+    matched = n_ref = n_test = 0
+    ious, conf_diff = [], []
+    for r, t in zip(ref, test):
+        n_ref += len(r)
+        n_test += len(t)
+        if not len(r) or not len(t):
+            continue
+        m = _iou_matrix(r, t)
+        m[r[:, None, 5] != t[None, :, 5]] = 0
+        while True:
+            i, j = np.unravel_index(np.argmax(m), m.shape)
+            if m[i, j] < iou_thres:
+                break
+            matched += 1
+            ious.append(m[i, j])
+            conf_diff.append(abs(r[i, 4] - t[j, 4]))
+            m[i, :] = 0
+            m[:, j] = 0
+    return {
+        "ref_boxes": n_ref,
+        "test_boxes": n_test,
+        "matched": matched,
+        "recall_vs_pt": round(matched / n_ref, 4) if n_ref else None,
+        "precision_vs_pt": round(matched / n_test, 4) if n_test else None,
+        "mean_iou": round(float(np.mean(ious)), 4) if ious else None,
+        "mean_conf_diff": round(float(np.mean(conf_diff)), 4) if conf_diff else None,
+    }
+
+
+def _latency(times):
+    ms = times * 1000
+    return {
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+    }
+
+
+def compare(model_path, video, backend, int8=False, frames=200, every=5, conf=0.25, iou=0.30,
+            imgsz=EXPORT_IMGSZ, data=None, threads=None):
+    from ultralytics import YOLO
+
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    samples = _sample_frames(video, frames, every)
+    if not samples:
+        raise RuntimeError("样例视频没有可用的帧")
+    artifact = resolve_weights(model_path, backend, int8, imgsz, data)
+    ref_times, ref_dets = _run(YOLO(model_path), samples, conf, iou, imgsz)
+    test_times, test_dets = _run(YOLO(artifact), samples, conf, iou, imgsz)
+    ref_lat, test_lat = _latency(ref_times), _latency(test_times)
+    return {
+        "video": video,
+        "frames": len(samples),
+        "backend": backend,
+        "int8": int8,
+        "artifact": artifact,
+        "latency": {"pt": ref_lat, backend: test_lat, "speedup": round(ref_lat["mean_ms"] / test_lat["mean_ms"], 2)},
+        "accuracy_vs_pt": compare_dets(ref_dets, test_dets),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出 CPU 推理后端 / 与 .pt 对比延迟和结果")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name in ("export", "compare"):
+        p = sub.add_parser(name)
+        p.add_argument("--model", required=True, help=".pt 权重路径")
+        p.add_argument("--backend", choices=BACKENDS[1:], default="onnx")
+        p.add_argument("--int8", action="store_true")
+        p.add_argument("--imgsz", type=int, default=EXPORT_IMGSZ)
+        p.add_argument("--data", default=None, help="openvino int8 校准数据集 yaml")
+        if name == "compare":
+            p.add_argument("video", help="样例视频")
+            p.add_argument("--frames", type=int, default=200, help="参与对比的帧数")
+            p.add_argument("--every", type=int, default=5, help="每隔多少帧取一帧")
+            p.add_argument("--conf", type=float, default=0.25)
+            p.add_argument("--iou", type=float, default=0.30)
+            p.add_argument("--threads", type=int, default=None, help="torch 线程数（与线上部署保持一致）")
+    args = parser.parse_args()
+
+    if args.cmd == "export":
+        print(resolve_weights(args.model, args.backend, args.int8, args.imgsz, args.data))
+        return
+    report = compare(args.model, args.video, args.backend, args.int8, args.frames, max(1, args.every),
+                     args.conf, args.iou, args.imgsz, args.data, args.threads)
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
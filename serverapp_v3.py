@@ -1,15 +1,34 @@
 import os
 import time
 import json
+import asyncio
 import base64
+import struct
 import threading
-from queue import Queue
+import traceback
+import bisect
+import hmac
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
 import sys
 
 import cv2
-from flask import Flask, Response, jsonify
+import numpy as np
+import torch
+import torchvision
+from flask import Flask, Response, abort, jsonify, request
 from flask_sock import Sock
+from hypercorn.middleware import AsyncioWSGIMiddleware
 from ultralytics import YOLO
+from ultralytics.engine.results import Boxes
+
+from common import BEHAVIOR_BY_CODE as _BEHAVIOR_BY_CODE
+from common import BEHAVIOR_LEGEND as _BEHAVIOR_LEGEND
+from common import BEHAVIOR_ORDER as _BEHAVIOR_ORDER
+from common import behavior_lut, lookup_behavior, new_tracker
+from model_backend import resolve_weights
 
 # =========================
 # 用户配置
@@ -21,106 +40,1162 @@ MODEL_PATH = r"xanylabeling_models\best_1200_pre.pt"
 SOURCE = 1
 TRACKER_CFG = "botsort.yaml"
 
-# 推理节流：每隔多少秒推理一帧（抽帧）
+# 多路视频源：stream_id -> SOURCE（同一个模型批量推理所有路）
+# 单路部署保持默认即可；整层教室可写成 {"301": 0, "302": "rtsp://...", ...}
+STREAMS = {
+    "main": SOURCE,
+}
+FILE_REALTIME = True    # 文件源按原始帧率读取（模拟实时流）；False 则尽快读，用于测吞吐上限
+FILE_LOOP = False       # 文件源播完后从头循环（演示/压测用），否则该路结束
+# 跨路批量推理：单次 predict 最多拼多少路画面
+MAX_BATCH = 8
+
+# 推理节流：每路两次推理之间的最小间隔（秒），即每路推理频率的上限
 INFERENCE_INTERVAL_SEC = 0.01
+# 自适应调度：持续测量推理耗时，按预算自动决定每路多久推理一次
+INFER_CPU_SHARE = 0.6        # 推理最多占用的时间比例（所有路合计），其余留给解码/编码/推送
+INFER_MAX_RESULT_AGE = 1.0   # 每路结果最旧不超过多少秒；预算不够时优先保证这一点
 CONF_THRES = 0.25
 IOU_THRES = 0.30
 PERSIST_TRACK = True
 DEVICE = None     # "cuda:0" / "cpu" / None(自动)
 VERBOSE = False
+# 推理后端：无 GPU 的教室主机可改用 "onnx"（ONNX Runtime）或 "openvino"；首次启动导出并缓存在权重旁边
+BACKEND = "pt"
+BACKEND_INT8 = False      # INT8 量化；openvino 需要在 BACKEND_DATA 指定校准数据集 yaml
+BACKEND_DATA = None
+
+# 运动门控：画面相对上次推理时几乎没变（OBS 虚拟摄像头的重复帧、静止的讲课画面）就跳过推理，沿用上次结果
+MOTION_GATE = True
+MOTION_GATE_SIZE = (64, 36)     # 比较用的灰度缩略图尺寸
+MOTION_PIXEL_DELTA = 12         # 缩略图上灰度差超过该值的像素算“变化”
+MOTION_CHANGED_RATIO = 0.002    # 变化像素占比超过该值才推理；调大更省 CPU，调小更灵敏
+MOTION_MAX_SKIP_SEC = 2.0       # 无论画面是否变化，至少每隔这么久推理一次
+
+# 分块/ROI 推理（可选）：按路配置若干区域，每个区域以各自的输入尺寸推理，结果映射回原图、跨区域 NMS 合并后再交给跟踪器
+# roi 为 (x1, y1, x2, y2)，0~1 的小数表示相对画面的比例，大于 1 表示像素；imgsz 为该区域的推理输入尺寸（None 为模型默认）
+# 相邻区域应留出重叠，跨边界的学生才能在某一块里被完整检测到
+TILES = {
+    # "main": [
+    #     {"roi": (0.0, 0.0, 1.0, 0.45), "imgsz": 1280},   # 后排：高分辨率小块
+    #     {"roi": (0.0, 0.0, 1.0, 1.0), "imgsz": 640},     # 全景：低分辨率
+    # ],
+}
+
+# 两次推理之间按每条轨迹的速度（像素/秒，由相邻两次推理结果估计）外推框的位置，而不是原样重复上次结果
+PREDICT_BOXES = True
+PREDICT_MAX_SEC = 0.5           # 最多外推多久；推理间隔更长时框停在外推上限处
 
 # 输出控制
 INCLUDE_IMAGE_IN_JSON = False  # 若为 True，会把 JPEG(base64) 塞进 JSON（带宽较大）
 JPEG_QUALITY = 80
-MJPEG_FPS = 20
+MJPEG_FPS = 20          # /video.mjpg 默认帧率，客户端可用 ?fps= 覆盖
+MJPEG_MAX_FPS = 30
+# MJPEG 变体：客户端 ?w=640&q=60 会被归并到下面的档位，同一档位每帧只编码一次、所有观看者共享
+MJPEG_WIDTHS = (320, 480, 640, 960, 1280)   # 超过最大档或不指定 w 时为原始尺寸
+MJPEG_QUALITIES = (40, 60, 80, 90)
+MJPEG_MAX_VARIANTS = 6      # 每路最多同时维护的变体数
+MJPEG_VARIANT_TTL = 30.0    # 变体无人观看后保留多久（秒），期间重连可直接拿到缓存帧
+
+# 流水线：采集 → 推理 → 绘制/JPEG 编码 → 序列化/广播，阶段之间为有界队列（满则丢最旧）
+PIPELINE_QUEUE_SIZE = 4
+ENCODE_WORKERS = 2      # cv2 绘制/编码会释放 GIL，可多线程并行
+SERIALIZE_WORKERS = 1
+
+# WebSocket 推送
+WS_CLIENT_QUEUE = 2        # 每个客户端每路最多积压几条消息，满了丢该路最旧的（计入该客户端的 dropped）
+WS_SEND_TIMEOUT = 5.0      # ASGI 模式：单条消息超过该时长仍发不出去视为卡死的慢客户端，断开
+ASGI_HTTP_THREADS = 64     # ASGI 模式：Flask 路由使用的线程池大小（MJPEG 长连接在事件循环里处理，不占线程）
+
+# 性能指标：各阶段耗时的滚动直方图（/metrics、/health）；分位数按最近 1~2 个窗口统计
+METRICS_WINDOW_SEC = 60
+
+# 端到端延迟追踪：每帧 JSON 带上采集/推理/发送时间戳（timing 字段）；采集到发出超过阈值的帧，抽样记下各阶段耗时（/trace/slow）
+TRACE_SLOW_MS = 500
+TRACE_SLOW_MAX_PER_SEC = 2.0    # 慢帧记录的抽样上限（全局，条/秒），持续卡顿时不会刷满日志
+TRACE_SLOW_KEEP = 500           # 内存里保留最近多少条
+TRACE_SLOW_FILE = None          # 例如 "output/slow_frames.jsonl"：同时追加写入文件，重启后仍可排查
+
+# 按需采样分析（GET /admin/profile）：线上 fps 突然掉下来时，不重启就能看推理/编码/WS 线程把时间花在哪
+# 平时不挂任何钩子，没有开销；只有请求期间由一个线程定时抓各线程的调用栈
+PROFILE_TOKEN = None            # 设置后才启用该接口；请求需带 X-Admin-Token 头（不接受查询参数，免得令牌进访问日志）
+PROFILE_MAX_SEC = 30.0          # 单次最长采样时长
+PROFILE_MAX_HZ = 500            # 最高采样频率
+# 默认采样的线程（按名称前缀）：推理、编码、序列化、flask-sock 的 WS 发送线程、ASGI 模式下扇出 WS 的事件循环（主线程）
+PROFILE_THREADS = ("yolo-worker", "encode", "serialize", "ws-sender", "MainThread")
+
+# 行为计数历史：每路 × 每类一组环形缓冲，逐级降采样；(桶宽秒, 桶数)
+# 默认保留 1 秒粒度 1 小时、10 秒粒度 6 小时、1 分钟粒度 24 小时，每路约 260KB
+HISTORY_TIERS = ((1, 3600), (10, 2160), (60, 1440))
+HISTORY_MAX_POINTS = 5000  # /history 单次最多返回的点数，超出时自动加大 step
 # =========================
 
 
 app = Flask(__name__)
 sock = Sock(app)
 
-# ---------------- 行为类别映射（重要） ----------------
-# 需求映射：抬头:u  低头:d  趴桌:c  回头:b  使用手机:p  站立:s
-# 训练集类名（英文）与中文描述都做了兼容
-_BEHAVIOR_ENG_KEYS = {
-    "lookingup":   ("u", "抬头",   "LookingUp"),
-    "lookingdown": ("d", "低头",   "LookingDown"),
-    "lyingondesk": ("c", "趴桌",   "LyingOnDesk"),
-    "lookingback": ("b", "回头",   "LookingBack"),
-    "usingphone":  ("p", "使用手机", "UsingPhone"),
-    "standing":    ("s", "站立",   "Standing"),
-}
-_BEHAVIOR_ORDER = ["u", "d", "c", "b", "p", "s"]  # 固定顺序，便于前端绘图
+class Detections:
+    """一帧检测/跟踪结果的紧凑表示：连续的 NumPy 数组，推理后一次性取回主机内存。
+
+    载荷构建、叠加绘制、行为计数共用同一份记录，不再逐框做 tensor → host 拷贝。
+    """
+
+    __slots__ = ("xyxy", "cls", "conf", "ids", "cache", "t", "vel", "pred")
+
+    def __init__(self, xyxy, cls, conf, ids):
+        self.xyxy = xyxy    # (N, 4) int32
+        self.cls = cls      # (N,) int32
+        self.conf = conf    # (N,) float32
+        self.ids = ids      # (N,) int64，-1 表示没有 track id
+        self.cache = {}     # 序列化结果缓存：同一次推理的结果在非推理帧上被复用，只序列化一次
+        self.t = None       # 推理帧的采集时间
+        self.vel = None     # (N, 4) float32，框四条边的速度（像素/秒），用于推理间隔内外推
+        self.pred = None    # (N,) bool，外推得到的框为 True；推理结果为 None
+
+    def __len__(self):
+        return len(self.cls)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 4), np.int32), np.zeros(0, np.int32), np.zeros(0, np.float32), np.zeros(0, np.int64))
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        """跟踪器输出 (N, 8)：[x1, y1, x2, y2, track_id, conf, cls, idx]。"""
+        if len(tracks) == 0:
+            return cls.empty()
+        return cls(
+            tracks[:, :4].astype(np.int32),
+            tracks[:, 6].astype(np.int32),
+            tracks[:, 5].astype(np.float32),
+            tracks[:, 4].astype(np.int64),
+        )
+
+
+def _with_velocity(det, prev, t):
+    """按 track id 与上一次推理结果配对，估计每个框的速度（与上次估计各取一半做平滑）。"""
+    det.t = t
+    det.vel = np.zeros((len(det), 4), np.float32)
+    if prev is None or prev.t is None or len(det) == 0 or len(prev) == 0:
+        return det
+    dt = t - prev.t
+    if not 0 < dt <= 2 * INFER_MAX_RESULT_AGE:
+        return det  # 间隔太久（比如门控长时间跳过），速度已无意义
+    order = np.argsort(prev.ids)
+    sorted_ids = prev.ids[order]
+    pos = np.clip(np.searchsorted(sorted_ids, det.ids), 0, len(sorted_ids) - 1)
+    match = (sorted_ids[pos] == det.ids) & (det.ids >= 0)
+    j = order[pos[match]]
+    vel = (det.xyxy[match] - prev.xyxy[j]) / dt
+    if prev.vel is not None:
+        vel = 0.5 * vel + 0.5 * prev.vel[j]
+    det.vel[match] = vel
+    return det
+
+
+def _predict_detections(det, t, size):
+    """按恒定速度把推理结果外推到时间 t；没有在动的轨迹时直接返回原结果（保持序列化缓存）。"""
+    if det.vel is None or det.t is None or not det.vel.any():
+        return det
+    dt = min(t - det.t, PREDICT_MAX_SEC)
+    if dt <= 0:
+        return det
+    xyxy = det.xyxy + np.rint(det.vel * dt).astype(np.int32)
+    w, h = size
+    if w and h:
+        np.clip(xyxy, 0, [w - 1, h - 1, w - 1, h - 1], out=xyxy)
+    out = Detections(xyxy, det.cls, det.conf, det.ids)
+    out.pred = det.vel.any(axis=1)
+    return out
+
+
+class BehaviorTable:
+    """模型加载时按 model.names 编译的 类别 id → 行为 查找表。
+
+    model.names 加载后不再变化，逐框的类名字符串匹配（common.map_behavior，与 analyze_video.py 共用）因此只在这里做一次；
+    每帧的行为映射变成一次数组索引（beh_index[cls]），计数是一次 bincount。
+    """
+
+    def __init__(self, class_names):
+        self.class_names = {int(k): str(v) for k, v in (class_names or {}).items()}
+        self.beh_index = behavior_lut(self.class_names)  # 类别 id -> _BEHAVIOR_ORDER 下标，-1 表示未映射
+        self.unmapped = [class_id for class_id in self.class_names if self.beh_index[class_id] < 0]
+        # 预先构造好载荷/绘制用的结构，每帧直接复用
+        self.behavior_dicts = [
+            {"code": code, "zh": _BEHAVIOR_BY_CODE[code][1], "en": _BEHAVIOR_BY_CODE[code][2]}
+            for code in _BEHAVIOR_ORDER
+        ]
+        self.draw_labels = [f"{code} {_BEHAVIOR_BY_CODE[code][2]}" for code in _BEHAVIOR_ORDER]
+
+    def name(self, class_id):
+        return self.class_names.get(class_id, str(class_id))
+
+    def lookup(self, cls):
+        """类别 id 数组 → 行为下标数组（越界/未映射为 -1）。"""
+        return lookup_behavior(self.beh_index, cls)
+
+    def counts(self, beh):
+        per_beh = np.bincount(beh[beh >= 0], minlength=len(_BEHAVIOR_ORDER))
+        return dict(zip(_BEHAVIOR_ORDER, per_beh.tolist()))
+
+    def describe(self):
+        return {
+            "classes": [
+                {
+                    "class_id": class_id,
+                    "class_name": name,
+                    "behavior": _BEHAVIOR_ORDER[self.beh_index[class_id]] if self.beh_index[class_id] >= 0 else None,
+                }
+                for class_id, name in sorted(self.class_names.items())
+            ],
+            "unmapped": [self.class_names[c] for c in self.unmapped],
+        }
+
+
+# 连接管理：每个 WS 客户端一个有界待发队列；广播方只做入队，满了丢最旧的一条
+class WSClient:
+    """一个 WS 客户端的订阅与投递状态。
+
+    订阅（可在连接参数里给出，也可随时用 subscribe 指令修改）：
+      fields        "full" 完整帧（objects + 计数）/ "counts" 只要六类计数
+      max_hz        最高推送频率，0 表示每帧都推
+      streams       订阅的视频流 id 集合（二进制协议只支持单路）
+      changes_only  只在（对应档位的）结果有变化时推送
+      binary        完整帧使用紧凑二进制协议
+    """
+
+    def __init__(self, fields="full", max_hz=0.0, changes_only=False, binary=False):
+        self.fields = fields
+        self.max_hz = max_hz
+        self.changes_only = changes_only
+        self.binary = binary
+        self.streams = set()
+        self.pending = deque()  # (sid, 消息, 相对该客户端是否有变化)，按到达顺序发送
+        self._queued = {}       # sid -> 该路在 pending 中积压的条数，积压上限按路计算
+        self.control = deque()  # 指令回复（ack/pong/error/hello），不参与丢弃
+        self.dropped = 0
+        self.sent = 0
+        self.version = None  # 二进制客户端当前持有的检测结果版本
+        self._next_due = {}  # 限速与变化标记按流分别记录，多路订阅互不挤占
+        self._dirty = {}
+
+    @property
+    def kind(self):
+        """该客户端消费的消息档位：counts / bin / full。"""
+        if self.fields == "counts":
+            return "counts"
+        return "bin" if self.binary else "full"
+
+    def subscription(self):
+        return {
+            "fields": self.fields,
+            "max_hz": self.max_hz,
+            "streams": sorted(self.streams),
+            "changes_only": self.changes_only,
+            "format": "bin" if self.binary else "json",
+        }
+
+    def offer(self, tick):
+        """返回因该路积压已满而丢弃的消息数（0/1）：只替换同一路更旧的消息，多路订阅互不挤占。"""
+        kind = self.kind
+        msg = tick.get(kind)
+        if msg is None:
+            return 0
+        # 限速期间到来的变化先记下，到点后即使当帧没变化也要推，保证不漏掉变化
+        sid = tick["stream"]
+        changed = tick["counts_changed" if kind == "counts" else "changed"]
+        dirty = self._dirty.get(sid, True) or changed
+        self._dirty[sid] = dirty
+        if self.changes_only and not dirty:
+            return 0
+        if self.max_hz:
+            now = time.monotonic()
+            if now < self._next_due.get(sid, 0.0):
+                return 0
+            self._next_due[sid] = now + 1.0 / self.max_hz
+        self._dirty[sid] = False
+        # 消息里的 changed 是相对该路上一帧的；客户端首条消息、限速期间或被挤掉的消息里的变化都要算到这一条上
+        dropped = 0
+        if self._queued.get(sid, 0) >= WS_CLIENT_QUEUE:
+            for i, (queued_sid, _, queued_dirty) in enumerate(self.pending):
+                if queued_sid == sid:
+                    del self.pending[i]
+                    dirty = dirty or queued_dirty
+                    break
+            self.dropped += 1
+            dropped = 1
+        else:
+            self._queued[sid] = self._queued.get(sid, 0) + 1
+        self.pending.append((sid, msg if changed or not dirty else _mark_changed(msg), dirty))
+        self._wake()
+        return dropped
+
+    def reply(self, obj):
+        self.control.append(json.dumps(obj, ensure_ascii=False))
+        self._wake()
+
+    def _wake(self):
+        pass
+
+    def _ready(self):
+        return self.pending or self.control
+
+    def _take(self):
+        if self.control:
+            return self.control.popleft()
+        sid, msg, _ = self.pending.popleft()
+        self._queued[sid] -= 1
+        if isinstance(msg, (BinFrame, _ChangedBinFrame)):
+            data = msg.pick(self.version)
+            self.version = msg.ver
+            return data
+        return msg
 
-def _map_behavior(name: str):
-    """将模型类名/中文名映射到 (code, zh, en)。无法识别返回 None。"""
-    if not name:
-        return None
-    raw = str(name).strip()
-    key = raw.lower().replace(" ", "").replace("_", "")
-    # 英文优先
-    if key in _BEHAVIOR_ENG_KEYS:
-        return _BEHAVIOR_ENG_KEYS[key]
-    # 常见别名
-    alias = {
-        "lookinguplook": "lookingup",
-        "up": "lookingup",
-        "raisehead": "lookingup",
-        "down": "lookingdown",
-        "desk": "lyingondesk",
-        "back": "lookingback",
-        "phone": "usingphone",
-        "stand": "standing",
-    }
-    if key in alias and alias[key] in _BEHAVIOR_ENG_KEYS:
-        return _BEHAVIOR_ENG_KEYS[alias[key]]
-    # 中文关键字兜底
-    if "抬头" in raw:   return _BEHAVIOR_ENG_KEYS["lookingup"]
-    if "低头" in raw:   return _BEHAVIOR_ENG_KEYS["lookingdown"]
-    if ("趴" in raw) or ("趴桌" in raw) or ("伏" in raw):  return _BEHAVIOR_ENG_KEYS["lyingondesk"]
-    if "回头" in raw or "后" in raw: return _BEHAVIOR_ENG_KEYS["lookingback"]
-    if "手机" in raw:   return _BEHAVIOR_ENG_KEYS["usingphone"]
-    if "站" in raw:     return _BEHAVIOR_ENG_KEYS["standing"]
-    return None
-# -----------------------------------------------------
 
+def _mark_changed(msg):
+    """把共享消息里的 changed 改为 true（只在客户端视角有变化而该路视角没有时调用，不常发生）。"""
+    if isinstance(msg, BinFrame):
+        return _ChangedBinFrame(msg)
+    # JSON 字符串值里的引号都被转义，"changed": false 只会匹配到字段本身
+    return msg.replace('"changed": false', '"changed": true', 1)
+
+
+class _ChangedBinFrame:
+    """包装共享的 BinFrame，挑出的二进制帧头 flags 置上 bit0（changed）。"""
+
+    __slots__ = ("frame", "ver")
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.ver = frame.ver
+
+    def pick(self, client_ver):
+        data = self.frame.pick(client_ver)
+        return data[:1] + bytes((data[1] | 1,)) + data[2:]
+
+
+class ThreadWSClient(WSClient):
+    """flask-sock（WSGI）模式：每个客户端一个发送线程，阻塞在 Condition 上。"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._cond = threading.Condition()
+
+    def offer(self, tick):
+        with self._cond:
+            return super().offer(tick)
+
+    def reply(self, obj):
+        with self._cond:
+            super().reply(obj)
+
+    def _wake(self):
+        self._cond.notify()
+
+    def next(self):
+        with self._cond:
+            self._cond.wait_for(self._ready)
+            return self._take()
+
+
+class AsyncWSClient(WSClient):
+    """ASGI 模式：所有客户端在同一个事件循环里由各自的发送协程消费，offer/reply 只在事件循环线程中调用。"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._event = asyncio.Event()
+
+    def _wake(self):
+        self._event.set()
+
+    async def next(self):
+        while not self._ready():
+            self._event.clear()
+            await self._event.wait()
+        return self._take()
+
+
+class WSHub:
+    """一路视频的 WS 广播中心：各档位消息在序列化阶段生成一次，这里只负责扇出。
+
+    flask-sock 客户端在发布线程里直接入队；ASGI 客户端由一次 call_soon_threadsafe 交给事件循环统一扇出，
+    发布线程的开销与客户端数量无关，慢客户端只会丢自己的消息，拖不慢推理和序列化。
+    """
 
-# 连接管理：每个 WS 客户端一个 Queue，后台线程投递最新消息
-class WSManager:
     def __init__(self):
-        self._conns = {}  # ws -> Queue[str]
         self._lock = threading.Lock()
+        self._thread_clients = set()
+        self._async_clients = set()  # 只在事件循环线程中增删、遍历
+        self._loop = None
+        self._kinds = {}  # 档位 -> 客户端数，序列化阶段据此只生成有人要的档位
+        self._dropped_thread = 0
+        self._dropped_async = 0
+        self.slow_disconnects = 0
 
-    def add(self, ws):
-        q = Queue(maxsize=2)
+    def add(self, client, loop=None):
         with self._lock:
-            self._conns[ws] = q
-        return q
+            if loop is not None:
+                self._loop = loop
+                self._async_clients.add(client)
+            else:
+                self._thread_clients.add(client)
+            self._kinds[client.kind] = self._kinds.get(client.kind, 0) + 1
 
-    def remove(self, ws):
+    def remove(self, client):
         with self._lock:
-            self._conns.pop(ws, None)
+            if client in self._async_clients or client in self._thread_clients:
+                self._async_clients.discard(client)
+                self._thread_clients.discard(client)
+                self._kinds[client.kind] -= 1
 
-    def broadcast(self, message_str: str):
+    def count(self):
+        return len(self._thread_clients) + len(self._async_clients)
+
+    def kinds(self):
+        return {k for k, n in self._kinds.items() if n > 0}
+
+    def broadcast(self, tick):
         # 非阻塞广播；队列满则丢弃旧消息，保持最新
-        drop_list = []
         with self._lock:
-            for ws, q in self._conns.items():
+            for client in self._thread_clients:
+                self._dropped_thread += client.offer(tick)
+            loop = self._loop if self._async_clients else None
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._fanout, tick)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _fanout(self, tick):
+        for client in list(self._async_clients):
+            self._dropped_async += client.offer(tick)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "clients": self.count(),
+                "tiers": {k: n for k, n in self._kinds.items() if n > 0},
+                "dropped": self._dropped_thread + self._dropped_async,
+                "slow_disconnects": self.slow_disconnects,
+            }
+
+
+# 采集与推理解耦：采集线程不断覆盖“最新帧”槽位，推理线程永远只取最新一帧
+# 所有路的槽位共用一个 Condition，推理线程可以同时等待任意一路出新帧
+_frame_cond = threading.Condition()
+
+
+class LatestFrameSlot:
+    """单槽位最新帧缓存。seq 为采集序号（从 1 开始），被新帧覆盖而未被取走的帧计入 dropped。"""
+
+    def __init__(self, cond=_frame_cond):
+        self._cond = cond
+        self._frame = None
+        self._ts = 0.0
+        self._media_ms = None
+        self._seq = 0
+        self._taken_seq = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, frame, ts, media_ms=None):
+        with self._cond:
+            self._frame = frame
+            self._ts = ts
+            self._media_ms = media_ms
+            self._seq += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def pending(self):
+        """是否有尚未取走的新帧（调用方需持有 cond）。"""
+        return self._seq != self._taken_seq
+
+    def take(self):
+        """取走最新帧，返回 (seq, frame, capture_ts, media_ms)；没有新帧返回 None。"""
+        with self._cond:
+            if self._seq == self._taken_seq:
+                return None
+            self.dropped += self._seq - self._taken_seq - 1
+            self._taken_seq = self._seq
+            frame, self._frame = self._frame, None
+            return self._seq, frame, self._ts, self._media_ms
+
+
+class MotionGate:
+    """基于缩略图帧差的推理门控：与“上次推理时”的画面比较，而不是与上一帧比较，缓慢的累积变化也不会漏掉。"""
+
+    def __init__(self):
+        self._ref = None
+        self._ref_t = 0.0
+        self.checked = 0
+        self.skipped = 0
+
+    def _thumb(self, frame):
+        # 先隔行隔列取样再缩放，1080p 下也只需处理很少的像素
+        step = max(1, frame.shape[1] // (MOTION_GATE_SIZE[0] * 4))
+        small = cv2.resize(frame[::step, ::step], MOTION_GATE_SIZE, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def should_infer(self, frame, now):
+        """返回 True 表示需要推理（并把这一帧记为新的参照画面）。"""
+        self.checked += 1
+        thumb = self._thumb(frame)
+        if self._ref is not None and now - self._ref_t < MOTION_MAX_SKIP_SEC:
+            changed = np.count_nonzero(cv2.absdiff(thumb, self._ref) > MOTION_PIXEL_DELTA)
+            if changed <= MOTION_CHANGED_RATIO * thumb.size:
+                self.skipped += 1
+                return False
+        self._ref = thumb
+        self._ref_t = now
+        return True
+
+    def stats(self):
+        return {
+            "enabled": MOTION_GATE,
+            "checked": self.checked,
+            "skipped": self.skipped,
+            "skip_rate": round(self.skipped / self.checked, 4) if self.checked else 0.0,
+        }
+
+
+class InferenceScheduler:
+    """自适应推理调度：用实测的单帧推理耗时（EWMA）把 INFER_CPU_SHARE 的时间预算换算成总推理频率，
+    再平分给当前活跃的各路。路数增加时每路自动降频；机器空闲或画面静止（门控跳过不耗预算）时升回去。
+    每路频率限制在 [1 / INFER_MAX_RESULT_AGE, min(相机帧率, 1 / INFERENCE_INTERVAL_SEC)] 之间。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cost = None            # 单帧推理耗时（秒，批量推理按帧均摊）
+        self.budget_rate = None     # 预算允许的总推理频率（帧/秒）
+        self.overloaded = False     # 按最大结果时延的下限推理也超出预算
+        self._busy = 0.0
+        self._win_start = time.time()
+        self.busy_ratio = 0.0       # 最近一个统计窗口内推理实际占用的时间比例
+
+    def observe(self, n, seconds):
+        with self._lock:
+            per_frame = seconds / n
+            self.cost = per_frame if self.cost is None else 0.8 * self.cost + 0.2 * per_frame
+            self.budget_rate = INFER_CPU_SHARE / self.cost
+            self._busy += seconds
+            now = time.time()
+            if now - self._win_start >= 5.0:
+                self.busy_ratio = self._busy / (now - self._win_start)
+                self._busy, self._win_start = 0.0, now
+
+    def plan(self, streams):
+        """按当前活跃路数为每路计算目标推理频率。"""
+        floor = 1.0 / INFER_MAX_RESULT_AGE
+        share = self.budget_rate / len(streams) if self.budget_rate else None
+        self.overloaded = share is not None and share < floor
+        for st in streams:
+            ceiling = min(st.fps_cap, 1.0 / INFERENCE_INTERVAL_SEC)
+            st.infer_rate = ceiling if share is None else max(floor, min(ceiling, share))
+
+    @staticmethod
+    def due(st, now):
+        return now >= st.next_infer_t
+
+    @staticmethod
+    def mark(st, now):
+        # 帧按相机帧率到达，预留半帧的容差，免得因为抖动错过本该推理的帧
+        st.next_infer_t = now + 1.0 / st.infer_rate - 0.5 / st.fps_cap
+
+    def stats(self):
+        return {
+            "infer_ms": round(self.cost * 1000, 2) if self.cost else None,
+            "cpu_share": INFER_CPU_SHARE,
+            "busy_ratio": round(self.busy_ratio, 3),
+            "budget_fps": round(self.budget_rate, 2) if self.budget_rate else None,
+            "max_result_age": INFER_MAX_RESULT_AGE,
+            "overloaded": self.overloaded,
+        }
+
+
+_scheduler = InferenceScheduler()
+
+
+class LatencyHistogram:
+    """固定桶的耗时直方图：累计计数用于 Prometheus histogram，当前/上一窗口两组计数用于滚动分位数。
+
+    记录一次只是一次二分查找加几次加法，热路径上开销可以忽略。
+    """
+
+    # 细分桶：50us ~ 20s 按约 1.2 倍递增，并包含对外导出的整齐边界
+    EXPORT_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+    BOUNDS = sorted(set(np.round(np.geomspace(5e-5, 20.0, 72), 6).tolist()) | set(EXPORT_BOUNDS))
+    _EXPORT_IDX = list(map(BOUNDS.index, EXPORT_BOUNDS))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        n = len(self.BOUNDS) + 1  # 最后一个桶为 +Inf
+        self._total = [0] * n
+        self._cur = [0] * n
+        self._prev = [0] * n
+        self._win_start = time.time()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.BOUNDS, seconds)
+        with self._lock:
+            now = time.time()
+            if now - self._win_start >= METRICS_WINDOW_SEC:
+                # 隔了不止一个窗口没有数据时，上一窗口也已过期
+                stale = now - self._win_start >= 2 * METRICS_WINDOW_SEC
+                self._prev = [0] * len(self._cur) if stale else self._cur
+                self._cur = [0] * len(self._prev)
+                self._win_start = now
+            self._total[i] += 1
+            self._cur[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        """最近窗口内的分位数（秒，取所在桶的上界）；没有数据返回 None。"""
+        with self._lock:
+            counts = [a + b for a, b in zip(self._cur, self._prev)]
+        n = sum(counts)
+        if not n:
+            return [None] * len(qs)
+        cum = np.cumsum(counts)
+        bounds = self.BOUNDS + [float("inf")]
+        return [bounds[int(np.searchsorted(cum, q * n))] for q in qs]
+
+    def export(self):
+        """[(le, 累计计数)] + sum + count，le 为 EXPORT_BOUNDS 与 +Inf。"""
+        with self._lock:
+            cum = np.cumsum(self._total).tolist()
+            count, total = self.count, self.sum
+        buckets = [(le, cum[i]) for le, i in zip(self.EXPORT_BOUNDS, self._EXPORT_IDX)]
+        buckets.append(("+Inf", count))
+        return buckets, total, count
+
+    def summary(self):
+        p50, p95, p99 = self.quantiles()
+        ms = lambda v: None if v is None else (round(v * 1000, 2) if v != float("inf") else None)
+        return {"count": self.count, "p50_ms": ms(p50), "p95_ms": ms(p95), "p99_ms": ms(p99)}
+
+
+# 采集（cap.read）→ 推理（批量 predict + 跟踪）→ 绘制 → JPEG 编码 → 序列化 → 广播
+_STAGES = ("capture", "inference", "draw", "encode", "serialize", "broadcast")
+_latency = {stage: LatencyHistogram() for stage in _STAGES}
+
+
+class SlowFrameLog:
+    """采集到发出超过 TRACE_SLOW_MS 的慢帧：按阶段拆开耗时，抽样记在环形缓冲里（可选同时追加到 JSONL 文件）。
+
+    直方图只能看出哪个阶段整体变慢；这里保留单帧的完整链路，卡顿过后仍能看出当时卡在哪一段。
+    """
+
+    def __init__(self, threshold_ms=TRACE_SLOW_MS, max_per_sec=TRACE_SLOW_MAX_PER_SEC, keep=TRACE_SLOW_KEEP, path=TRACE_SLOW_FILE):
+        self.threshold = threshold_ms / 1000.0
+        self.min_gap = 1.0 / max_per_sec if max_per_sec > 0 else 0.0
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=max(1, int(keep)))
+        self._last_t = 0.0
+        self.slow = 0       # 超阈值的帧数
+        self.sampled = 0    # 其中被记录下来的
+
+    def observe(self, job, serialized_t, sent_t):
+        """序列化阶段广播完成后调用；未超阈值时只有一次比较。"""
+        total = sent_t - job.capture_ts
+        if total < self.threshold:
+            return
+        with self._lock:
+            self.slow += 1
+            if sent_t - self._last_t < self.min_gap:
+                return
+            self._last_t = sent_t
+            self.sampled += 1
+        ms = lambda v: round(v * 1000, 1)
+        stages = {"slot_wait": ms(job.taken_t - job.capture_ts)}  # 在采集槽位里等推理线程取走
+        if job.inferred:
+            _, start, end, _ = job.infer
+            stages["pre_infer"] = ms(start - job.taken_t)   # 同一轮里排在前面的调度/门控
+            stages["inference"] = ms(end - start)           # 整批 predict + 跟踪
+            stages["post_infer"] = ms(job.dispatch_t - end)
+        else:
+            stages["worker"] = ms(job.dispatch_t - job.taken_t)  # 本帧不推理：同一轮其他路的推理也算在这里
+        stages["queue"] = ms(job.serialize_t - job.dispatch_t)   # 序列化阶段队列
+        stages["serialize"] = ms(serialized_t - job.serialize_t)
+        stages["broadcast"] = ms(sent_t - serialized_t)
+        record = {
+            "time_ms": int(sent_t * 1000),
+            "stream": job.st.sid,
+            "frame_index": job.frame_index,
+            "capture_seq": job.seq,
+            "media_ms": job.media_ms,
+            "total_ms": ms(total),
+            "inferred": job.inferred,
+            "predicted": job.dets is not None and job.dets.pred is not None,
+            # 所展示的检测结果来自多久之前采集的帧
+            "result_age_ms": ms(job.capture_ts - job.infer[0]) if job.infer else None,
+            "batch": job.infer[3] if job.inferred else 0,
+            "stages_ms": stages,
+            "pipeline": _pipeline_info(),
+            "scheduler_overloaded": _scheduler.overloaded,
+        }
+        with self._lock:
+            self._records.append(record)
+            if self.path:
                 try:
-                    if q.full():
-                        _ = q.get_nowait()
-                    q.put_nowait(message_str)
-                except Exception:
-                    drop_list.append(ws)
-            for ws in drop_list:
-                self._conns.pop(ws, None)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except OSError:
+                    pass
+
+    def recent(self, sid=None, limit=100):
+        with self._lock:
+            records = [r for r in self._records if sid is None or r["stream"] == sid]
+        return records[::-1][:limit]
+
+    def stats(self):
+        return {"threshold_ms": round(self.threshold * 1000, 1), "slow_frames": self.slow, "sampled": self.sampled}
+
+
+_slow_frames = SlowFrameLog()
+
+
+class SamplingProfiler:
+    """按需的采样分析器：在 seconds 秒内以 hz 的频率用 sys._current_frames() 抓取选中线程的调用栈，
+    汇总为 collapsed stacks（每行 "线程;外层函数;...;内层函数 次数"，flamegraph.pl / speedscope 可直接读取）。
+
+    同一时间只允许一次采样；采样在调用线程里同步进行，到时长上限必然结束，不会被遗留在后台。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+        self.runs = 0
+
+    def sample(self, seconds, hz, prefixes=PROFILE_THREADS, lines=False):
+        """返回 (collapsed stacks 计数, 统计信息)；已有采样在进行时返回 None。
+
+        seconds / hz 截到 PROFILE_MAX_SEC / PROFILE_MAX_HZ 以内，非有限值抛 ValueError。
+        """
+        if not (math.isfinite(seconds) and math.isfinite(hz)):
+            raise ValueError("seconds/hz must be finite")
+        seconds = min(max(seconds, 0.1), PROFILE_MAX_SEC)
+        hz = min(max(hz, 1), PROFILE_MAX_HZ)
+        with self._lock:
+            if self.running:
+                return None
+            self.running = True
+            self.runs += 1
+        try:
+            return self._sample(seconds, hz, prefixes, lines)
+        finally:
+            with self._lock:
+                self.running = False
+
+    @staticmethod
+    def _label(frame, lines):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno if lines else code.co_firstlineno})"
+
+    def _sample(self, seconds, hz, prefixes, lines):
+        interval = 1.0 / hz
+        stacks = {}
+        ticks = 0
+        me = threading.get_ident()
+        t0 = time.perf_counter()
+        deadline = t0 + seconds
+        next_t = t0
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()
+                     if t.ident != me and (not prefixes or t.name.startswith(tuple(prefixes)))}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if name is None:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._label(frame, lines))
+                    frame = frame.f_back
+                key = name + ";" + ";".join(reversed(labels))
+                stacks[key] = stacks.get(key, 0) + 1
+            ticks += 1
+            next_t += interval
+            delay = min(next_t, deadline) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_t = time.perf_counter()  # 抓栈本身跟不上时不追
+        elapsed = time.perf_counter() - t0
+        info = {
+            "seconds": round(elapsed, 3),
+            "hz": hz,
+            "ticks": ticks,
+            "effective_hz": round(ticks / elapsed, 1) if elapsed > 0 else 0.0,
+            "threads": sorted({key.split(";", 1)[0] for key in stacks}),
+            "samples": sum(stacks.values()),
+        }
+        return stacks, info
+
+
+_profiler = SamplingProfiler()
+
+
+class DropOldestQueue:
+    """有界队列：满了丢弃最旧的一项，上游永远不会被下游阻塞。"""
+
+    def __init__(self, maxsize):
+        self.maxsize = max(1, int(maxsize))
+        self._items = deque()
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._items)
+            return self._items.popleft()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class PipelineStage:
+    """流水线的一个阶段：一个输入队列 + N 个工作线程，fn(job) 的返回值投递给所有下游阶段。"""
+
+    def __init__(self, name, fn, workers=1, maxsize=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, int(workers))
+        self.queue = DropOldestQueue(maxsize)
+        self.downstream = []
+        self.processed = 0
+        self.errors = 0
+        self._threads = []
+
+    def to(self, *stages):
+        self.downstream.extend(stages)
+        return self
+
+    def submit(self, job):
+        self.queue.put(job)
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                out = self.fn(job)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+                continue
+            self.processed += 1
+            if out is not None:
+                for stage in self.downstream:
+                    stage.submit(out)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": len(self.queue),
+            "processed": self.processed,
+            "dropped": self.queue.dropped,
+            "errors": self.errors,
+        }
+
+
+class FrameJob:
+    """在流水线各阶段之间传递的一帧：推理阶段把结果快照进来，后续阶段不再读 StreamState 的可变状态。"""
+
+    __slots__ = ("st", "frame", "seq", "capture_ts", "media_ms", "frame_index", "dets", "fps", "jpeg", "variants", "predict",
+                 "taken_t", "infer", "inferred", "dispatch_t", "serialize_t")
+
+    def __init__(self, st, seq, frame, capture_ts, media_ms=None):
+        self.st = st
+        self.seq = seq
+        self.frame = frame
+        self.capture_ts = capture_ts
+        self.media_ms = media_ms    # 文件源：该帧在视频里的时间位置（CAP_PROP_POS_MSEC）
+        self.frame_index = 0
+        self.dets = None
+        self.fps = 0.0
+        self.jpeg = None
+        self.variants = ()
+        self.predict = False  # 非推理帧：按速度外推上次结果
+        # 延迟追踪（墙钟秒）：推理线程取走 / 所用结果的 (采集, 推理开始, 推理结束, 批大小) / 交给后续阶段 / 序列化开始
+        self.taken_t = 0.0
+        self.infer = None
+        self.inferred = False
+        self.dispatch_t = 0.0
+        self.serialize_t = 0.0
+
+
+class _MjpegVariant:
+    __slots__ = ("key", "viewers", "notify", "jpeg", "jpeg_index", "seq", "last_reserve_t", "idle_since", "encoded")
+
+    def __init__(self, key):
+        self.key = key            # (width, quality)，width=0 表示原始尺寸
+        self.viewers = {}         # token -> fps
+        self.notify = {}          # token -> 新帧回调（ASGI 观看者，唤醒其事件循环）
+        self.jpeg = None
+        self.jpeg_index = -1
+        self.seq = 0
+        self.last_reserve_t = 0.0
+        self.idle_since = None
+        self.encoded = 0
+
+
+def _snap_variant(width, quality):
+    """把客户端请求的宽度/质量归并到固定档位：宽度取不小于请求值的最小档，质量取最近档。"""
+    w = 0
+    if width:
+        w = next((x for x in MJPEG_WIDTHS if x >= width), 0)
+    q = min(MJPEG_QUALITIES, key=lambda x: abs(x - quality))
+    return w, q
+
+
+class MjpegHub:
+    """按需编码的 MJPEG 分发：按 (宽度, 质量) 变体记录观看者及其帧率，没有观看者就不绘制、不编码。
+
+    每个变体的编码频率取其观看者中的最高帧率，一帧只编码一次、所有观看者共享；
+    新帧编码完成后用 Condition 唤醒线程观看者、用回调唤醒 ASGI 观看者，而不是让它们轮询。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._variants = {}  # (w, q) -> _MjpegVariant
+        self._next_token = 0
+
+    def subscribe(self, key, fps, notify=None):
+        """登记一个观看者，返回 (token, 实际使用的变体 key)；notify 在该变体每次有新帧时于编码线程中调用。"""
+        with self._cond:
+            now = time.time()
+            self._evict(now)
+            v = self._variants.get(key)
+            if v is None:
+                if len(self._variants) >= MJPEG_MAX_VARIANTS:
+                    # 变体数已满且都有人在看：就近复用已有变体，不再新增编码负担
+                    key = min(self._variants, key=lambda k: (abs(k[0] - key[0]), abs(k[1] - key[1])))
+                    v = self._variants[key]
+                else:
+                    v = self._variants[key] = _MjpegVariant(key)
+            self._next_token += 1
+            v.viewers[self._next_token] = fps
+            if notify is not None:
+                v.notify[self._next_token] = notify
+            v.idle_since = None
+            return self._next_token, key
+
+    def unsubscribe(self, token, key):
+        with self._cond:
+            v = self._variants.get(key)
+            if v is not None:
+                v.viewers.pop(token, None)
+                v.notify.pop(token, None)
+                if not v.viewers:
+                    v.idle_since = time.time()
+
+    def _evict(self, now):
+        # 无人观看且超过 TTL 的变体直接淘汰；变体数超限时再按空闲时长淘汰最久未用的
+        idle = sorted((v.idle_since, k) for k, v in self._variants.items() if v.idle_since is not None)
+        for since, k in idle:
+            if now - since > MJPEG_VARIANT_TTL or len(self._variants) >= MJPEG_MAX_VARIANTS:
+                del self._variants[k]
+
+    def viewer_count(self):
+        with self._cond:
+            return sum(len(v.viewers) for v in self._variants.values())
+
+    def want_variants(self, now):
+        """推理线程调用：返回这一帧需要编码的变体 key 列表（有观看者且到了该变体的编码间隔）。"""
+        keys = []
+        with self._cond:
+            for v in self._variants.values():
+                if v.viewers and now - v.last_reserve_t >= 1.0 / max(v.viewers.values()):
+                    v.last_reserve_t = now
+                    keys.append(v.key)
+        return keys
+
+    def publish(self, key, jpeg, frame_index):
+        # 多个编码线程可能乱序完成，只保留帧号更大的
+        with self._cond:
+            v = self._variants.get(key)
+            if v is None or frame_index <= v.jpeg_index:
+                return
+            v.jpeg = jpeg
+            v.jpeg_index = frame_index
+            v.seq += 1
+            v.encoded += 1
+            self._cond.notify_all()
+            for notify in v.notify.values():
+                notify()
+
+    def wait_next(self, key, last_seq, timeout=1.0):
+        """阻塞到该变体有比 last_seq 更新的帧，返回 (seq, jpeg)；超时返回 (last_seq, None)。"""
+        with self._cond:
+            v = self._variants.get(key)
+            if v is None:
+                return last_seq, None
+            if not self._cond.wait_for(lambda: v.seq > last_seq, timeout=timeout):
+                return last_seq, None
+            return v.seq, v.jpeg
+
+    def latest(self, key, last_seq):
+        """不阻塞：该变体有比 last_seq 更新的帧时返回 (seq, jpeg)，否则返回 (last_seq, None)。"""
+        with self._cond:
+            v = self._variants.get(key)
+            if v is None or v.seq <= last_seq:
+                return last_seq, None
+            return v.seq, v.jpeg
+
+    def stats(self):
+        with self._cond:
+            return [
+                {"width": k[0], "quality": k[1], "viewers": len(v.viewers), "encoded": v.encoded}
+                for k, v in self._variants.items()
+            ]
+
+
+class _HistoryTier:
+    """固定桶宽的环形时间序列：桶号 = 时间 // 桶宽，槽位 = 桶号 % 桶数，槽位里的旧桶号不符即视为已过期。"""
+
+    def __init__(self, step, size, width):
+        self.step = step
+        self.size = size
+        self.bucket = np.full(size, -1, dtype=np.int64)
+        self.sums = np.zeros((size, width), dtype=np.float32)
+        self.samples = np.zeros(size, dtype=np.int32)
+
+    def add(self, t, vec):
+        b = int(t // self.step)
+        i = b % self.size
+        if self.bucket[i] != b:
+            self.bucket[i] = b
+            self.sums[i] = 0
+            self.samples[i] = 0
+        self.sums[i] += vec
+        self.samples[i] += 1
+
+    def span(self, now):
+        """该层仍保留的最早时间（秒）。"""
+        return (int(now // self.step) - self.size + 1) * self.step
+
+    def query(self, b0, b1):
+        """返回桶号 [b0, b1] 的 (sums, samples)，缺失的桶样本数为 0。"""
+        bs = np.arange(b0, b1 + 1, dtype=np.int64)
+        idx = bs % self.size
+        hit = self.bucket[idx] == bs
+        sums = np.where(hit[:, None], self.sums[idx], 0)
+        samples = np.where(hit, self.samples[idx], 0)
+        return sums, samples
+
+
+class CountHistory:
+    """一路视频的六类人数历史。每条检测结果同时累加进所有层（各层一次 O(1) 更新），
+    查询时挑能覆盖时间范围的最细一层，必要时再按 step 合并，返回按桶平均后的人数。"""
+
+    def __init__(self, tiers=HISTORY_TIERS):
+        self._lock = threading.Lock()
+        self._tiers = [_HistoryTier(step, size, len(_BEHAVIOR_ORDER)) for step, size in tiers]
+
+    def add(self, t, vec):
+        with self._lock:
+            for tier in self._tiers:
+                tier.add(t, vec)
+
+    def query(self, t0, t1, step=None):
+        """t0/t1 为秒；返回 (实际 step, 各桶起始秒, 平均人数 (n, 6) 或 NaN, 样本数)。"""
+        now = time.time()
+        # 超出保留期或晚于当前的部分没有数据，先裁掉，避免为空区间分配大数组
+        t1 = min(t1, now)
+        t0 = min(max(t0, self._tiers[-1].span(now)), t1)
+        step = max(step or 0, (t1 - t0) / HISTORY_MAX_POINTS)
+        usable = [tier for tier in self._tiers if tier.span(now) <= t0] or self._tiers[-1:]
+        fit = [tier for tier in usable if tier.step <= step]
+        tier = fit[-1] if fit else usable[0]
+        step = min(step, max(tier.step, t1 - t0))  # 比整个查询区间还大的 step 没有意义，也避免 k 失控
+        k = max(1, int(round(step / tier.step)))  # 每个输出点合并 k 个桶
+        b0 = int(t0 // (tier.step * k)) * k
+        b1 = int(t1 // tier.step)
+        n = (b1 - b0) // k + 1
+        with self._lock:
+            sums, samples = tier.query(b0, b0 + n * k - 1)
+        sums = sums.reshape(n, k, -1).sum(axis=1)
+        samples = samples.reshape(n, k).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums / samples[:, None]
+        starts = (b0 + np.arange(n) * k) * tier.step
+        return tier.step * k, starts, mean, samples
 
-ws_manager = WSManager()
 
-# 共享的“最新 JPEG 帧”
-_latest_jpeg = None
-_latest_jpeg_lock = threading.Lock()
-_latest_size = (0, 0)  # (w, h)
+class StreamState:
+    """单路视频流的运行状态：采集句柄、独立跟踪器、帧计数，以及该路自己的 WS/MJPEG 通道。"""
+
+    def __init__(self, sid, source):
+        self.sid = sid
+        self.source = source
+        self.cap = None
+        self.slot = LatestFrameSlot()
+        self.capture_thread = None
+        self.tracker = None
+        self.running = False
+        self.fps_cap = 30.0
+        self.size = (0, 0)  # (w, h)
+        self.infer_rate = 0.0     # 调度器给出的目标推理频率（次/秒）
+        self.next_infer_t = 0.0
+        self.frame_index = 0
+        self.infer_count = 0
+        self.start_t = None
+        self.last_dets = None
+        self.last_infer = None    # 最近一次推理：(采集时间, 推理开始, 推理结束, 批大小)，墙钟秒
+        self.gate = MotionGate()
+        self.tiles = TILES.get(sid) or []
+        self._tile_rects = {}     # 画面尺寸 -> 换算成像素的区域；ROI 固定，每种尺寸只算一次
+        self.no_dets = Detections.empty()  # 首次推理前使用；每路一份，序列化缓存/版本号不会串路
+        self.ws_hub = WSHub()
+        self.history = CountHistory()
+        # 该路共享的“最新 JPEG 帧”，只在有人观看时编码
+        self.mjpeg = MjpegHub()
+        # 序列化阶段同理：保证推给客户端的 frame_index 单调递增
+        self.last_sent_index = -1
+        self.last_sent_dets = None
+        self.last_sent_counts = None
+        self.send_lock = threading.Lock()
+        # 二进制协议：检测结果版本号与最近一次发送的结果（增量基准）
+        self.bin_ver = 0
+        self.bin_last_det = None
+
+    def proc_fps(self):
+        elapsed = time.time() - self.start_t if self.start_t else 0.0
+        return (self.frame_index + 1) / elapsed if elapsed > 0 else 0.0
+
+
+_streams = {sid: StreamState(sid, src) for sid, src in STREAMS.items()}
+_default_sid = next(iter(_streams))
+
+
+def _get_stream(sid=None):
+    st = _streams.get(sid or _default_sid)
+    if st is None:
+        abort(404, description=f"unknown stream: {sid}")
+    return st
 
 def _encode_jpeg(frame, quality=80):
     ok, buf = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
@@ -137,29 +1212,17 @@ def _encode_jpeg(frame, quality=80):
 #         color = (0, 255, 0)
 #         cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
 #     return frame
-def _draw_detections(frame, result, class_names):
-    if result is None or result.boxes is None:
+def _draw_detections(frame, det, table):
+    if det is None or len(det) == 0:
         return frame
-    for box in result.boxes:
-        xyxy = box.xyxy[0].cpu().numpy().astype(int)
-        x1, y1, x2, y2 = xyxy.tolist()
-        class_id = int(box.cls[0]) if box.cls is not None else -1
-        track_id = int(box.id[0]) if (box.id is not None) else -1
-        conf = float(box.conf[0]) if box.conf is not None else None
-
-        # 行为标签用于可视化
-        name = class_names.get(class_id, str(class_id))
-        beh = _map_behavior(name)
-        beh_code = beh[0] if beh else ""
-        beh_en = beh[2] if beh else ""  # 改这里：用英文
-
-        color = (0, 255, 0)
-        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-        label = f"ID {track_id if track_id is not None else '-'} {beh_code}"
-        if beh_en:
-            label += f" {beh_en}"  # 改这里：拼英文
-        if conf is not None:
-            label += f" {conf:.2f}"
+    pred = det.pred.tolist() if det.pred is not None else [False] * len(det)
+    for (x1, y1, x2, y2), beh, track_id, conf, predicted in zip(
+        det.xyxy.tolist(), table.lookup(det.cls).tolist(), det.ids.tolist(), det.conf.tolist(), pred
+    ):
+        # 行为标签用于可视化（英文）；外推的框用黄色细线
+        color = (0, 220, 255) if predicted else (0, 255, 0)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 1 if predicted else 2)
+        label = f"ID {track_id} {table.draw_labels[beh] if beh >= 0 else ''} {conf:.2f}"
         cv2.putText(frame, label, (x1, max(0, y1 - 8)),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, lineType=cv2.LINE_AA)
     return frame
@@ -191,58 +1254,181 @@ def _draw_detections(frame, result, class_names):
 #                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, lineType=cv2.LINE_AA)
 #     return frame
 
-def _result_to_payload(result, frame_index, t_ms, fps, src, class_names, image_b64=None):
-    # 初始化六类计数
-    behavior_counts = {k: 0 for k in _BEHAVIOR_ORDER}
+def _detections_body(det, table):
+    """载荷中只取决于检测结果的部分：objects / 六类计数 / 图例。"""
     objects = []
+    behavior_counts = {k: 0 for k in _BEHAVIOR_ORDER}
 
-    if result is not None and result.boxes is not None:
-        for box in result.boxes:
-            xyxy = box.xyxy[0].cpu().numpy().tolist()
-            class_id = int(box.cls[0]) if box.cls is not None else -1
-            name = class_names.get(class_id, str(class_id))
-            track_id = int(box.id[0]) if (box.id is not None) else None
-            conf = float(box.conf[0]) if box.conf is not None else None
-
-            beh = _map_behavior(name)
-            behavior = None
-            if beh:
-                behavior = {"code": beh[0], "zh": beh[1], "en": beh[2]}
-                if beh[0] in behavior_counts:
-                    behavior_counts[beh[0]] += 1
-
+    if det is not None and len(det):
+        beh_idx = table.lookup(det.cls)
+        behavior_counts = table.counts(beh_idx)
+        for (x1, y1, x2, y2), class_id, beh, track_id, conf in zip(
+            det.xyxy.tolist(), det.cls.tolist(), beh_idx.tolist(), det.ids.tolist(), det.conf.tolist()
+        ):
             objects.append({
-                "id": track_id,
+                "id": track_id if track_id >= 0 else None,
                 "class_id": class_id,
-                "class_name": name,
+                "class_name": table.name(class_id),
                 "conf": conf,
-                "bbox": {
-                    "x1": int(xyxy[0]),
-                    "y1": int(xyxy[1]),
-                    "x2": int(xyxy[2]),
-                    "y2": int(xyxy[3]),
-                },
-                "behavior": behavior  # 新增：行为标注（含 code/中英）
+                "bbox": {"x1": x1, "y1": y1, "x2": x2, "y2": y2},
+                "behavior": table.behavior_dicts[beh] if beh >= 0 else None  # 行为标注（含 code/中英）
             })
+        if det.pred is not None:
+            # 外推帧：标出哪些框是按速度预测的（推理帧不带该字段）
+            for obj, predicted in zip(objects, det.pred.tolist()):
+                obj["predicted"] = predicted
 
-    payload = {
-        "type": "frame",
-        "source": str(src),
-        "frame_index": frame_index,
-        "time_ms": t_ms,
-        "fps": round(fps, 2),
+    return {
         "objects": objects,
-        # 新增：每帧六类人数统计 + 固定顺序（便于前端直接映射到横向柱状图）
+        # 每帧六类人数统计 + 固定顺序（便于前端直接映射到横向柱状图）
         "behavior_counts": behavior_counts,
         "behavior_order": _BEHAVIOR_ORDER,
         # 可选：提供 code->中文 的图例，前端直接使用
-        "behavior_legend": {
-            "u": "抬头", "d": "低头", "c": "趴桌", "b": "回头", "p": "使用手机", "s": "站立"
-        }
+        "behavior_legend": _BEHAVIOR_LEGEND
+    }
+
+
+def _serialized_body(det, table):
+    """检测结果部分的 JSON（去掉外层花括号，便于拼接帧头）。缓存在 Detections 上，每次推理只序列化一次。"""
+    body = det.cache.get("json")
+    if body is None:
+        body = json.dumps(_detections_body(det, table), ensure_ascii=False)[1:-1]
+        det.cache["json"] = body
+    return body
+
+
+# ---------------- 紧凑二进制 WS 协议（/ws?format=bin） ----------------
+# 连接建立时先发一条 JSON 文本 {"type":"hello",...}（图例、类名只发这一次），之后每帧一条二进制消息（小端）：
+#   帧头 42 字节  <BBHHIIIIfIId
+#     kind(1=关键帧, 2=增量帧) flags(bit0=changed, bit1=外推帧：有 id 且在动的轨迹为预测框) n_upd n_new frame_index capture_seq
+#     ver base_ver fps latency_ms dropped_frames time_ms
+#   计数 12 字节   六类人数 u16 × 6（按 behavior_order）
+#   n_upd 条更新记录 11 字节  id:i32 dx1 dy1 dx2 dy2:i8 cls:u8 beh:i8 conf:u8   —— 相对 base_ver 中同一 id 的框
+#   n_new 条完整记录 15 字节  id:i32 x1 y1 x2 y2:i16 cls:u8 beh:i8 conf:u8    —— 新轨迹 / 位移过大 / 无 id
+# ver 为该路检测结果版本（每次推理 +1）。增量帧：base_ver 中没被更新记录引用的轨迹即已消失；
+# base_ver == ver 表示结果没变，只更新帧头与计数。conf 量化为 0..255，beh=-1 表示未映射。
+_BIN_KEY, _BIN_DELTA = 1, 2
+_BIN_HEADER = struct.Struct("<BBHHIIIIfIId")
+_BIN_COUNTS = struct.Struct("<6H")
+_BIN_FULL = np.dtype([("id", "<i4"), ("x1", "<i2"), ("y1", "<i2"), ("x2", "<i2"), ("y2", "<i2"),
+                      ("cls", "u1"), ("beh", "i1"), ("conf", "u1")])
+_BIN_UPD = np.dtype([("id", "<i4"), ("dx1", "i1"), ("dy1", "i1"), ("dx2", "i1"), ("dy2", "i1"),
+                     ("cls", "u1"), ("beh", "i1"), ("conf", "u1")])
+
+
+class BinFrame:
+    """一帧的二进制消息，三种形态各编码一次、所有二进制客户端共享；发送线程按客户端已有的版本挑选。"""
+
+    __slots__ = ("ver", "base_ver", "key", "delta", "same")
+
+    def __init__(self, ver, base_ver, key, delta, same):
+        self.ver = ver
+        self.base_ver = base_ver
+        self.key = key
+        self.delta = delta
+        self.same = same
+
+    def pick(self, client_ver):
+        # 客户端已持有本版本 → 只发帧头；持有增量基准 → 增量帧；否则关键帧
+        if client_ver == self.ver:
+            return self.same
+        if self.delta is not None and client_ver == self.base_ver:
+            return self.delta
+        return self.key
+
+
+def _bin_rows(det, table, rows, dtype):
+    out = np.zeros(len(rows), dtype)
+    out["id"] = det.ids[rows]
+    out["cls"] = np.clip(det.cls[rows], 0, 255)
+    out["beh"] = table.lookup(det.cls[rows])
+    out["conf"] = np.round(np.clip(det.conf[rows], 0.0, 1.0) * 255)
+    return out
+
+
+def _bin_key_body(det, table):
+    body = det.cache.get("bin_key")
+    if body is None:
+        counts = table.counts(table.lookup(det.cls))
+        rec = _bin_rows(det, table, np.arange(len(det)), _BIN_FULL)
+        xyxy = np.clip(det.xyxy, -32768, 32767)
+        for i, name in enumerate(("x1", "y1", "x2", "y2")):
+            rec[name] = xyxy[:, i]
+        body = det.cache["bin_key"] = (_BIN_COUNTS.pack(*counts.values()), rec.tobytes(), len(rec))
+    return body
+
+
+def _bin_delta_body(det, base, table):
+    """相对 base 的增量：两帧都出现、且四个坐标变化都在 ±127 内的轨迹发更新记录，其余发完整记录。"""
+    counts_bytes = _bin_key_body(det, table)[0]
+    cur_ids = det.ids
+    order = np.argsort(base.ids)
+    base_sorted = base.ids[order]
+    pos = np.clip(np.searchsorted(base_sorted, cur_ids), 0, max(len(base_sorted) - 1, 0))
+    matched = (cur_ids >= 0) & (len(base_sorted) > 0)
+    if len(base_sorted):
+        matched &= base_sorted[pos] == cur_ids
+    d = np.zeros_like(det.xyxy)
+    if matched.any():
+        d[matched] = det.xyxy[matched] - base.xyxy[order[pos[matched]]]
+    upd_mask = matched & (np.abs(d).max(axis=1) <= 127)
+    upd_rows = np.flatnonzero(upd_mask)
+    new_rows = np.flatnonzero(~upd_mask)
+
+    upd = _bin_rows(det, table, upd_rows, _BIN_UPD)
+    for i, name in enumerate(("dx1", "dy1", "dx2", "dy2")):
+        upd[name] = d[upd_rows, i]
+    new = _bin_rows(det, table, new_rows, _BIN_FULL)
+    xyxy = np.clip(det.xyxy[new_rows], -32768, 32767)
+    for i, name in enumerate(("x1", "y1", "x2", "y2")):
+        new[name] = xyxy[:, i]
+    return counts_bytes, upd.tobytes() + new.tobytes(), len(upd), len(new)
+
+
+def _bin_frame(st, det, table, h):
+    """h: 帧头字段 (flags, frame_index, capture_seq, fps, latency_ms, dropped, time_ms)。调用方需持有 st.send_lock。"""
+    ver = det.cache.get("bin_ver")
+    if ver is None:
+        # 第一次发送这份检测结果：分配版本号，并记下它的增量基准（上一份发送过的结果）
+        st.bin_ver += 1
+        ver = det.cache["bin_ver"] = st.bin_ver
+        det.cache["bin_base"] = st.bin_last_det
+        st.bin_last_det = det
+    flags, frame_index, capture_seq, fps, latency_ms, dropped, time_ms = h
+    tail = (frame_index, capture_seq)
+    info = (fps, max(0, latency_ms), dropped, time_ms)
+
+    counts_bytes, key_rec, n_key = _bin_key_body(det, table)
+    key = _BIN_HEADER.pack(_BIN_KEY, flags, 0, n_key, *tail, ver, 0, *info) + counts_bytes + key_rec
+    same = _BIN_HEADER.pack(_BIN_DELTA, flags, 0, 0, *tail, ver, ver, *info) + counts_bytes
+
+    base = det.cache.get("bin_base")
+    delta, base_ver = None, 0
+    if base is not None:
+        base_ver = base.cache["bin_ver"]
+        cached = det.cache.get("bin_delta")
+        if cached is None:
+            cached = det.cache["bin_delta"] = _bin_delta_body(det, base, table)
+        counts_bytes, rec, n_upd, n_new = cached
+        delta = _BIN_HEADER.pack(_BIN_DELTA, flags, n_upd, n_new, *tail, ver, base_ver, *info) + counts_bytes + rec
+        base.cache.pop("bin_base", None)  # 基准自己的基准已不再需要，断开引用链，旧结果可以被回收
+    return BinFrame(ver, base_ver, key, delta, same)
+
+
+def _bin_hello(st, table):
+    return {
+        "type": "hello",
+        "format": "bin1",
+        "stream": st.sid,
+        "source": str(st.source),
+        "behavior_order": _BEHAVIOR_ORDER,
+        "behavior_legend": _BEHAVIOR_LEGEND,
+        "behavior_en": {code: _BEHAVIOR_BY_CODE[code][2] for code in _BEHAVIOR_ORDER},
+        "class_names": table.class_names,
     }
-    if image_b64 is not None:
-        payload["image_jpeg_base64"] = image_b64
-    return payload
+# -----------------------------------------------------
+
+
 # 可选：给摄像头设定期望的采集参数（OBS 输出要尽量与之匹配）
 CAM_WIDTH = 1920
 CAM_HEIGHT = 1080
@@ -266,110 +1452,591 @@ def _open_capture(src):
         # 文件/网络流照旧
         return cv2.VideoCapture(src)
 
-# 在 processing_loop() 里，替换这一行：
-# cap = cv2.VideoCapture(SOURCE)
-# cap = _open_capture(SOURCE)
+def _new_tracker(frame_rate=30):
+    """按 TRACKER_CFG 为单路视频创建独立跟踪器。"""
+    return new_tracker(TRACKER_CFG, DEVICE, frame_rate)
+
+
+def _tile_rects(st, shape):
+    """把该路配置的 ROI 换算为像素矩形 [(x1, y1, x2, y2, imgsz)]，按画面尺寸缓存。"""
+    h, w = shape[:2]
+    rects = st._tile_rects.get((w, h))
+    if rects is None:
+        rects = []
+        for tile in st.tiles:
+            x1, y1, x2, y2 = (
+                v * (w if i % 2 == 0 else h) if v <= 1 else v for i, v in enumerate(tile["roi"])
+            )
+            x1, y1 = max(0, int(x1)), max(0, int(y1))
+            x2, y2 = min(w, int(round(x2))), min(h, int(round(y2)))
+            if x2 > x1 and y2 > y1:
+                rects.append((x1, y1, x2, y2, tile.get("imgsz")))
+        st._tile_rects[(w, h)] = rects
+    return rects
 
-def processing_loop():
-    global _latest_jpeg, _latest_size
-    os.environ["ULTRALYTICS_HIDE_VERSION_WARNING"] = "1"
 
-    model = YOLO(MODEL_PATH)
-    if DEVICE:
+def _merge_tiles(parts, shape):
+    """各区域的检测结果（已是区域内坐标）平移回原图，跨区域按类别做 NMS，返回跟踪器可用的 Boxes。"""
+    data = [r.boxes.data.cpu().numpy()[:, [0, 1, 2, 3, -2, -1]] + [x, y, x, y, 0, 0]
+            for (x, y), r in parts if r.boxes is not None and len(r.boxes)]
+    data = np.concatenate(data).astype(np.float32) if data else np.zeros((0, 6), np.float32)
+    if len(data) > 1:
+        t = torch.from_numpy(data)
+        keep = torchvision.ops.batched_nms(t[:, :4], t[:, 4], t[:, 5].long(), IOU_THRES).numpy()
+        data = data[np.sort(keep)]
+    return Boxes(data, shape[:2])
+
+
+def _track_result(tracker, result):
+    """把该路的检测结果交给该路的跟踪器，直接由跟踪器输出构造 Detections（等价于 model.track 的后处理）。"""
+    det = result.boxes.cpu().numpy()
+    return Detections.from_tracks(tracker.update(det, result.orig_img))
+
+
+def _load_model():
+    os.environ["ULTRALYTICS_HIDE_VERSION_WARNING"] = "1"
+    model = YOLO(resolve_weights(MODEL_PATH, BACKEND, BACKEND_INT8, data=BACKEND_DATA))
+    if DEVICE and BACKEND == "pt":
         model.to(DEVICE)
     try:
         class_names = model.names if hasattr(model, "names") else {}
     except Exception:
         class_names = {}
+    return model, BehaviorTable(class_names)
 
-    # cap = cv2.VideoCapture(SOURCE)
-    cap = _open_capture(SOURCE)
-    if not cap.isOpened():
-        print(f"[ERR] 无法打开视频源: {SOURCE}")
-        return
 
-    fps_cap = cap.get(cv2.CAP_PROP_FPS) or 30.0
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or 0
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 0
-    _latest_size = (width, height)
-    interval_frames = max(1, int(fps_cap * INFERENCE_INTERVAL_SEC))
+def _open_stream(st):
+    st.cap = _open_capture(st.source)
+    if not st.cap.isOpened():
+        print(f"[ERR] 无法打开视频源: {st.sid} -> {st.source}")
+        return False
+    st.fps_cap = st.cap.get(cv2.CAP_PROP_FPS) or 30.0
+    width = int(st.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or 0
+    height = int(st.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 0
+    st.size = (width, height)
+    st.tracker = _new_tracker(st.fps_cap)
+    st.start_t = time.time()
+    st.running = True
+    st.capture_thread = threading.Thread(target=capture_loop, args=(st,), name=f"capture-{st.sid}", daemon=True)
+    st.capture_thread.start()
+    print(f"[INFO] 推理启动: stream={st.sid}, source={st.source}, fps≈{st.fps_cap:.2f}, "
+          f"size=({width}x{height})")
+    return True
 
-    print(f"[INFO] 推理启动: source={SOURCE}, fps≈{fps_cap:.2f}, size=({width}x{height}), 每 {interval_frames} 帧推理一次")
 
-    frame_index = 0
-    last_result = None
-    infer_count = 0
-    start_t = time.time()
+def _close_stream(st):
+    st.running = False
+    print(f"[INFO] 推理结束: stream={st.sid}, 总帧 {st.frame_index}, 推理次数 {st.infer_count}, "
+          f"门控跳过 {st.gate.skipped}, "
+          f"丢弃 {st.slot.dropped}")
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
 
-        do_infer = (frame_index % interval_frames == 0)
+def capture_loop(st):
+    # 采集线程：只管读帧并覆盖该路的最新帧槽位，推理慢时旧帧直接被覆盖，不会在驱动缓冲里堆积
+    # 文件源默认按原始帧率读取（模拟实时流）；整段离线分析请走批处理模式
+    is_file = isinstance(st.source, str) and os.path.isfile(st.source)
+    period = 1.0 / st.fps_cap if (is_file and FILE_REALTIME) else 0.0
+    next_t = time.time()
+    got_frame = True   # 上次回到开头后是否读到过帧；一帧都读不出的文件不循环，避免空转
+    try:
+        while True:
+            t0 = time.perf_counter()
+            ret, frame = st.cap.read()
+            if not ret:
+                if is_file and FILE_LOOP and got_frame and st.cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                    got_frame = False
+                    continue
+                break
+            got_frame = True
+            _latency["capture"].observe(time.perf_counter() - t0)
+            # 文件源同时记下该帧在视频里的时间位置；摄像头/推流的 POS_MSEC 没有统一含义，不采用
+            st.slot.put(frame, time.time(), st.cap.get(cv2.CAP_PROP_POS_MSEC) if is_file else None)
+            if period:
+                next_t += period
+                delay = next_t - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_t = time.time()  # 落后时不追帧
+    finally:
+        st.cap.release()
+        st.slot.close()
 
-        if do_infer:
-            results = model.track(
-                source=frame,
-                tracker=TRACKER_CFG,
-                persist=PERSIST_TRACK,
+
+def _infer_batch(model, items):
+    """items: [(StreamState, frame, capture_ts)]。所有路的帧（及分块推理的各个区域）按输入尺寸分组拼批推理，
+    结果按顺序回到各自的跟踪器。"""
+    # 区域裁剪只是 NumPy 切片视图，不拷贝；同一输入尺寸的所有路、所有区域在一次 predict 里完成
+    groups = {}
+    for n, (st, frame, _) in enumerate(items):
+        if st.tiles:
+            for x1, y1, x2, y2, imgsz in _tile_rects(st, frame.shape):
+                groups.setdefault(imgsz, []).append((n, (x1, y1), frame[y1:y2, x1:x2]))
+        else:
+            groups.setdefault(None, []).append((n, None, frame))
+    outputs = [[] for _ in items]
+    for imgsz, crops in groups.items():
+        kwargs = {"imgsz": imgsz} if imgsz else {}
+        for i in range(0, len(crops), MAX_BATCH):
+            chunk = crops[i:i + MAX_BATCH]
+            results = model.predict(
+                source=[crop for _, _, crop in chunk],
                 stream=False,
                 show=False,
                 verbose=VERBOSE,
                 conf=CONF_THRES,
                 iou=IOU_THRES,
                 save=False,
-                show_conf=False,
+                **kwargs,
             )
-            if results:
-                last_result = results[0]
-                infer_count += 1
-
-        # 叠加绘制（用于 MJPEG 或可选内嵌 JSON 图像）
-        drawn = frame.copy()
-        drawn = _draw_detections(drawn, last_result, class_names)
-        jpeg_bytes = _encode_jpeg(drawn, JPEG_QUALITY)
-        if jpeg_bytes:
-            with _latest_jpeg_lock:
-                _latest_jpeg = jpeg_bytes
-
-        # 组织并广播 JSON
-        elapsed = time.time() - start_t
-        proc_fps = (frame_index + 1) / elapsed if elapsed > 0 else 0.0
+            for (n, offset, _), result in zip(chunk, results):
+                outputs[n].append((offset, result))
+
+    for (st, frame, ts), parts in zip(items, outputs):
+        if not PERSIST_TRACK:
+            st.tracker = _new_tracker(st.fps_cap)
+        if st.tiles:
+            dets = Detections.from_tracks(st.tracker.update(_merge_tiles(parts, frame.shape), frame))
+        else:
+            dets = _track_result(st.tracker, parts[0][1])
+        st.last_dets = _with_velocity(dets, st.last_dets if PERSIST_TRACK else None, ts)
+        st.infer_count += 1
+
+
+def _encode_stage(job):
+    # 叠加绘制（用于 MJPEG 或可选内嵌 JSON 图像）
+    # 采集槽位取走帧后即由本帧独占，推理也已结束，可以直接在原图上绘制，省一次整帧拷贝
+    # 每个变体只在这里编码一次，观看者共享同一份 JPEG
+    st = job.st
+    t0 = time.perf_counter()
+    drawn = _draw_detections(job.frame, job.dets, _behavior_table)
+    job.frame = None
+    t1 = time.perf_counter()
+    _latency["draw"].observe(t1 - t0)
+    h, w = drawn.shape[:2]
+    for key in job.variants:
+        width, quality = key
+        img = drawn
+        if 0 < width < w:
+            img = cv2.resize(drawn, (width, max(1, round(h * width / w))), interpolation=cv2.INTER_AREA)
+        jpeg = _encode_jpeg(img, quality)
+        if jpeg:
+            st.mjpeg.publish(key, jpeg, job.frame_index)
+    if INCLUDE_IMAGE_IN_JSON:
+        job.jpeg = _encode_jpeg(drawn, JPEG_QUALITY)
+    if job.variants or INCLUDE_IMAGE_IN_JSON:
+        _latency["encode"].observe(time.perf_counter() - t1)
+    return job if INCLUDE_IMAGE_IN_JSON else None
+
+
+def _same_detections(a, b):
+    return (a is b) or (
+        a is not None and b is not None and len(a) == len(b)
+        and np.array_equal(a.ids, b.ids) and np.array_equal(a.cls, b.cls)
+        and np.array_equal(a.xyxy, b.xyxy) and np.array_equal(a.conf, b.conf)
+    )
+
+
+def _det_counts(det, table):
+    counts = det.cache.get("counts")
+    if counts is None:
+        counts = det.cache["counts"] = table.counts(table.lookup(det.cls))
+    return counts
+
+
+def _serialize_stage(job):
+    # 按订阅档位组织消息：每个档位每帧只生成一次，所有同档客户端共享
+    # 检测结果部分按推理结果缓存，每帧只重新生成很小的帧头
+    st = job.st
+    job.serialize_t = time.time()
+    t0 = time.perf_counter()
+    det = job.dets if job.dets is not None else st.no_dets
+    kinds = st.ws_hub.kinds()
+    body = _serialized_body(det, _behavior_table) if "full" in kinds else None
+    image_b64 = base64.b64encode(job.jpeg).decode("ascii") if (INCLUDE_IMAGE_IN_JSON and job.jpeg and body) else None
+    with st.send_lock:
+        if job.frame_index <= st.last_sent_index:
+            return None  # 已有更新的帧发出，丢弃乱序的旧帧
+        st.last_sent_index = job.frame_index
+        # 复用上一次推理结果的帧 det 是同一个对象；新推理但结果完全一致时视为没有变化
+        changed = not _same_detections(det, st.last_sent_dets)
+        counts = _det_counts(det, _behavior_table)
+        st.history.add(job.capture_ts, [counts[c] for c in _BEHAVIOR_ORDER])
+        counts_changed = counts != st.last_sent_counts
+        st.last_sent_dets, st.last_sent_counts = det, counts
         now_ms = int(time.time() * 1000)
-        image_b64 = base64.b64encode(jpeg_bytes).decode("ascii") if (INCLUDE_IMAGE_IN_JSON and jpeg_bytes) else None
-        payload = _result_to_payload(
-            last_result, frame_index, now_ms, proc_fps, SOURCE, class_names, image_b64=image_b64
-        )
+        capture_ms = int(job.capture_ts * 1000)
+        latency_ms = now_ms - capture_ms
+        tick = {"stream": st.sid, "changed": changed, "counts_changed": counts_changed}
+        if body is not None:
+            header = {
+                "type": "frame",
+                "stream": st.sid,
+                "source": str(st.source),
+                "frame_index": job.frame_index,
+                "time_ms": now_ms,
+                "fps": round(job.fps, 2),
+                # 采集序号 / 累计丢帧 / 采集到结果发出的延迟 / 检测结果相对上一帧是否有变化
+                "capture_seq": job.seq,
+                "dropped_frames": st.slot.dropped,
+                "latency_ms": latency_ms,
+                "changed": changed,
+                "timing": _frame_timing(job, capture_ms, now_ms),
+            }
+            if image_b64 is not None:
+                header["image_jpeg_base64"] = image_b64
+            tick["full"] = json.dumps(header, ensure_ascii=False)[:-1] + "," + body + "}"
+        if "bin" in kinds:
+            tick["bin"] = _bin_frame(st, det, _behavior_table, (
+                int(changed) | (2 if det.pred is not None else 0), job.frame_index, job.seq, job.fps, latency_ms, st.slot.dropped, float(now_ms),
+            ))
+        if "counts" in kinds:
+            tick["counts"] = json.dumps({
+                "type": "counts",
+                "stream": st.sid,
+                "frame_index": job.frame_index,
+                "time_ms": now_ms,
+                "capture_ms": capture_ms,
+                "changed": counts_changed,
+                "behavior_counts": counts,
+            }, ensure_ascii=False)
+        t1 = time.perf_counter()
+        serialized_t = time.time()
+        _latency["serialize"].observe(t1 - t0)
         try:
-            ws_manager.broadcast(json.dumps(payload, ensure_ascii=False))
+            st.ws_hub.broadcast(tick)
         except Exception:
             pass
+        _latency["broadcast"].observe(time.perf_counter() - t1)
+    _slow_frames.observe(job, serialized_t, time.time())
+    return None
+
+
+def _frame_timing(job, capture_ms, send_ms):
+    """帧的时间链路（墙钟毫秒）：本帧采集 → 所用检测结果的推理起止 → 发出。
+    非推理帧（外推/沿用）的 infer_* 属于更早采集的那一帧（infer_capture_ms），二者之差就是结果的陈旧程度。"""
+    infer_capture, start, end, _ = job.infer or (None, None, None, None)
+    ms = lambda v: None if v is None else int(v * 1000)
+    return {
+        "capture_ms": capture_ms,
+        "media_ms": None if job.media_ms is None else round(job.media_ms, 1),
+        "infer_capture_ms": ms(infer_capture),
+        "infer_start_ms": ms(start),
+        "infer_end_ms": ms(end),
+        "send_ms": send_ms,
+    }
 
-        frame_index += 1
 
-    cap.release()
-    print(f"[INFO] 推理结束: 总帧 {frame_index}, 推理次数 {infer_count}")
+_behavior_table = BehaviorTable({})
+_encode_pipeline_stage = PipelineStage("encode", _encode_stage, workers=ENCODE_WORKERS)
+_serialize_pipeline_stage = PipelineStage("serialize", _serialize_stage, workers=SERIALIZE_WORKERS)
+if INCLUDE_IMAGE_IN_JSON:
+    # JSON 需要内嵌图像时，每帧都要编码，且序列化必须排在编码之后
+    _encode_pipeline_stage.to(_serialize_pipeline_stage)
+
+
+def _dispatch(job, now):
+    job.variants = job.st.mjpeg.want_variants(now)
+    if INCLUDE_IMAGE_IN_JSON:
+        _encode_pipeline_stage.submit(job)
+        return
+    # JSON 不必等 JPEG 编码；只有有人在看 MJPEG 且到了编码间隔，才绘制和编码这一帧
+    _serialize_pipeline_stage.submit(job)
+    if job.variants:
+        _encode_pipeline_stage.submit(job)
+
+
+def processing_loop(model=None):
+    # 所有路共用一个模型实例：每轮取各路最新一帧，需要推理的帧拼成一个批次
+    global _behavior_table
+    if model is None:
+        model, _behavior_table = _load_model()
+    else:
+        _behavior_table = BehaviorTable(getattr(model, "names", {}))
+    _encode_pipeline_stage.start()
+    _serialize_pipeline_stage.start()
+
+    active = [st for st in _streams.values() if _open_stream(st)]
+    while active:
+        with _frame_cond:
+            _frame_cond.wait_for(lambda: any(st.slot.pending() or st.slot.closed for st in active))
+
+        jobs = []
+        taken_t = time.time()
+        for st in list(active):
+            item = st.slot.take()
+            if item is None:
+                if st.slot.closed:
+                    _close_stream(st)
+                    active.remove(st)
+                continue
+            job = FrameJob(st, *item)
+            job.taken_t = taken_t
+            jobs.append(job)
+
+        now = time.time()
+        if active:
+            _scheduler.plan(active)
+        to_infer = []
+        for job in jobs:
+            if not _scheduler.due(job.st, now):
+                job.predict = PREDICT_BOXES  # 两次推理之间：外推；门控跳过说明画面没动，不外推
+            elif not MOTION_GATE or job.st.gate.should_infer(job.frame, now):
+                to_infer.append((job.st, job.frame, job.capture_ts))
+        if to_infer:
+            start = time.time()
+            t0 = time.perf_counter()
+            _infer_batch(model, to_infer)
+            elapsed = time.perf_counter() - t0
+            _scheduler.observe(len(to_infer), elapsed)
+            _latency["inference"].observe(elapsed)
+            end = time.time()
+            for st, _, ts in to_infer:
+                _scheduler.mark(st, now)
+                st.last_infer = (ts, start, end, len(to_infer))
+
+        # 推理线程只做推理；绘制/编码/序列化交给后续阶段并行完成
+        now = time.time()
+        for job in jobs:
+            st = job.st
+            job.frame_index = st.frame_index
+            job.dets = st.last_dets
+            if job.predict and st.last_dets is not None:
+                job.dets = _predict_detections(st.last_dets, job.capture_ts, st.size)
+            job.fps = st.proc_fps()
+            job.infer = st.last_infer
+            job.inferred = st.last_infer is not None and st.last_infer[0] == job.capture_ts
+            job.dispatch_t = now
+            _dispatch(job, now)
+            st.frame_index += 1
 
 # 启动后台线程
-_processing_thread = threading.Thread(target=processing_loop, name="yolo-worker", daemon=True)
-_processing_thread.start()
+def start_processing(model=None, streams=None):
+    """启动推理线程。model 为 None 时按 MODEL_PATH/BACKEND 加载；streams（stream_id -> SOURCE）替换 STREAMS。
+
+    导入本模块时自动以默认配置启动；基准测试/压测（bench.py）设置环境变量 CLASSVISION_NO_AUTOSTART=1 后，
+    换上桩模型和合成视频再调用。
+    """
+    global _processing_thread, _default_sid
+    if streams is not None:
+        _streams.clear()
+        _streams.update((sid, StreamState(sid, src)) for sid, src in streams.items())
+        _default_sid = next(iter(_streams))
+    _processing_thread = threading.Thread(target=processing_loop, args=(model,), name="yolo-worker", daemon=True)
+    _processing_thread.start()
+    return _processing_thread
+
+
+_processing_thread = None
+if not os.environ.get("CLASSVISION_NO_AUTOSTART"):
+    start_processing()
+
+def _stream_info(st):
+    w, h = st.size
+    return {
+        "id": st.sid,
+        "source": str(st.source),
+        "running": st.running,
+        "frame_index": st.frame_index,
+        "infer_count": st.infer_count,
+        "infer_rate": round(st.infer_rate, 2),
+        "motion_gate": st.gate.stats(),
+        "tiles": [
+            {"x1": x1, "y1": y1, "x2": x2, "y2": y2, "imgsz": imgsz}
+            for x1, y1, x2, y2, imgsz in st._tile_rects.get(st.size, [])
+        ],
+        "dropped_frames": st.slot.dropped,
+        "fps": round(st.proc_fps(), 2),
+        "frame_size": {"width": w, "height": h},
+        "ws_clients": st.ws_hub.count(),
+        "ws": st.ws_hub.stats(),
+        "mjpeg_viewers": st.mjpeg.viewer_count(),
+        "mjpeg_variants": st.mjpeg.stats(),
+    }
+
+def _pipeline_info():
+    return {stage.name: stage.stats() for stage in (_encode_pipeline_stage, _serialize_pipeline_stage)}
 
 @app.get("/health")
 def health():
-    return jsonify({"status": "ok", "model": os.path.basename(MODEL_PATH), "source": str(SOURCE)})
+    return jsonify({
+        "status": "ok",
+        "model": os.path.basename(MODEL_PATH),
+        "source": str(_streams[_default_sid].source),
+        "streams": {sid: _stream_info(st) for sid, st in _streams.items()},
+        "pipeline": _pipeline_info(),
+        "scheduler": _scheduler.stats(),
+        "latency": {stage: h.summary() for stage, h in _latency.items()},
+        "slow_frames": _slow_frames.stats(),
+    })
+
+
+def _metrics_text():
+    """Prometheus 文本格式（0.0.4）。"""
+    lines = [
+        "# HELP classvision_stage_seconds Processing time per pipeline stage.",
+        "# TYPE classvision_stage_seconds histogram",
+    ]
+    for stage, h in _latency.items():
+        buckets, total, count = h.export()
+        lines.extend(f'classvision_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}' for le, n in buckets)
+        lines.append(f'classvision_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'classvision_stage_seconds_count{{stage="{stage}"}} {count}')
+    lines += [
+        f"# HELP classvision_stage_window_seconds Rolling quantiles over the last {METRICS_WINDOW_SEC}-{2 * METRICS_WINDOW_SEC}s.",
+        "# TYPE classvision_stage_window_seconds gauge",
+    ]
+    for stage, h in _latency.items():
+        for q, v in zip(("0.5", "0.95", "0.99"), h.quantiles()):
+            if v is not None:
+                lines.append(f'classvision_stage_window_seconds{{stage="{stage}",quantile="{q}"}} {v}')
+
+    per_stream = (
+        ("frames_total", "counter", "Frames processed.", lambda st: st.frame_index),
+        ("inferences_total", "counter", "Frames sent to inference.", lambda st: st.infer_count),
+        ("dropped_frames_total", "counter", "Captured frames overwritten before inference.", lambda st: st.slot.dropped),
+        ("gate_skipped_total", "counter", "Inferences skipped by the motion gate.", lambda st: st.gate.skipped),
+        ("infer_rate", "gauge", "Target inference rate set by the scheduler (1/s).", lambda st: round(st.infer_rate, 3)),
+        ("ws_clients", "gauge", "Connected WebSocket clients.", lambda st: st.ws_hub.count()),
+        ("ws_dropped_total", "counter", "WebSocket messages dropped for slow clients.", lambda st: st.ws_hub.stats()["dropped"]),
+        ("ws_slow_disconnects_total", "counter", "WebSocket clients disconnected as stuck.", lambda st: st.ws_hub.slow_disconnects),
+        ("mjpeg_viewers", "gauge", "Connected MJPEG viewers.", lambda st: st.mjpeg.viewer_count()),
+    )
+    for name, kind, help_text, fn in per_stream:
+        lines += [f"# HELP classvision_{name} {help_text}", f"# TYPE classvision_{name} {kind}"]
+        lines.extend(f'classvision_{name}{{stream="{sid}"}} {fn(st)}' for sid, st in _streams.items())
+
+    for name, help_text in (("processed", "Jobs processed"), ("dropped", "Jobs dropped from a full queue"),
+                            ("errors", "Jobs that raised")):
+        lines += [f"# HELP classvision_pipeline_{name}_total {help_text} per pipeline stage.",
+                  f"# TYPE classvision_pipeline_{name}_total counter"]
+        lines.extend(f'classvision_pipeline_{name}_total{{stage="{stage}"}} {info[name]}'
+                     for stage, info in _pipeline_info().items())
+    lines += ["# HELP classvision_pipeline_queued Jobs waiting per pipeline stage.",
+              "# TYPE classvision_pipeline_queued gauge"]
+    lines.extend(f'classvision_pipeline_queued{{stage="{stage}"}} {info["queued"]}' for stage, info in _pipeline_info().items())
+    lines += [f"# HELP classvision_slow_frames_total Frames sent more than {TRACE_SLOW_MS}ms after capture.",
+              "# TYPE classvision_slow_frames_total counter",
+              f"classvision_slow_frames_total {_slow_frames.slow}"]
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(_metrics_text(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/trace/slow")
+def trace_slow():
+    """最近抽样记录的慢帧（新的在前）：?stream=&limit=。"""
+    sid = request.args.get("stream")
+    if sid is not None:
+        _get_stream(sid)
+    try:
+        limit = max(1, int(request.args.get("limit", 100)))
+    except ValueError:
+        abort(400, description="limit must be an integer")
+    return jsonify({**_slow_frames.stats(), "frames": _slow_frames.recent(sid, limit)})
+
+@app.get("/admin/profile")
+def admin_profile():
+    """采样分析：?seconds=10&hz=100&threads=yolo-worker,encode（all 为全部线程）&lines=1&format=json。
+
+    默认返回 collapsed stacks 文本，可直接交给 flamegraph.pl 或拖进 speedscope。
+    """
+    if not PROFILE_TOKEN:
+        abort(404)
+    token = request.headers.get("X-Admin-Token") or ""
+    if not hmac.compare_digest(token.encode("utf-8"), str(PROFILE_TOKEN).encode("utf-8")):
+        abort(403, description="invalid admin token")
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        hz = int(request.args.get("hz", 100))
+    except ValueError:
+        abort(400, description="seconds/hz must be numbers")
+    if not math.isfinite(seconds):
+        abort(400, description="seconds must be finite")
+    threads = request.args.get("threads")
+    prefixes = PROFILE_THREADS if not threads else (() if threads == "all" else tuple(threads.split(",")))
+    result = _profiler.sample(seconds, hz, prefixes, lines=request.args.get("lines") in ("1", "true"))
+    if result is None:
+        abort(409, description="a profile is already running")
+    stacks, info = result
+    ordered = sorted(stacks.items(), key=lambda kv: -kv[1])
+    if request.args.get("format") == "json":
+        return jsonify({**info, "stacks": [{"stack": k, "count": n} for k, n in ordered]})
+    body = "".join(f"{k} {n}\n" for k, n in ordered)
+    headers = {f"X-Profile-{k.replace('_', '-').title()}": str(v) for k, v in info.items() if k != "threads"}
+    return Response(body, mimetype="text/plain", headers=headers)
 
 @app.get("/config")
 def config():
-    w, h = _latest_size
+    st = _streams[_default_sid]
+    w, h = st.size
     return jsonify({
         "model_path": MODEL_PATH,
-        "source": str(SOURCE),
+        "backend": {"name": BACKEND, "int8": BACKEND_INT8},
+        "source": str(st.source),
+        "streams": {sid: str(s.source) for sid, s in _streams.items()},
+        "default_stream": _default_sid,
+        "max_batch": MAX_BATCH,
+        "scheduler": {
+            "min_interval_sec": INFERENCE_INTERVAL_SEC,
+            "cpu_share": INFER_CPU_SHARE,
+            "max_result_age": INFER_MAX_RESULT_AGE,
+        },
+        "trace": {"slow_ms": TRACE_SLOW_MS, "max_per_sec": TRACE_SLOW_MAX_PER_SEC, "file": TRACE_SLOW_FILE},
+        "profile": {"enabled": bool(PROFILE_TOKEN), "max_sec": PROFILE_MAX_SEC, "max_hz": PROFILE_MAX_HZ,
+                    "threads": list(PROFILE_THREADS)},
+        "pipeline": {
+            "queue_size": PIPELINE_QUEUE_SIZE,
+            "encode_workers": ENCODE_WORKERS,
+            "serialize_workers": SERIALIZE_WORKERS,
+        },
         "tracker": TRACKER_CFG,
         "include_image_in_json": INCLUDE_IMAGE_IN_JSON,
         "jpeg_quality": JPEG_QUALITY,
         "mjpeg_fps": MJPEG_FPS,
-        "frame_size": {"width": w, "height": h}
+        "mjpeg_widths": list(MJPEG_WIDTHS),
+        "mjpeg_qualities": list(MJPEG_QUALITIES),
+        "frame_size": {"width": w, "height": h},
+        # 模型类名 → 行为 code 的编译结果；unmapped 非空说明有类名没对上，需要补别名
+        "behavior_table": _behavior_table.describe(),
+    })
+
+@app.get("/streams")
+def streams():
+    return jsonify([_stream_info(st) for st in _streams.values()])
+
+@app.get("/history")
+def history():
+    """行为人数历史（列式）：?stream=&from=&to=&step=，时间为毫秒时间戳，step 为秒。
+
+    默认返回最近 45 分钟；空缺的时间桶为 null。
+    """
+    st = _get_stream(request.args.get("stream"))
+    try:
+        t1 = float(request.args.get("to", time.time() * 1000)) / 1000
+        t0 = float(request.args.get("from", t1 * 1000 - 45 * 60 * 1000)) / 1000
+        step = request.args.get("step")
+        step = None if step is None else float(step)
+    except ValueError:
+        abort(400, description="from/to/step must be numbers")
+    if not (math.isfinite(t0) and math.isfinite(t1)) or (step is not None and not math.isfinite(step)):
+        abort(400, description="from/to/step must be finite")
+    if t0 > t1 or (step is not None and step <= 0):
+        abort(400, description="from must not be later than to, step must be positive")
+    step, starts, mean, samples = st.history.query(t0, t1, step)
+    mean = np.round(mean, 2)
+    return jsonify({
+        "stream": st.sid,
+        "step": step,
+        "t": (starts * 1000).astype(np.int64).tolist(),
+        "samples": samples.tolist(),
+        "behavior_order": _BEHAVIOR_ORDER,
+        "counts": {
+            code: [None if np.isnan(v) else float(v) for v in mean[:, i].tolist()]
+            for i, code in enumerate(_BEHAVIOR_ORDER)
+        },
     })
 
 @app.route("/")
@@ -389,15 +2056,17 @@ def index():
   #right { display:flex; flex-direction:column; gap:12px; }
   #chart { width:560px; height:360px; border:1px solid #eee; }
   #log { width:560px; height:280px; border:1px solid #ccc; overflow:auto; white-space:pre; }
+  #latency { width:560px; font-size:13px; color:#333; white-space:pre; }
 </style>
 </head>
 <body>
   <div id="left">
-    <img id="mjpeg" src="/video.mjpg" />
+    <img id="mjpeg" />
     <canvas id="overlay"></canvas>
   </div>
   <div id="right">
     <div id="chart"></div>
+    <div id="latency"></div>
     <div>
       <h3 style="margin:6px 0;">WebSocket JSON (sample)</h3>
       <div id="log"></div>
@@ -412,6 +2081,14 @@ const ctx = canvas.getContext('2d');
 const logDiv = document.getElementById('log');
 const chart = echarts.init(document.getElementById('chart'));
 
+// 多路部署：/?stream=<id> 查看指定教室，缺省为默认路
+const PAGE_QS = new URLSearchParams(location.search);
+const STREAM = PAGE_QS.get('stream');
+const STREAM_QS = STREAM ? ('?stream=' + encodeURIComponent(STREAM)) : '';
+img.src = '/video.mjpg' + STREAM_QS;
+// /?format=bin：使用紧凑二进制协议（首条 hello 为 JSON，之后每帧为二进制，增量更新轨迹）
+const BINARY = PAGE_QS.get('format') === 'bin';
+
 const BEH_ORDER = ["u","d","c","b","p","s"];
 const BEH_LABEL_ZH = { "u":"抬头", "d":"低头", "c":"趴桌", "b":"回头", "p":"使用手机", "s":"站立" };
 
@@ -432,6 +2109,7 @@ function drawBoxes(objects) {
   for (const o of objects) {
     const {x1,y1,x2,y2} = o.bbox;
     const w = x2-x1, h = y2-y1;
+    ctx.setLineDash(o.predicted ? [4, 3] : []);  // 外推（预测）框画虚线
     ctx.strokeRect(x1,y1,w,h);
     const code = o.behavior?.code ?? "";
     const zh = o.behavior?.zh ?? "";
@@ -481,15 +2159,109 @@ function appendLog(text) {
   if (atBottom) logDiv.scrollTop = logDiv.scrollHeight;
 }
 
+// 端到端（采集 → 看板收到）延迟；服务端与浏览器不在同一台机器时依赖两边时钟同步（NTP）
+const latencyDiv = document.getElementById('latency');
+const e2eWindow = [];
+function updateLatency(data) {
+  const now = Date.now();
+  const t = data.timing;
+  const capture = t ? t.capture_ms : data.time_ms - data.latency_ms;
+  const send = t ? t.send_ms : data.time_ms;
+  const e2e = now - capture;
+  e2eWindow.push(e2e);
+  if (e2eWindow.length > 100) e2eWindow.shift();
+  const avg = e2eWindow.reduce((a, b) => a + b, 0) / e2eWindow.length;
+  let text = `端到端延迟 ${e2e} ms（最近 ${e2eWindow.length} 帧 平均 ${avg.toFixed(0)} / 最大 ${Math.max(...e2eWindow)} ms）\n`
+           + `  服务端 采集→发出 ${send - capture} ms，传输 ${now - send} ms`;
+  if (t && t.infer_end_ms !== null) {
+    text += `\n  推理 ${t.infer_end_ms - t.infer_start_ms} ms，检测结果采集于 ${capture - t.infer_capture_ms} ms 前`;
+  }
+  if (t && t.media_ms !== null) text += `，视频位置 ${(t.media_ms / 1000).toFixed(2)} s`;
+  latencyDiv.textContent = text;
+}
+
+const bin = { hello: null, ver: -1, tracks: new Map(), untracked: [] };
+
+function binObject(id, x1, y1, x2, y2, cls, beh, conf) {
+  const h = bin.hello;
+  const code = beh >= 0 ? h.behavior_order[beh] : null;
+  return {
+    id: id >= 0 ? id : null,
+    class_id: cls,
+    class_name: h.class_names[cls] ?? String(cls),
+    conf: conf / 255,
+    bbox: {x1, y1, x2, y2},
+    behavior: code ? {code, zh: h.behavior_legend[code], en: h.behavior_en[code]} : null,
+  };
+}
+
+function decodeBinFrame(buf) {
+  // 布局见服务端 _BIN_HEADER / _BIN_FULL / _BIN_UPD 注释
+  const dv = new DataView(buf);
+  const kind = dv.getUint8(0), flags = dv.getUint8(1);
+  const nUpd = dv.getUint16(2, true), nNew = dv.getUint16(4, true);
+  const ver = dv.getUint32(14, true), baseVer = dv.getUint32(18, true);
+  let off = 42;
+  const counts = {};
+  for (const k of bin.hello.behavior_order) { counts[k] = dv.getUint16(off, true); off += 2; }
+  if (!(kind === 2 && baseVer === ver)) {
+    const prev = kind === 2 ? bin.tracks : new Map();
+    const tracks = new Map(), untracked = [];
+    for (let i = 0; i < nUpd; i++, off += 11) {
+      const id = dv.getInt32(off, true), p = prev.get(id);
+      if (!p) continue;
+      tracks.set(id, binObject(id,
+        p.bbox.x1 + dv.getInt8(off + 4), p.bbox.y1 + dv.getInt8(off + 5),
+        p.bbox.x2 + dv.getInt8(off + 6), p.bbox.y2 + dv.getInt8(off + 7),
+        dv.getUint8(off + 8), dv.getInt8(off + 9), dv.getUint8(off + 10)));
+    }
+    for (let i = 0; i < nNew; i++, off += 15) {
+      const id = dv.getInt32(off, true);
+      const o = binObject(id,
+        dv.getInt16(off + 4, true), dv.getInt16(off + 6, true), dv.getInt16(off + 8, true), dv.getInt16(off + 10, true),
+        dv.getUint8(off + 12), dv.getInt8(off + 13), dv.getUint8(off + 14));
+      if (id >= 0) tracks.set(id, o); else untracked.push(o);
+    }
+    bin.tracks = tracks;
+    bin.untracked = untracked;
+    bin.ver = ver;
+  }
+  return {
+    type: 'frame',
+    frame_index: dv.getUint32(6, true),
+    capture_seq: dv.getUint32(10, true),
+    fps: dv.getFloat32(22, true),
+    latency_ms: dv.getUint32(26, true),
+    dropped_frames: dv.getUint32(30, true),
+    time_ms: dv.getFloat64(34, true),
+    changed: (flags & 1) === 1,
+    behavior_counts: counts,
+    // 外推帧的框在服务端按速度预测，bin1 不逐框标记，有 id 的轨迹都视为预测
+    objects: (flags & 2) ? [...[...bin.tracks.values()].map(o => ({...o, predicted: true})), ...bin.untracked]
+                         : [...bin.tracks.values(), ...bin.untracked],
+  };
+}
+
+const wsParams = new URLSearchParams();
+if (STREAM) wsParams.set('stream', STREAM);
+if (BINARY) wsParams.set('format', 'bin');
 const wsProto = location.protocol === 'https:' ? 'wss' : 'ws';
-const ws = new WebSocket(wsProto + '://' + location.host + '/ws');
+const ws = new WebSocket(wsProto + '://' + location.host + '/ws' + (wsParams.toString() ? '?' + wsParams : ''));
+ws.binaryType = 'arraybuffer';
 ws.onopen = () => appendLog('WS connected');
 ws.onclose = () => appendLog('WS closed');
 ws.onerror = (e) => appendLog('WS error');
 ws.onmessage = (ev) => {
   try {
-    const data = JSON.parse(ev.data);
-    drawBoxes(data.objects || []);
+    let data;
+    if (typeof ev.data === 'string') {
+      data = JSON.parse(ev.data);
+      if (data.type === 'hello') { bin.hello = data; appendLog('WS hello: ' + data.format); return; }
+      if (data.type !== 'frame' && data.type !== 'counts') { appendLog('WS ' + ev.data); return; }
+    } else {
+      data = decodeBinFrame(ev.data);
+    }
+    if (data.type === 'frame') { drawBoxes(data.objects || []); updateLatency(data); }
     const counts = ensureCounts(data);
     updateChart(counts);
     if (data.frame_index % 10 === 0) appendLog(JSON.stringify({frame_index: data.frame_index, behavior_counts: counts}));
@@ -503,46 +2275,405 @@ ws.onmessage = (ev) => {
     """
     return Response(html, mimetype="text/html")
 
+_MJPEG_BOUNDARY = "frameboundary"
+_MJPEG_HEADERS = {
+    "Cache-Control": "no-cache, private",
+    "Pragma": "no-cache",
+    "Age": "0",
+    "Content-Type": f"multipart/x-mixed-replace; boundary=--{_MJPEG_BOUNDARY}"
+}
+
+
+def _mjpeg_params(st, args):
+    """解析观看者的 fps / w / q，返回 (fps, 变体 key)；参数不合法时抛 ValueError（消息即 400 的说明）。
+
+    fps 截到 [0.1, MJPEG_MAX_FPS]；w（0 为原始尺寸）/ q 归并到最近的共享变体档位。
+    """
+    try:
+        fps = float(args.get("fps", MJPEG_FPS))
+        width = int(args.get("w", 0))
+        quality = int(args.get("q", JPEG_QUALITY))
+    except ValueError:
+        raise ValueError("fps/w/q must be numbers") from None
+    if not math.isfinite(fps):
+        raise ValueError("fps must be finite")
+    if width < 0:
+        raise ValueError("w must not be negative")
+    if not 1 <= quality <= 100:
+        raise ValueError("q must be between 1 and 100")
+    fps = min(max(fps, 0.1), MJPEG_MAX_FPS)
+    key = _snap_variant(width, quality)
+    if st.size[0] and key[0] >= st.size[0]:
+        key = (0, key[1])  # 不放大：请求宽度不小于原图时与原始尺寸共用一个变体
+    return fps, key
+
+
+def _mjpeg_part(data):
+    return (
+        f"--{_MJPEG_BOUNDARY}\r\n"
+        f"Content-Type: image/jpeg\r\n"
+        f"Content-Length: {len(data)}\r\n\r\n"
+    ).encode("utf-8") + data + b"\r\n"
+
+
+def _mjpeg_response(st):
+    try:
+        fps, key = _mjpeg_params(st, request.args)
+    except ValueError as e:
+        abort(400, description=str(e))
+
+    def gen():
+        interval = 1.0 / fps
+        token, vkey = st.mjpeg.subscribe(key, fps)
+        seq = 0
+        next_due = 0.0
+        try:
+            while True:
+                # 观看者自己的帧率低于编码帧率时，等到下一个发送时刻再取最新帧
+                delay = next_due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                seq, data = st.mjpeg.wait_next(vkey, seq)
+                if data is None:
+                    continue
+                next_due = time.time() + interval
+                yield _mjpeg_part(data)
+        finally:
+            st.mjpeg.unsubscribe(token, vkey)
+
+    return Response(gen(), headers=_MJPEG_HEADERS)
+
 @app.route("/video.mjpg")
 def mjpeg_stream():
-    boundary = "frameboundary"
-    def gen():
-        interval = 1.0 / max(1, MJPEG_FPS)
+    return _mjpeg_response(_get_stream(request.args.get("stream")))
+
+@app.route("/streams/<sid>/video.mjpg")
+def stream_mjpeg(sid):
+    return _mjpeg_response(_get_stream(sid))
+
+def _ws_parse_subscription(data, client):
+    """校验 subscribe 指令 / 连接参数，返回 (变更字典, 错误信息)。"""
+    changes = {}
+    if "fields" in data:
+        if data["fields"] not in ("full", "counts"):
+            return None, "fields must be 'full' or 'counts'"
+        changes["fields"] = data["fields"]
+    if "max_hz" in data:
+        try:
+            max_hz = float(data["max_hz"])
+        except (TypeError, ValueError):
+            return None, "max_hz must be a number"
+        if not 0 <= max_hz <= 100:
+            return None, "max_hz must be between 0 and 100"
+        changes["max_hz"] = max_hz
+    if "changes_only" in data:
+        changes["changes_only"] = data["changes_only"] in (True, 1, "1", "true")
+    if "format" in data:
+        if data["format"] not in ("json", "bin"):
+            return None, "format must be 'json' or 'bin'"
+        changes["binary"] = data["format"] == "bin"
+    if "streams" in data:
+        streams = data["streams"]
+        if streams == "*":
+            streams = list(_streams)
+        elif isinstance(streams, str):
+            streams = [x for x in streams.split(",") if x]
+        if not isinstance(streams, list) or not streams or any(sid not in _streams for sid in streams):
+            return None, f"streams must be '*' or a list of: {', '.join(_streams)}"
+        changes["streams"] = set(streams)
+    binary = changes.get("binary", client.binary)
+    if binary and changes.get("fields", client.fields) == "full" and len(changes.get("streams", client.streams)) > 1:
+        return None, "format 'bin' supports a single stream"
+    return changes, None
+
+
+def _ws_apply_subscription(client, changes, loop=None):
+    # 先从旧的 hub 全部退订，修改后再重新登记，保证各 hub 的分档计数一致
+    for sid in client.streams:
+        _streams[sid].ws_hub.remove(client)
+    old_streams, old_kind = client.streams, client.kind
+    hello = False
+    for key, value in changes.items():
+        if getattr(client, key) != value:
+            setattr(client, key, value)
+            hello = hello or key in ("binary", "streams")
+    for sid in client.streams:
+        if sid not in old_streams or client.kind != old_kind:
+            client._dirty.pop(sid, None)  # 新订阅的路/换了档位：下一条消息对该客户端一定算有变化
+        _streams[sid].ws_hub.add(client, loop)
+    if client.binary and hello and client.streams:
+        # 二进制协议的图例/类名只在订阅建立时发一次；换了路就从关键帧重新开始
+        client.version = None
+        client.reply(_bin_hello(_streams[next(iter(client.streams))], _behavior_table))
+
+
+def _ws_connect_args(args, sid=None):
+    """连接参数：?stream=<id> 或 ?streams=a,b / *、?fields=counts、?max_hz=2、?changes=1、?format=bin。"""
+    data = {"streams": [sid] if sid else (args.get("streams") or [args.get("stream") or _default_sid])}
+    for key in ("fields", "max_hz", "format"):
+        if args.get(key) is not None:
+            data[key] = args.get(key)
+    if args.get("changes") is not None:
+        data["changes_only"] = args.get("changes")
+    return data
+
+
+def _ws_command(client, text, loop=None):
+    """处理客户端发来的 JSON 指令（与 app.py 的指令风格一致）。"""
+    try:
+        data = json.loads(text)
+    except Exception:
+        client.reply({"type": "error", "message": "invalid JSON"})
+        return
+    if not isinstance(data, dict):
+        client.reply({"type": "error", "message": "invalid JSON"})
+        return
+    cmd = data.get("type")
+    if cmd == "ping":
+        client.reply({"type": "pong", "t": int(time.time() * 1000)})
+    elif cmd in ("subscribe", "set_interval"):
+        if cmd == "set_interval":
+            # 兼容 app.py：推送间隔（毫秒）→ max_hz
+            ms = data.get("ms")
+            if not isinstance(ms, int) or not 50 <= ms <= 10_000:
+                client.reply({"type": "error", "message": "ms must be integer between 50 and 10000"})
+                return
+            data = {"max_hz": 1000.0 / ms}
+        changes, err = _ws_parse_subscription(data, client)
+        if err:
+            client.reply({"type": "error", "message": err})
+            return
+        _ws_apply_subscription(client, changes, loop)
+        client.reply({"type": "ack", "action": cmd, "subscription": client.subscription()})
+    else:
+        client.reply({"type": "error", "message": "unknown command"})
+
+
+def _ws_serve(ws, sid=None):
+    # flask-sock（WSGI）模式：每个连接一个发送线程 + 本线程接收指令
+    client = ThreadWSClient()
+    changes, err = _ws_parse_subscription(_ws_connect_args(request.args, sid), client)
+    if err:
+        ws.close(reason=1008, message=err)
+        return
+    _ws_apply_subscription(client, changes)
+    state = {"running": True}
+
+    def sender():
+        try:
+            while state["running"]:
+                ws.send(client.next())  # 阻塞等待新消息
+                client.sent += 1
+        except Exception:
+            pass
+
+    t = threading.Thread(target=sender, name="ws-sender", daemon=True)
+    t.start()
+    try:
         while True:
-            time.sleep(interval)
-            with _latest_jpeg_lock:
-                data = _latest_jpeg
-            if data is None:
-                continue
-            yield (
-                f"--{boundary}\r\n"
-                f"Content-Type: image/jpeg\r\n"
-                f"Content-Length: {len(data)}\r\n\r\n"
-            ).encode("utf-8") + data + b"\r\n"
-
-    headers = {
-        "Cache-Control": "no-cache, private",
-        "Pragma": "no-cache",
-        "Age": "0",
-        "Content-Type": f"multipart/x-mixed-replace; boundary=--{boundary}"
-    }
-    return Response(gen(), headers=headers)
+            msg = ws.receive()
+            if msg is None:
+                break
+            _ws_command(client, msg)
+    except Exception:
+        pass
+    finally:
+        state["running"] = False
+        _ws_apply_subscription(client, {"streams": set()})
+        client.reply({"type": "bye"})  # 唤醒发送线程使其退出
 
 @sock.route("/ws")
 def ws(ws):
-    # 为此连接创建独立队列
-    q = ws_manager.add(ws)
+    _ws_serve(ws)
+
+@sock.route("/streams/<sid>/ws")
+def stream_ws(ws, sid):
+    if sid not in _streams:
+        ws.close(reason=1008, message="unknown stream")
+        return
+    _ws_serve(ws, sid)
+
+
+# ---------------- ASGI 入口（hypercorn serverapp_v3:asgi_app） ----------------
+# WebSocket 与 MJPEG 长连接由 asyncio 原生处理：所有客户端共用一个事件循环，不再每个客户端占一个线程，
+# 客户端断开（websocket.disconnect / http.disconnect）时立即注销；其余 HTTP 路由仍交给 Flask，在独立线程池里执行。
+_flask_asgi = AsyncioWSGIMiddleware(app)
+
+
+async def _asgi_ws_sender(client, send):
+    while True:
+        data = await client.next()
+        event = {"type": "websocket.send"}
+        event["bytes" if isinstance(data, bytes) else "text"] = data
+        try:
+            await asyncio.wait_for(send(event), WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            for sid in client.streams:
+                _streams[sid].ws_hub.slow_disconnects += 1
+            return
+        client.sent += 1
+
+
+async def _asgi_ws_receiver(client, receive, loop):
+    while True:
+        event = await receive()
+        if event["type"] == "websocket.disconnect":
+            return
+        if event.get("text") is not None:
+            _ws_command(client, event["text"], loop)
+
+
+async def _asgi_websocket(scope, receive, send):
+    args = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+    path = scope["path"].rstrip("/")
+    sid, err = None, None
+    if path.startswith("/streams/") and path.endswith("/ws"):
+        sid = path[len("/streams/"):-len("/ws")]
+        if sid not in _streams:
+            err = "unknown stream"
+    elif path != "/ws":
+        err = "not found"
+    client = AsyncWSClient()
+    if err is None:
+        changes, err = _ws_parse_subscription(_ws_connect_args(args, sid), client)
+    await receive()  # websocket.connect
+    if err is not None:
+        await send({"type": "websocket.close", "code": 1008})
+        return
+    await send({"type": "websocket.accept"})
+
+    loop = asyncio.get_running_loop()
+    _ws_apply_subscription(client, changes, loop)
+    sender = asyncio.ensure_future(_asgi_ws_sender(client, send))
+    receiver = asyncio.ensure_future(_asgi_ws_receiver(client, receive, loop))
     try:
-        # 只发不收；若需心跳可 ws.receive(timeout=...) 并忽略
-        while True:
-            msg = q.get()  # 阻塞等待新消息
-            ws.send(msg)
-    except Exception:
+        done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        if sender in done:
+            # 慢客户端或发送异常：主动关闭
+            try:
+                await send({"type": "websocket.close", "code": 1011})
+            except Exception:
+                pass
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        _ws_apply_subscription(client, {"streams": set()}, loop)
+
+
+async def _asgi_plain(send, status, text):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
+
+
+async def _asgi_mjpeg_sender(st, vkey, fps, wake, send):
+    interval = 1.0 / fps
+    seq = 0
+    next_due = 0.0
+    while True:
+        # 观看者自己的帧率低于编码帧率时，等到下一个发送时刻再取最新帧
+        delay = next_due - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        wake.clear()
+        seq, data = st.mjpeg.latest(vkey, seq)
+        if data is None:
+            try:
+                await asyncio.wait_for(wake.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        next_due = time.time() + interval
+        await send({"type": "http.response.body", "body": _mjpeg_part(data), "more_body": True})
+
+
+async def _asgi_disconnected(receive):
+    while (await receive())["type"] != "http.disconnect":
         pass
+
+
+async def _asgi_mjpeg(scope, receive, send, sid):
+    """/video.mjpg 与 /streams/<sid>/video.mjpg：观看者在事件循环里等新帧，收到 http.disconnect 即注销。"""
+    args = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+    sid = sid or args.get("stream")
+    st = _streams.get(sid or _default_sid)
+    if st is None:
+        await _asgi_plain(send, 404, f"unknown stream: {sid}")
+        return
+    try:
+        fps, key = _mjpeg_params(st, args)
+    except ValueError as e:
+        await _asgi_plain(send, 400, str(e))
+        return
+
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    def notify():
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    token, vkey = st.mjpeg.subscribe(key, fps, notify)
+    try:
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in _MJPEG_HEADERS.items()]})
+        sender = asyncio.ensure_future(_asgi_mjpeg_sender(st, vkey, fps, wake, send))
+        watcher = asyncio.ensure_future(_asgi_disconnected(receive))
+        try:
+            await asyncio.wait({sender, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sender.cancel()
+            watcher.cancel()
     finally:
-        ws_manager.remove(ws)
+        st.mjpeg.unsubscribe(token, vkey)
+
+
+def _asgi_mjpeg_sid(path):
+    """MJPEG 路径 → 路由用的 sid（"" 为默认路，取 ?stream=）；不是 MJPEG 路径时返回 None。"""
+    path = path.rstrip("/")
+    if path == "/video.mjpg":
+        return ""
+    if path.startswith("/streams/") and path.endswith("/video.mjpg"):
+        return path[len("/streams/"):-len("/video.mjpg")]
+    return None
+
+
+async def _asgi_lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            # Flask 路由在线程池里同步执行，默认线程池偏小
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=ASGI_HTTP_THREADS, thread_name_prefix="http")
+            )
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "websocket":
+        await _asgi_websocket(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await _asgi_lifespan(receive, send)
+    else:
+        sid = _asgi_mjpeg_sid(scope["path"]) if scope.get("method") in ("GET", "HEAD") else None
+        if sid is None:
+            await _flask_asgi(scope, receive, send)
+        else:
+            await _asgi_mjpeg(scope, receive, send, sid)
+# -----------------------------------------------------
+
 
 if __name__ == "__main__":
-    # 直接用 Flask 内置服务器即可运行（开发用途）
-    # 生产建议用 gunicorn + gevent 或 waitress 等部署
-    app.run(host="0.0.0.0", port=8000, threaded=True)
\ No newline at end of file
+    # 默认用 hypercorn 跑 ASGI 入口（WS 在事件循环里扇出，可支撑数百个看板）
+    # 也可以直接用 Flask 内置服务器：app.run(host="0.0.0.0", port=8000, threaded=True)，此时 WS 每个客户端一个线程
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    hc_config = Config()
+    hc_config.bind = ["0.0.0.0:8000"]
+    asyncio.run(serve(asgi_app, hc_config))
\ No newline at end of file
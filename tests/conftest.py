@@ -0,0 +1,8 @@
+"""
+单元测试只覆盖不需要模型、摄像头的纯逻辑：导入 serverapp_v3 时不自动启动采集/推理。
+"""
+import os
+import sys
+
+os.environ.setdefault("CLASSVISION_NO_AUTOSTART", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+import pytest
+
+import analyze_video as av
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    video = tmp_path / "lesson.mp4"
+    video.write_bytes(b"frames")
+    weights = tmp_path / "best.pt"
+    weights.write_bytes(b"weights-v1")
+    tracker = tmp_path / "botsort.yaml"
+    tracker.write_text("tracker_type: botsort\n", encoding="utf-8")
+    monkeypatch.setattr(av, "MODEL_PATH", str(weights))
+    monkeypatch.setattr(av, "TRACKER_CFG", str(tracker))
+    av._hash_memo.clear()
+    return video, weights, tracker
+
+
+def test_cache_key_is_content_addressed(setup, tmp_path):
+    video, _, _ = setup
+    name, key = av._cache_key(str(video), 1)
+    copy = tmp_path / "renamed.mp4"
+    copy.write_bytes(video.read_bytes())
+    assert av._cache_key(str(copy), 1)[0] == name   # 同样内容、不同路径命中同一条目
+    assert key["every"] == 1 and len(name) == 64
+
+
+def test_cache_key_changes_with_inputs(setup, monkeypatch):
+    video, weights, tracker = setup
+    name = av._cache_key(str(video), 1)[0]
+    assert av._cache_key(str(video), 2)[0] != name
+    iou = av.IOU_THRES
+    monkeypatch.setattr(av, "IOU_THRES", iou + 0.1)
+    assert av._cache_key(str(video), 1)[0] != name
+    monkeypatch.setattr(av, "IOU_THRES", iou)
+    assert av._cache_key(str(video), 1)[0] == name
+    tracker.write_text("tracker_type: bytetrack\n", encoding="utf-8")
+    assert av._cache_key(str(video), 1)[0] != name
+
+
+def test_weights_change_invalidates(setup):
+    video, weights, _ = setup
+    name = av._cache_key(str(video), 1)[0]
+    weights.write_bytes(b"weights-v2, retrained")
+    assert av._cache_key(str(video), 1)[0] != name
@@ -0,0 +1,41 @@
+import os
+
+import analyze_video as av
+
+
+def _video(tmp_path, data=b"frames"):
+    path = tmp_path / "lesson.mp4"
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_job_key_is_stable(tmp_path):
+    path = _video(tmp_path)
+    assert av._job_key(path, 1) == av._job_key(path, 1)
+
+
+def test_job_key_changes_with_file_and_parameters(tmp_path, monkeypatch):
+    path = _video(tmp_path)
+    key = av._job_key(path, 1)
+    assert av._job_key(path, 5) != key
+    monkeypatch.setattr(av, "CONF_THRES", av.CONF_THRES + 0.1)
+    assert av._job_key(path, 1) != key
+    monkeypatch.undo()
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 10))
+    assert av._job_key(path, 1) != key
+    _video(tmp_path, b"re-recorded")
+    assert av._job_key(path, 1)["size"] != key["size"]
+
+
+def test_progress_round_trip_ignores_torn_line(tmp_path):
+    out = str(tmp_path / "out")
+    av._append_progress(out, "a.mp4", {"every": 1}, {"frames": 10})
+    av._append_progress(out, "b.mp4", {"every": 2}, {"frames": 20})
+    with open(os.path.join(out, av.PROGRESS_FILE), "a", encoding="utf-8") as f:
+        f.write('{"path": "c.mp4", "ke')   # 崩溃时留下的半行
+    assert av._load_progress(out) == {"a.mp4": {"every": 1}, "b.mp4": {"every": 2}}
+
+
+def test_missing_progress_file(tmp_path):
+    assert av._load_progress(str(tmp_path / "none")) == {}
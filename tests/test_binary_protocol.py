@@ -0,0 +1,89 @@
+import types
+
+import numpy as np
+
+import serverapp_v3 as srv
+
+TABLE = srv.BehaviorTable({0: "LookingUp", 1: "LookingDown", 2: "UsingPhone"})
+HEAD = (1, 10, 11, 25.0, 40, 0, 1.7e12)   # flags, frame_index, capture_seq, fps, latency_ms, dropped, time_ms
+
+
+def _det(rows):
+    """rows: [(id, x1, y1, x2, y2, cls, conf)]"""
+    a = np.array(rows, dtype=np.float64).reshape(-1, 7)
+    return srv.Detections(a[:, 1:5].astype(np.int32), a[:, 5].astype(np.int32),
+                          a[:, 6].astype(np.float32), a[:, 0].astype(np.int64))
+
+
+def _decode(msg, state):
+    """按协议解出 (帧头, 计数, {id: (x1, y1, x2, y2, cls)})；增量帧以 state（基准版本的结果）为底。"""
+    head = srv._BIN_HEADER.unpack_from(msg, 0)
+    kind, _, n_upd, n_new, _, _, ver, base_ver = head[:8]
+    off = srv._BIN_HEADER.size
+    counts = srv._BIN_COUNTS.unpack_from(msg, off)
+    off += srv._BIN_COUNTS.size
+    if kind == srv._BIN_DELTA and n_upd == n_new == 0 and ver == base_ver:
+        return head, counts, dict(state)   # 只有帧头：结果未变
+    out = {}
+    upd = np.frombuffer(msg, srv._BIN_UPD, n_upd, off)
+    off += upd.nbytes
+    for r in upd:
+        x1, y1, x2, y2, _ = state[int(r["id"])]
+        out[int(r["id"])] = (x1 + r["dx1"], y1 + r["dy1"], x2 + r["dx2"], y2 + r["dy2"], int(r["cls"]))
+    full = np.frombuffer(msg, srv._BIN_FULL, n_new, off)
+    for r in full:
+        out[int(r["id"])] = (int(r["x1"]), int(r["y1"]), int(r["x2"]), int(r["y2"]), int(r["cls"]))
+    return head, counts, out
+
+
+def _expected(det):
+    return {int(i): (*map(int, box), int(c)) for i, box, c in zip(det.ids, det.xyxy, det.cls)}
+
+
+def _stream():
+    return types.SimpleNamespace(bin_ver=0, bin_last_det=None)
+
+
+def test_key_frame_round_trip():
+    det = _det([(1, 10, 20, 50, 90, 0, 0.9), (2, 100, 20, 150, 90, 2, 0.5)])
+    frame = srv._bin_frame(_stream(), det, TABLE, HEAD)
+    head, counts, tracks = _decode(frame.pick(None), {})
+    assert head[0] == srv._BIN_KEY and head[1] == 1
+    assert tracks == _expected(det)
+    assert counts[:3] == (1, 0, 0) and counts[4] == 1   # u / d / c，p 在第 5 位
+
+
+def test_delta_round_trip_with_small_and_large_moves():
+    st = _stream()
+    a = _det([(1, 10, 20, 50, 90, 0, 0.9), (2, 100, 20, 150, 90, 1, 0.5), (3, 5, 5, 9, 9, 0, 0.4)])
+    b = _det([(1, 12, 21, 52, 88, 1, 0.9),       # 小幅移动 → 更新记录
+              (2, 400, 20, 450, 90, 1, 0.5),     # 超过 ±127 → 完整记录
+              (4, 7, 7, 30, 30, 2, 0.8)])        # 新轨迹；3 消失
+    fa = srv._bin_frame(st, a, TABLE, HEAD)
+    fb = srv._bin_frame(st, b, TABLE, HEAD)
+    _, _, state = _decode(fa.pick(None), {})
+    msg = fb.pick(fa.ver)
+    assert msg is fb.delta
+    head, _, tracks = _decode(msg, state)
+    assert head[2:4] == (1, 2)
+    assert tracks == _expected(b)
+
+
+def test_pick_by_client_version():
+    st = _stream()
+    a, b = _det([(1, 0, 0, 10, 10, 0, 1.0)]), _det([(1, 1, 1, 11, 11, 0, 1.0)])
+    fa, fb = srv._bin_frame(st, a, TABLE, HEAD), srv._bin_frame(st, b, TABLE, HEAD)
+    assert fb.pick(None) is fb.key          # 新客户端：关键帧
+    assert fb.pick(fa.ver) is fb.delta      # 持有基准：增量
+    assert fb.pick(fb.ver) is fb.same       # 已是最新：只有帧头
+    assert fb.pick(12345) is fb.key         # 版本对不上：关键帧
+    _, _, tracks = _decode(fb.same, _expected(b))
+    assert tracks == _expected(b)
+
+
+def test_reused_result_keeps_version():
+    st = _stream()
+    det = _det([(1, 0, 0, 10, 10, 0, 1.0)])
+    first = srv._bin_frame(st, det, TABLE, HEAD)
+    again = srv._bin_frame(st, det, TABLE, HEAD)
+    assert first.ver == again.ver == st.bin_ver == 1
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import serverapp_v3 as srv
+
+NOW = 1_000_000.0
+TIERS = ((1, 60), (10, 60))   # 1 秒粒度保留 1 分钟，10 秒粒度保留 10 分钟
+
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setattr(srv.time, "time", lambda: NOW)
+    h = srv.CountHistory(TIERS)
+    for i in range(600):
+        t = NOW - 600 + i
+        h.add(t, np.full(6, i % 10, np.float32))
+    return h
+
+
+def test_recent_range_uses_finest_tier(history):
+    step, starts, mean, samples = history.query(NOW - 10, NOW)
+    assert step == 1
+    assert starts[0] == NOW - 10 and len(starts) == 11
+    assert samples[:-1].tolist() == [1] * 10
+    assert mean[0, 0] == (600 - 10) % 10
+
+
+def test_older_range_falls_back_to_coarse_tier(history):
+    step, starts, mean, samples = history.query(NOW - 300, NOW)
+    assert step == 10
+    assert samples[0] == 10
+    assert mean[0, 0] == pytest.approx(4.5)   # 10 个 0..9 的平均
+
+
+def test_step_merges_buckets(history):
+    step, starts, _, samples = history.query(NOW - 30, NOW, 5)
+    assert step == 5
+    assert np.all(starts % 5 == 0)
+    assert samples[1] == 5
+
+
+def test_huge_step_is_clamped_to_the_span(history):
+    step, starts, _, samples = history.query(NOW - 300, NOW, 1e11)
+    assert len(starts) <= 2
+    assert step <= 310
+    assert samples.sum() >= 300   # 整个区间的样本都合并进了这一两个点
+
+
+def test_range_beyond_retention_is_trimmed(history):
+    step, starts, _, samples = history.query(NOW - 10 ** 9, NOW + 10 ** 9)
+    assert starts[0] >= NOW - 600
+    assert len(starts) <= srv.HISTORY_MAX_POINTS + 1
+
+
+def test_missing_buckets_are_nan(monkeypatch):
+    monkeypatch.setattr(srv.time, "time", lambda: NOW)
+    h = srv.CountHistory(TIERS)
+    h.add(NOW - 5, np.ones(6, np.float32))
+    _, _, mean, samples = h.query(NOW - 6, NOW)
+    assert samples.tolist() == [0, 1, 0, 0, 0, 0, 0]
+    assert np.isnan(mean[0]).all() and mean[1, 0] == 1
+
+
+@pytest.mark.parametrize("query", ["step=0", "step=-1", "step=nan", "step=inf", "from=nan", "to=inf", "step=x"])
+def test_history_endpoint_rejects_bad_parameters(query):
+    assert srv.app.test_client().get("/history?" + query).status_code == 400
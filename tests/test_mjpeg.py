@@ -0,0 +1,41 @@
+import pytest
+
+import serverapp_v3 as srv
+
+
+class _Stream:
+    size = (1920, 1080)
+
+
+@pytest.mark.parametrize("args, expected", [
+    ({}, (srv.MJPEG_FPS, (0, srv.JPEG_QUALITY))),
+    ({"w": "0"}, (srv.MJPEG_FPS, (0, srv.JPEG_QUALITY))),
+    ({"w": "500", "q": "55"}, (srv.MJPEG_FPS, (640, 60))),
+    ({"w": "4000"}, (srv.MJPEG_FPS, (0, srv.JPEG_QUALITY))),
+    ({"fps": "1000"}, (srv.MJPEG_MAX_FPS, (0, srv.JPEG_QUALITY))),
+    ({"fps": "0"}, (0.1, (0, srv.JPEG_QUALITY))),
+])
+def test_mjpeg_params_snaps_to_shared_variants(args, expected):
+    assert srv._mjpeg_params(_Stream(), args) == expected
+
+
+def test_mjpeg_params_does_not_upscale():
+    st = _Stream()
+    st.size = (640, 360)
+    assert srv._mjpeg_params(st, {"w": "640"})[1] == (0, srv.JPEG_QUALITY)
+
+
+@pytest.mark.parametrize("args", [
+    {"fps": "x"}, {"w": "1.5"}, {"fps": "nan"}, {"fps": "inf"},
+    {"w": "-5"}, {"q": "0"}, {"q": "-10"}, {"q": "500"},
+])
+def test_mjpeg_params_rejects_invalid(args):
+    with pytest.raises(ValueError):
+        srv._mjpeg_params(_Stream(), args)
+
+
+def test_mjpeg_route_returns_400():
+    client = srv.app.test_client()
+    resp = client.get("/video.mjpg?w=-5")
+    assert resp.status_code == 400
+    assert b"w must not be negative" in resp.data
@@ -0,0 +1,44 @@
+import numpy as np
+
+import serverapp_v3 as srv
+
+
+def _frame(value=100, h=360, w=640):
+    return np.full((h, w, 3), value, np.uint8)
+
+
+def test_first_frame_is_inferred():
+    gate = srv.MotionGate()
+    assert gate.should_infer(_frame(), 0.0)
+
+
+def test_static_scene_is_skipped_until_max_skip():
+    gate = srv.MotionGate()
+    gate.should_infer(_frame(), 0.0)
+    assert not gate.should_infer(_frame(), 0.5)
+    assert not gate.should_infer(_frame(), srv.MOTION_MAX_SKIP_SEC - 0.01)
+    assert gate.should_infer(_frame(), srv.MOTION_MAX_SKIP_SEC)
+    assert gate.stats()["skipped"] == 2 and gate.stats()["checked"] == 4
+
+
+def test_small_noise_is_ignored():
+    gate = srv.MotionGate()
+    gate.should_infer(_frame(100), 0.0)
+    assert not gate.should_infer(_frame(100 + srv.MOTION_PIXEL_DELTA - 2), 0.1)
+
+
+def test_local_change_triggers_inference():
+    gate = srv.MotionGate()
+    gate.should_infer(_frame(), 0.0)
+    moved = _frame()
+    moved[100:200, 200:300] = 255   # 一个学生站起来
+    assert gate.should_infer(moved, 0.1)
+
+
+def test_compares_against_last_inferred_frame():
+    # 每帧只变一点点、单看相邻帧都低于阈值，累积起来仍要触发推理
+    gate = srv.MotionGate()
+    gate.should_infer(_frame(100), 0.0)
+    results = [gate.should_infer(_frame(100 + 4 * i), 0.1 * i) for i in range(1, 6)]
+    assert results[:2] == [False, False]
+    assert any(results)
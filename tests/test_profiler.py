@@ -0,0 +1,73 @@
+import pytest
+
+import serverapp_v3 as srv
+
+TOKEN = "secret"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(srv, "PROFILE_TOKEN", TOKEN)
+    return srv.app.test_client()
+
+
+def _get(client, query, token=TOKEN):
+    headers = {"X-Admin-Token": token} if token is not None else {}
+    return client.get("/admin/profile?" + query, headers=headers)
+
+
+def test_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(srv, "PROFILE_TOKEN", None)
+    assert srv.app.test_client().get("/admin/profile", headers={"X-Admin-Token": ""}).status_code == 404
+
+
+def test_token_only_from_header(client):
+    assert _get(client, f"seconds=0.1&token={TOKEN}", token=None).status_code == 403
+    assert _get(client, "seconds=0.1", token="wrong").status_code == 403
+
+
+@pytest.mark.parametrize("query", ["seconds=nan", "seconds=inf", "seconds=-inf", "seconds=x", "hz=nan", "hz=1.5"])
+def test_rejects_invalid_parameters(client, query):
+    assert _get(client, query).status_code == 400
+    assert not srv._profiler.running
+
+
+def test_profile_returns_and_releases(client):
+    resp = _get(client, "seconds=0.1&hz=50&threads=all&format=json")
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data["ticks"] >= 1 and data["seconds"] < 1.0
+    assert not srv._profiler.running
+
+
+def test_sample_clamps_duration(monkeypatch):
+    monkeypatch.setattr(srv, "PROFILE_MAX_SEC", 0.2)
+    _, info = srv.SamplingProfiler().sample(1e9, 1e9, prefixes=())
+    assert info["seconds"] < 1.0 and info["hz"] == srv.PROFILE_MAX_HZ
+
+
+def test_sample_rejects_non_finite():
+    profiler = srv.SamplingProfiler()
+    with pytest.raises(ValueError):
+        profiler.sample(float("nan"), 100)
+    assert not profiler.running
+
+
+def test_running_reset_when_sampling_fails(monkeypatch):
+    profiler = srv.SamplingProfiler()
+
+    def boom(*args):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(profiler, "_sample", boom)
+    with pytest.raises(RuntimeError):
+        profiler.sample(1, 10)
+    assert not profiler.running
+
+
+def test_busy_returns_409(client):
+    srv._profiler.running = True
+    try:
+        assert _get(client, "seconds=0.1").status_code == 409
+    finally:
+        srv._profiler.running = False
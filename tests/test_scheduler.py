@@ -0,0 +1,60 @@
+import types
+
+import pytest
+
+import serverapp_v3 as srv
+
+
+def _streams(n, fps=25.0):
+    return [types.SimpleNamespace(fps_cap=fps, infer_rate=0.0, next_infer_t=0.0) for _ in range(n)]
+
+
+def test_before_any_measurement_runs_at_ceiling():
+    sched = srv.InferenceScheduler()
+    streams = _streams(2)
+    sched.plan(streams)
+    assert [st.infer_rate for st in streams] == [min(25.0, 1 / srv.INFERENCE_INTERVAL_SEC)] * 2
+    assert not sched.overloaded
+
+
+def test_budget_is_split_across_streams():
+    sched = srv.InferenceScheduler()
+    sched.observe(1, 0.06)                       # 60 ms / 帧 → 预算 0.6 / 0.06 = 10 帧/秒
+    assert sched.budget_rate == pytest.approx(srv.INFER_CPU_SHARE / 0.06)
+    streams = _streams(4)
+    sched.plan(streams)
+    assert streams[0].infer_rate == pytest.approx(sched.budget_rate / 4)
+
+
+def test_batch_cost_is_per_frame_and_smoothed():
+    sched = srv.InferenceScheduler()
+    sched.observe(4, 0.4)                        # 批量 4 帧共 400 ms → 每帧 100 ms
+    assert sched.cost == pytest.approx(0.1)
+    sched.observe(1, 0.2)
+    assert sched.cost == pytest.approx(0.8 * 0.1 + 0.2 * 0.2)
+
+
+def test_floor_and_overload_flag():
+    sched = srv.InferenceScheduler()
+    sched.observe(1, 1.0)                        # 太慢：预算每秒 0.6 帧
+    streams = _streams(3)
+    sched.plan(streams)
+    assert sched.overloaded
+    assert all(st.infer_rate == pytest.approx(1.0 / srv.INFER_MAX_RESULT_AGE) for st in streams)
+
+
+def test_rate_capped_by_camera_fps():
+    sched = srv.InferenceScheduler()
+    sched.observe(1, 0.001)
+    streams = _streams(1, fps=5.0)
+    sched.plan(streams)
+    assert streams[0].infer_rate == 5.0
+
+
+def test_due_and_mark_leave_half_frame_tolerance():
+    st = _streams(1, fps=20.0)[0]
+    st.infer_rate = 10.0
+    srv.InferenceScheduler.mark(st, 100.0)
+    assert st.next_infer_t == pytest.approx(100.0 + 0.1 - 0.025)
+    assert not srv.InferenceScheduler.due(st, 100.05)
+    assert srv.InferenceScheduler.due(st, 100.08)
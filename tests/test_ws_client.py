@@ -0,0 +1,88 @@
+import json
+
+import serverapp_v3 as srv
+
+
+def _tick(sid, text, changed=True):
+    msg = json.dumps({"type": "counts", "stream": sid, "changed": changed, "v": text})
+    return {"stream": sid, "counts": msg, "changed": changed, "counts_changed": changed}
+
+
+def _drain(client):
+    out = []
+    while client._ready():
+        out.append(json.loads(client._take()))
+    return out
+
+
+def test_backlog_is_capped_per_stream():
+    client = srv.WSClient(fields="counts")
+    client.streams = {"a", "b", "c", "d"}
+    for sid in "abcd":
+        assert client.offer(_tick(sid, sid)) == 0
+    assert [m["v"] for m in _drain(client)] == ["a", "b", "c", "d"]
+    assert client.dropped == 0
+
+
+def test_only_own_older_message_is_dropped(monkeypatch):
+    monkeypatch.setattr(srv, "WS_CLIENT_QUEUE", 2)
+    client = srv.WSClient(fields="counts")
+    drops = [client.offer(_tick(text[0], text)) for text in ("a1", "b1", "a2", "a3")]
+    assert drops == [0, 0, 0, 1] and client.dropped == 1
+    assert [m["v"] for m in _drain(client)] == ["b1", "a2", "a3"]
+    assert client._queued == {"a": 0, "b": 0}
+
+
+def test_first_message_is_changed_for_the_client():
+    client = srv.WSClient(fields="counts", changes_only=True)
+    client.offer(_tick("a", "first", changed=False))
+    client.offer(_tick("a", "same", changed=False))
+    msgs = _drain(client)
+    assert [(m["v"], m["changed"]) for m in msgs] == [("first", True)]
+
+
+def test_change_during_rate_limit_is_carried_to_next_message(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(srv.time, "monotonic", lambda: now[0])
+    client = srv.WSClient(fields="counts", max_hz=1.0, changes_only=True)
+    client.offer(_tick("a", "t0"))
+    now[0] += 0.2
+    client.offer(_tick("a", "t1", changed=True))   # 限速中，被跳过
+    now[0] += 1.0
+    client.offer(_tick("a", "t2", changed=False))
+    assert [(m["v"], m["changed"]) for m in _drain(client)] == [("t0", True), ("t2", True)]
+
+
+def test_dropped_change_is_carried_to_replacement(monkeypatch):
+    monkeypatch.setattr(srv, "WS_CLIENT_QUEUE", 1)
+    client = srv.WSClient(fields="counts")
+    client.offer(_tick("a", "first"))
+    _drain(client)
+    client.offer(_tick("a", "moved", changed=True))
+    client.offer(_tick("a", "still", changed=False))  # 挤掉 moved，变化要算到这一条上
+    assert [(m["v"], m["changed"]) for m in _drain(client)] == [("still", True)]
+
+
+def test_binary_first_frame_sets_changed_flag():
+    head = bytes((srv._BIN_DELTA, 0)) + b"rest"
+    frame = srv.BinFrame(1, 0, bytes((srv._BIN_KEY, 0)) + b"key", head, head)
+    client = srv.WSClient(binary=True)
+    client.offer({"stream": "a", "bin": frame, "changed": False, "counts_changed": False})
+    data = client._take()
+    assert data[1] & 1 and data[0] == srv._BIN_KEY
+    assert client.version == 1
+
+
+def test_resubscribe_resets_change_state():
+    sid = srv._default_sid
+    client = srv.WSClient(fields="counts", changes_only=True)
+    srv._ws_apply_subscription(client, {"streams": {sid}})
+    try:
+        client.offer(_tick(sid, "first", changed=False))
+        client.offer(_tick(sid, "same", changed=False))
+        srv._ws_apply_subscription(client, {"streams": set()})
+        srv._ws_apply_subscription(client, {"streams": {sid}})
+        client.offer(_tick(sid, "again", changed=False))
+        assert [m["v"] for m in _drain(client)] == ["first", "again"]
+    finally:
+        srv._ws_apply_subscription(client, {"streams": set()})